@@ -1,16 +1,59 @@
-from flask import Flask, request, jsonify, redirect, url_for
-import os
-import sqlite3
-from service_config.config import modes, check_ports, regexp, InvalidPortMappingException, PortAlreadyUsedException
-from tasks.init_repo import load_repository
-from tasks.exceptions import InvalidVolumeMappingException, RepositoryAlreadyExistsException
-import subprocess
+import hmac
 import json
-from git import GitCommandError
-from base64 import b64encode
 import logging
-import docker
+import math
+import os
+import time
+from base64 import b64encode
+from functools import partial
+from hashlib import sha256
+
 from docker.errors import NotFound
+from flask import Flask, Response, g, jsonify, redirect, request, stream_with_context, url_for
+
+from service_config import database, metrics
+from service_config.config import (
+    InvalidPortMappingException,
+    PortAlreadyUsedException,
+    check_ports,
+    clone_strategies,
+    default_clone_strategy,
+    default_poll_interval,
+    default_update_strategy,
+    free_port_ranges,
+    gc_interval,
+    max_page_size,
+    metrics_flush_interval,
+    modes,
+    normalize_url,
+    parse_ports,
+    poll_workers,
+    priority_classes,
+    retry_after,
+    store_ports,
+    update_strategies,
+    webhook_secret,
+)
+from tasks import scheduler
+from tasks.delete_repo import delete_repository
+from tasks.deploy_log import follow_interval, is_running, list_deploys, read_lines
+from tasks.exceptions import (
+    InvalidFilesException,
+    InvalidRegistrationException,
+    InvalidVolumeMappingException,
+    QueueFullException,
+    RepositoryAlreadyExistsException,
+)
+from tasks.image_gc import ImageCollector
+from tasks.init_repo import initialize_repository, remove_stale_clones, reserve_repository
+from tasks.jobs import JobRunner, get_job
+from tasks.locks import lock_state
+from tasks.mirror import remove_stale_mirrors
+from tasks.poller import Poller
+from tasks.spool import collect_garbage, store_files
+from tasks.start_service import launch_service, prepull_image
+from tasks.status_cache import StatusCache
+from tasks.update_service import update_repository
 
 # create directory for service repositories
 if 'services' not in os.listdir():
@@ -27,40 +70,221 @@ else:
         keys = json.load(file)
 
 # initialize database for service management
-with sqlite3.connect('services/services.db') as db:
-    cursor = db.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS repos(id TEXT PRIMARY KEY, url TEXT, mode TEXT,'
-                   'state TEXT, port TEXT, docker_root TEXT, image TEXT, tag TEXT)')
-    cursor.close()
-    db.commit()
+database.migrate()
+
+# background workers executing service tasks
+runner = JobRunner()
+runner.recover()
+
+# remove spooled custom files of finished jobs
+collect_garbage()
+
+# remove clones, mirrors and reservations of registrations interrupted by terminated API workers
+remove_stale_clones()
+remove_stale_mirrors()
+
+# container states maintained from the Docker events stream
+status_cache = StatusCache()
+
+# observations of this worker are added to the shared totals in the database
+metrics.start(metrics_flush_interval)
 
 app = Flask(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # route templates keep the number of label values bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_start, method=request.method,
+                    route=route, status=response.status_code)
+
+    return response
+
+
 def check_volumes(volumes):
     if type(volumes) is not list:
         raise InvalidVolumeMappingException('Volume mapping list expected')
-    if any([len(volume.split(':')) != 2 for volume in volumes]):
+    if any(type(volume) is not str or len(volume.split(':')) != 2 for volume in volumes):
         raise InvalidVolumeMappingException('Invalid volume mapping format provided')
 
 
-def start_update(service_id: str, files: dict, volumes: list[str]):
-    subprocess.Popen(['python', 'tasks/update_service.py', service_id, json.dumps(files),
-                      json.dumps(volumes)])
+def parse_volumes(data: dict) -> list[str]:
+    """
+    Load and validate the volume mappings of a request, empty mappings are ignored
 
+    :param data: JSON payload of the request
+    :raises InvalidVolumeMappingException
+    :return: list of volume mappings
+    """
+    volumes = data.get('volumes', [])
+
+    if type(volumes) is list:
+        volumes = [volume for volume in volumes if volume != '']
+
+    check_volumes(volumes)
+
+    return volumes
 
-def valid(docker_mode: str):
+
+def parse_files(data: dict) -> dict:
+    """
+    Load and validate the custom files of a request
+
+    :param data: JSON payload of the request
+    :raises InvalidFilesException
+    :return: dictionary with (file_path, file_content) pairs
+    """
+    files = data.get('files', {})
+
+    if type(files) is not dict or any(type(content) is not str for content in files.values()):
+        raise InvalidFilesException('Custom files object expected')
+
+    return files
+
+
+def start_update(service_id: str, files: dict, volumes: list[str], spooled=False, priority_class='normal'):
+    # rejected before the custom files are spooled
+    scheduler.admit('update', service_id, priority_class)
+
+    # jobs reference the custom files in the spool instead of carrying their contents
+    if not spooled:
+        files = store_files(files)
+
+    # merge bursts of update requests into a single rebuild using the latest payload
+    return runner.submit('update', service_id, update_repository, service_id, files, volumes, coalesce=True,
+                         priority_class=priority_class)
+
+
+def parse_priority(value) -> str:
+    """
+    Validate the priority class of a deployment request
+
+    :param value: requested priority class, None selects "normal"
+    :raises ValueError: if the priority class is unknown
+    :return: priority class
+    """
+    if value is None:
+        return 'normal'
+
+    if value not in priority_classes:
+        raise ValueError(f'unknown priority class {value}')
+
+    return value
+
+
+def queue_full(e: QueueFullException):
+    # clients back off instead of growing the queue without bound
+    logging.warning(e.message)
+
+    return Response(e.message, 429, headers={'Retry-After': str(e.retry_after)})
+
+
+def parse_poll_interval(value) -> float:
+    """
+    Validate the poll interval of a service
+
+    :param value: seconds between two polls of the service's remote, 0 disables polling
+    :raises ValueError: if the value isn't a finite, non-negative number
+    :return: poll interval in seconds
+    """
+    if isinstance(value, bool) or (interval := float(value)) < 0 or not math.isfinite(interval):
+        raise ValueError(f'invalid poll interval {value}')
+
+    return interval
+
+
+def parse_registration(data: dict) -> tuple[dict, dict, list[str]]:
+    """
+    Validate the specification of a new service. Port mappings are only checked for their format.
+
+    :param data: JSON payload of the registration
+    :raises KeyError: if the mode is missing
+    :raises InvalidFilesException
+    :raises InvalidVolumeMappingException
+    :raises InvalidPortMappingException
+    :raises InvalidRegistrationException: if parameters are missing or unsupported
+    :return: keyword arguments of reserve_repository(), custom files and volume mappings
+    """
+    # load git clone URL and initialization mode
+    url = data['url'] if 'url' in data else ''
+    files = parse_files(data)
+    volumes = parse_volumes(data)
+    mode = data['mode']
+    port = ''
+    image = ''
+    tag = ''
+
+    # mode "docker" requires external port mapping
+    if mode in ['docker', 'dockerfile'] and not valid(mode, data):
+        logging.warning(f'Invalid configuration for mode {mode}')
+        raise InvalidRegistrationException('missing parameters')
+    elif mode in ['docker', 'dockerfile']:
+        image = data['image'] if mode == 'dockerfile' else ''
+        tag = data['tag'] if mode == 'dockerfile' else ''
+
+        # check port mapping format
+        parse_ports(port := data['port'])
+
+    # repository relative directory containing the Dockerfile or docker-compose.yml
+    docker_root = data['docker_root'] if 'docker_root' in data else '.'
+
+    # clone strategy and deployed branch of the git repository
+    clone_strategy = data.get('clone_strategy') or default_clone_strategy
+    branch = data.get('branch', '')
+    update_strategy = data.get('update_strategy') or default_update_strategy
+
+    try:
+        poll_interval = parse_poll_interval(data.get('poll_interval', default_poll_interval))
+    except (TypeError, ValueError):
+        raise InvalidRegistrationException('invalid poll interval')
+
+    # requested mode not supported
+    if mode not in modes:
+        logging.warning(f'Unsupported mode selected: {mode}')
+        raise InvalidRegistrationException('unsupported mode')
+
+    if clone_strategy not in clone_strategies:
+        logging.warning(f'Unsupported clone strategy selected: {clone_strategy}')
+        raise InvalidRegistrationException('unsupported clone strategy')
+
+    if update_strategy not in update_strategies:
+        logging.warning(f'Unsupported update strategy selected: {update_strategy}')
+        raise InvalidRegistrationException('unsupported update strategy')
+
+    return {'url': url, 'mode': mode, 'port': port, 'docker_root': docker_root, 'image': image, 'tag': tag,
+            'clone_strategy': clone_strategy, 'branch': branch, 'update_strategy': update_strategy,
+            'poll_interval': poll_interval}, files, volumes
+
+
+# polls the remotes of services without webhooks, only one API worker polls at a time
+poller = Poller(start_update)
+if poll_workers:
+    poller.start()
+
+# removes unused images and build cache and measures the disk use of the services
+image_collector = ImageCollector()
+if gc_interval:
+    image_collector.start()
+
+
+def valid(docker_mode: str, data: dict):
     """
     Check proper configuration for selected docker mode
 
     :param docker_mode: docker mode name
+    :param data: JSON payload of the registration
     :return: True, if all needed parameters are provided for the given docker_mode, otherwise False
     """
     if docker_mode == 'docker':
-        return 'port' in request.json
+        return 'port' in data
     elif docker_mode == 'dockerfile':
-        return ('port' in request.json and 'image' in request.json and 'tag' in request.json and request.json['tag']
-                and request.json['image'])
+        return 'port' in data and 'image' in data and 'tag' in data and data['tag'] and data['image']
     else:
         return True
 
@@ -81,98 +305,312 @@ def update_service(service_id: str):
         logging.warning('Invalid API key provided or missing')
         return 'valid API-KEY required', 400
 
-    with sqlite3.connect('services/services.db') as service_db:
-        service_db.create_function('REGEXP', 2, regexp)
+    # search service
+    service_data = database.query_one('SELECT state, port, image, tag FROM repos WHERE id = ?', (service_id,))
 
-        # search service
-        service_cursor = service_db.cursor()
-        service_cursor.execute('SELECT * FROM repos WHERE id = ?', (service_id,))
+    # service exists
+    if service_data:
+        state, port, image, tag = service_data
 
-        # service exists
-        if service_data := service_cursor.fetchone():
-            _, url, mode, _, port, docker_root, image, tag = service_data
+        if state == 'DELETING':
+            job = database.query_one('SELECT id FROM jobs WHERE service_id = ? AND kind = "delete" '
+                                     'ORDER BY created DESC', (service_id,))
 
-            # service update requested
-            if (method := request.method) == 'POST':
-                logging.info(f'Updating {service_id}...')
+            # repeated deletions return the running job
+            if request.method in ['GET', 'DELETE']:
+                return jsonify({'id': service_id, 'job': job[0] if job else None, 'state': state}), \
+                    200 if request.method == 'GET' else 202
 
-                payload = request.json
+            return f'{service_id} is being deleted', 409
 
-                files = payload['files'] if 'files' in payload else {}
-                volumes = payload['volumes'] if 'volumes' in payload else []
+        # the repository doesn't exist yet, deletions run after the clone
+        if state == 'CLONING' and request.method != 'DELETE':
+            job = database.query_one('SELECT id FROM jobs WHERE service_id = ? AND kind = "start" '
+                                     'ORDER BY created DESC', (service_id,))
 
-                if '' in volumes:
-                    volumes.remove('')
+            if request.method == 'GET':
+                return jsonify({'id': service_id, 'job': job[0] if job else None, 'state': state,
+                                'lock': lock_state(service_id)}), 200
 
-                try:
-                    check_volumes(volumes)
-
-                    # start background task to update the service
-                    start_update(service_id, files, volumes)
-                    return 'Update initiated', 200
-                except InvalidVolumeMappingException as e:
-                    logging.error(f'Invalid volume mapping provided: {e}')
-                    return e.message, 400
-            elif method == 'DELETE':
-                delete_process = subprocess.run(['python', 'tasks/delete_repo.py', service_id])
-
-                if delete_process.returncode == 0:
-                    return f'{service_id} removed', 200
-                else:
-                    logging.error(f'deletion of {service_id} failed')
-                    return 'deletion not completed', 500
-            elif method == 'PATCH':
-                payload = request.json
-
-                if 'port' in payload:
-                    try:
-                        check_ports(payload['port'], service_db.cursor())
-                    except InvalidPortMappingException as e:
-                        return e.message, 400
-                    except PortAlreadyUsedException as e:
-                        return e.message, 400
-
-                for param in ['tag', 'port']:
-                    if param in payload:
-                        if payload[param]:
-                            update_cursor = service_db.cursor()
+            return f'{service_id} is being cloned', 409
+
+        # service update requested
+        if (method := request.method) == 'POST':
+            logging.info(f'Updating {service_id}...')
+
+            payload = request.json
+
+            try:
+                files = parse_files(payload)
+                volumes = parse_volumes(payload)
+                priority_class = parse_priority(payload.get('priority'))
+
+                # start background task to update the service
+                job_id = start_update(service_id, files, volumes, priority_class=priority_class)
+                return jsonify({'id': service_id, 'job': job_id, 'state': 'Update initiated'}), 200
+            except InvalidFilesException as e:
+                return e.message, 400
+            except InvalidVolumeMappingException as e:
+                logging.error(f'Invalid volume mapping provided: {e}')
+                return e.message, 400
+            except ValueError:
+                return 'unsupported priority', 400
+            except QueueFullException as e:
+                return queue_full(e)
+        elif method == 'DELETE':
+            database.set_state(service_id, 'DELETING')
+
+            # stopping containers and removing the clone takes too long for a request
+            job_id = runner.submit('delete', service_id, delete_repository, service_id)
+            return jsonify({'id': service_id, 'job': job_id, 'state': 'DELETING'}), 202
+        elif method == 'PATCH':
+            payload = request.json
+
+            if payload.get('update_strategy') and payload['update_strategy'] not in update_strategies:
+                return 'unsupported update strategy', 400
+
+            try:
+                poll_interval = parse_poll_interval(payload['poll_interval']) if 'poll_interval' in payload else None
+            except (TypeError, ValueError):
+                return 'invalid poll interval', 400
+
+            try:
+                priority_class = parse_priority(payload.get('priority'))
+            except ValueError:
+                return 'unsupported priority', 400
+
+            try:
+                volumes = parse_volumes(payload)
+            except InvalidVolumeMappingException as e:
+                logging.error(f'Invalid volume mapping provided: {e}')
+                return e.message, 400
+
+            # the configuration isn't changed, if the restart can't be queued
+            try:
+                scheduler.admit('update', service_id, priority_class)
+            except QueueFullException as e:
+                return queue_full(e)
+
+            try:
+                with database.transaction() as service_db:
+                    update_cursor = service_db.cursor()
+
+                    if payload.get('port'):
+                        # the service's own ports may be kept
+                        check_ports(payload['port'], update_cursor, service_id)
+                        store_ports(payload['port'], service_id, update_cursor)
+
+                    for param in ['tag', 'port', 'update_strategy']:
+                        if payload.get(param):
                             update_cursor.execute(f'UPDATE repos SET {param} = ? WHERE id = ?',
                                                   (payload[param], service_id))
-                            service_db.commit()
 
-                volumes = payload['volumes'] if 'volumes' in payload else []
+                    if poll_interval is not None:
+                        update_cursor.execute('UPDATE repos SET poll_interval = ? WHERE id = ?',
+                                              (poll_interval, service_id))
+            except (InvalidPortMappingException, PortAlreadyUsedException) as e:
+                return e.message, 400
+
+            try:
+                job_id = start_update(service_id, {}, volumes, priority_class=priority_class)
+            # filled by other requests since the admission check
+            except QueueFullException as e:
+                return queue_full(e)
+
+            return jsonify({'id': service_id, 'job': job_id,
+                            'state': f'service "{service_id}" patched and restarted'}), 200
+        else:
+            errors = status_cache.errors(f'services/{service_id}/error.txt')
 
-                if '' in volumes:
-                    volumes.remove('')
+            logging.info(f'Fetching state of {service_id}...')
+            status_cache.start()
+            try:
+                docker_state = status_cache.status(service_id).upper()
+
+                return jsonify({
+                    'id': service_id,
+                    'state': docker_state,
+                    'errors': errors,
+                    'image': image,
+                    'tag': tag,
+                    'port': port,
+                    'lock': lock_state(service_id)
+                }), 200
+            except NotFound:
+                return jsonify({'id': service_id, 'state': 'BUILD FAILED', 'errors': errors,
+                                'lock': lock_state(service_id)}), 200
+    # service does not exist
+    else:
+        logging.warning(f'Service {service_id} not found.')
+        return f'{service_id} not found', 404
 
-                start_update(service_id, {}, volumes)
 
-                return f'service "{service_id}" patched and restarted', 200
-            else:
-                with open(f'services/{service_id}/error.txt') as f:
-                    errors = f.read()
+def log_events(service_id: str, deploy_id: str, follow: bool):
+    """
+    Generate the Server-Sent Events of a deployment log
 
-                logging.info(f'Fetching state of {service_id}...')
-                try:
-                    docker_client = docker.from_env()
-                    container = docker_client.containers.get(service_id)
-
-                    docker_state = container.status.upper()
-
-                    return jsonify({
-                        'id': service_id,
-                        'state': docker_state,
-                        'errors': errors,
-                        'image': image,
-                        'tag': tag,
-                        'port': port
-                    }), 200
-                except NotFound:
-                    return jsonify({'id': service_id, 'state': 'BUILD FAILED', 'errors': errors}), 200
-        # service does not exist
-        else:
-            logging.warning(f'Service {service_id} not found.')
-            return f'{service_id} not found', 404
+    :param service_id: id of the service
+    :param deploy_id: id of the deployment, the latest one if None
+    :param follow: wait for the lines of a running or queued deployment
+    :return: generator of "deploy", "log" and "end" events
+    """
+    deploys = list_deploys(service_id)
+    current = deploy_id or (deploys[-1] if deploys else None)
+
+    # a queued update starts a new deployment
+    while follow and not deploy_id and not (current and is_running(service_id, current)) and \
+            database.query_one('SELECT 1 FROM jobs WHERE service_id = ? AND state IN ("QUEUED", "RUNNING")',
+                               (service_id,)):
+        if (deploys := list_deploys(service_id)) and deploys[-1] != current:
+            current = deploys[-1]
+            break
+
+        time.sleep(follow_interval)
+
+    if current:
+        yield f'event: deploy\ndata: {current}\n\n'
+
+        for line in read_lines(service_id, current, follow):
+            yield f'event: log\ndata: {line}\n\n'
+
+    state = database.query_one('SELECT state FROM repos WHERE id = ?', (service_id,))
+    yield f'event: end\ndata: {state[0] if state else "DELETED"}\n\n'
+
+
+@app.route('/service/<string:service_id>/logs', methods=['GET'])
+def service_logs(service_id: str):
+    """
+    Endpoint to stream the log of a deployment as Server-Sent Events
+
+    :param service_id: id of the requested service
+    :return: event stream of the log lines, which ends with the state of the service
+    """
+    if not database.query_one('SELECT 1 FROM repos WHERE id = ?', (service_id,)):
+        logging.warning(f'Service {service_id} not found.')
+        return f'{service_id} not found', 404
+
+    deploy_id = request.args.get('deploy')
+
+    if deploy_id is not None and deploy_id not in list_deploys(service_id):
+        return f'deployment {deploy_id} not found', 404
+
+    follow = request.args.get('follow') in ['1', 'true']
+
+    return Response(stream_with_context(log_events(service_id, deploy_id, follow)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/service/<string:service_id>/disk', methods=['GET'])
+def disk_usage(service_id: str):
+    """
+    Endpoint to get the disk use of a service, measured by the last garbage collection
+
+    :param service_id: id of the requested service
+    :return: bytes used by the repository, the images and the writable layers of the containers
+    """
+    if not database.query_one('SELECT 1 FROM repos WHERE id = ?', (service_id,)):
+        logging.warning(f'Service {service_id} not found.')
+        return f'{service_id} not found', 404
+
+    usage = database.query_one('SELECT repository, images, containers, measured FROM disk_usage WHERE service_id = ?',
+                               (service_id,))
+
+    # not measured yet
+    if not usage:
+        return jsonify({'id': service_id, 'repository': None, 'images': None, 'containers': None, 'total': None,
+                        'measured': None}), 200
+
+    return jsonify({'id': service_id, **dict(usage), 'total': usage['repository'] + usage['images'] +
+                    usage['containers']}), 200
+
+
+@app.route('/service/<string:service_id>/prepull', methods=['POST'])
+def prepull(service_id: str):
+    """
+    Endpoint to pull an image tag of a "dockerfile" service in the background, before a PATCH switches to it
+
+    :param service_id: id of the requested service
+    :return: id of the pull job
+    """
+    if request.content_type != 'application/json':
+        logging.warning('Missing JSON payload')
+        return 'JSON payload expected', 400
+
+    if 'API-KEY' not in request.json or request.json['API-KEY'] not in keys:
+        logging.warning('Invalid API key provided or missing')
+        return 'valid API-KEY required', 400
+
+    if not (service := database.query_one('SELECT mode, image, tag, state FROM repos WHERE id = ?', (service_id,))):
+        logging.warning(f'Service {service_id} not found.')
+        return f'{service_id} not found', 404
+
+    mode, image, tag, state = service
+
+    if mode != 'dockerfile':
+        return 'only services in mode "dockerfile" pull images', 400
+
+    if state == 'DELETING':
+        return f'{service_id} is being deleted', 409
+
+    tag = request.json.get('tag') or tag
+    job_id = runner.submit('prepull', service_id, prepull_image, service_id, image, tag)
+
+    return jsonify({'id': service_id, 'job': job_id, 'image': image, 'tag': tag}), 202
+
+
+def list_services():
+    """
+    List registered services ordered by id.
+
+    The query parameters "state" and "mode" filter the services by their registration state and docker mode.
+    "expand=state" returns objects containing the container states instead of ids. If "limit" is given, the
+    response is paginated: the Link header references the next page, which starts after the id "cursor".
+
+    :return: list of service ids or service objects
+    """
+    conditions = ['id > ?']
+    params = [request.args.get('cursor', '')]
+
+    for column in ['state', 'mode']:
+        if column in request.args:
+            conditions.append(f'{column} = ?')
+            params.append(request.args[column])
+
+    query = f'SELECT id, mode, state FROM repos WHERE {" AND ".join(conditions)} ORDER BY id'
+
+    if limit := request.args.get('limit', type=int):
+        limit = max(1, min(limit, max_page_size))
+        # fetch one additional row to detect a further page
+        query += ' LIMIT ?'
+        params.append(limit + 1)
+
+    services = database.query(query, params)
+
+    next_cursor = None
+    if limit and len(services) > limit:
+        services = services[:limit]
+        next_cursor = services[-1][0]
+
+    if request.args.get('expand') == 'state':
+        status_cache.start()
+        states = status_cache.snapshot()
+
+        output = [{
+            'id': service_id,
+            'mode': mode,
+            'registration': registration,
+            'state': states[service_id].upper() if service_id in states else 'BUILD FAILED'
+        } for service_id, mode, registration in services]
+    else:
+        output = [service[0] for service in services]
+
+    response = jsonify(output)
+
+    if next_cursor is not None:
+        next_page = url_for('manage_services', **{**request.args.to_dict(), 'cursor': next_cursor})
+        response.headers['Link'] = f'<{next_page}>; rel="next"'
+
+    return response, 200
 
 
 @app.route('/service/', methods=['GET', 'POST'])
@@ -185,15 +623,11 @@ def manage_services():
     """
     Endpoint to get all services or register new ones
 
-    :return: GET - list of all service ids, POST - service id for a new service
+    :return: GET - list of service ids, POST - service id for a new service
     """
     if request.method == 'GET':
         logging.info('Requesting services...')
-        output = os.listdir('services')
-        output.remove('services.db')
-        output.remove('api-keys.json')
-        output.remove('.gitkeep')
-        return jsonify(sorted(output)), 200
+        return list_services()
     else:
         # backend requires JSON data
         if request.content_type != 'application/json':
@@ -206,62 +640,29 @@ def manage_services():
                 logging.warning('API key invalid or missing!')
                 return 'valid API-KEY required', 400
 
-            # load git clone URL and initialization mode
-            url = data['url'] if 'url' in data else ''
-            files = data['files'] if 'files' in data else {}
-            volumes = data['volumes'] if 'volumes' in data else []
-            mode = data['mode']
-            port = ''
-            image = ''
-            tag = ''
-
-            if '' in volumes:
-                volumes.remove('')
-
-            check_volumes(volumes)
-
-            # mode "docker" requires external port mapping
-            if mode in ['docker', 'dockerfile'] and not valid(mode):
-                logging.warning(f'Invalid configuration for mode {mode}')
-                return 'missing parameters', 400
-            elif mode in ['docker', 'dockerfile']:
-                image = data['image'] if mode == 'dockerfile' else ''
-                tag = data['tag'] if mode == 'dockerfile' else ''
-
-                with sqlite3.connect('services/services.db') as temp_db:
-                    temp_db.create_function('REGEXP', 2, regexp)
-
-                    try:
-                        # check port mapping format
-                        if check_ports(data['port'], temp_db.cursor()):
-                            port = data['port']
-                    except (InvalidPortMappingException, PortAlreadyUsedException) as e:
-                        logging.warning(e.message)
-                        return e.message, 400
-
-            # repository relative directory containing the Dockerfile or docker-compose.yml
-            docker_root = data['docker_root'] if 'docker_root' in data else '.'
-
-            # requested mode not supported
-            if mode not in modes:
-                logging.warning(f'Unsupported mode selected: {mode}')
-                return 'unsupported mode', 400
+            service, files, volumes = parse_registration(data)
 
             try:
-                # register new service
-                service_id = load_repository(url, mode, port, docker_root, image, tag, files)
+                priority_class = parse_priority(data.get('priority'))
+            except ValueError:
+                return 'unsupported priority', 400
 
-                # start new service
-                subprocess.Popen(['python', 'tasks/start_service.py', service_id, mode, docker_root, port, image, tag,
-                                  json.dumps(volumes)])
+            try:
+                scheduler.admit('start', '', priority_class)
+                files = store_files(files)
+
+                # reserve the id and the ports, the repository is cloned by the job starting the service
+                with database.transaction() as db:
+                    service_id = reserve_repository(db.cursor(), **service)
+                    job_id = runner.submit('start', service_id, launch_service, service_id, volumes, files,
+                                           priority_class=priority_class,
+                                           prepare=partial(initialize_repository, service_id, files))
+            except QueueFullException as e:
+                return queue_full(e)
             # service already existing
             except RepositoryAlreadyExistsException:
                 logging.error('service already exists!')
                 return 'Service already existing', 400
-            # Git clone failed
-            except GitCommandError as e:
-                logging.error('Cloning repository failed!')
-                return jsonify({'error': e.stderr}), 400
         # Missing arguments in JSON payload
         except KeyError as e:
             logging.error(f'Needed parameters not provided! {e}')
@@ -269,8 +670,339 @@ def manage_services():
         except InvalidVolumeMappingException as e:
             logging.error(f'Invalid volume mapping provided: {e}')
             return e.message, 400
+        except (InvalidRegistrationException, InvalidFilesException, InvalidPortMappingException,
+                PortAlreadyUsedException) as e:
+            logging.warning(e.message)
+            return e.message, 400
+
+        return jsonify({'id': service_id, 'state': 'CLONING', 'job': job_id}), 202
+
+
+def batch_items():
+    """
+    Validate the common parameters of a batch request
+
+    :raises InvalidRegistrationException: if the API key, the list of services or the priority class is invalid
+    :return: list of service specifications and priority class
+    """
+    if request.content_type != 'application/json':
+        raise InvalidRegistrationException('JSON payload expected')
+
+    if 'API-KEY' not in request.json or request.json['API-KEY'] not in keys:
+        logging.warning('Invalid API key provided or missing')
+        raise InvalidRegistrationException('valid API-KEY required')
+
+    if type(items := request.json.get('services')) is not list or not items or \
+            any(type(item) is not dict for item in items):
+        raise InvalidRegistrationException('list of services expected')
+
+    try:
+        return items, parse_priority(request.json.get('priority'))
+    except ValueError:
+        raise InvalidRegistrationException('unsupported priority')
+
+
+@app.route('/service/batch', methods=['POST'])
+def register_batch():
+    """
+    Endpoint to register several services at once. The port mappings of all services are validated and
+    allocated in a single transaction, either all services are registered or none. The repositories are
+    cloned by background jobs in parallel.
+
+    :return: ids and jobs of the registered services or the errors per list index
+    """
+    try:
+        items, priority_class = batch_items()
+    except InvalidRegistrationException as e:
+        return e.message, 400
+
+    specs, errors = [], []
+
+    for index, item in enumerate(items):
+        try:
+            specs.append(parse_registration(item))
+        except KeyError as e:
+            errors.append({'index': index, 'error': f'missing argument {e}'})
+        except (InvalidRegistrationException, InvalidFilesException, InvalidVolumeMappingException,
+                InvalidPortMappingException) as e:
+            errors.append({'index': index, 'error': e.message})
+
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    try:
+        scheduler.admit('start', '', priority_class, count=len(specs))
+    except QueueFullException as e:
+        return queue_full(e)
+
+    service_ids = []
+    spooled = [store_files(files) for _, files, _ in specs]
+
+    try:
+        with database.transaction() as db:
+            cursor = db.cursor()
+
+            # ports are checked against the registered services and the earlier services of the batch
+            for index, (service, _, _) in enumerate(specs):
+                try:
+                    service_ids.append(reserve_repository(cursor, **service))
+                except RepositoryAlreadyExistsException:
+                    errors.append({'index': index, 'error': 'Service already existing'})
+                except (InvalidPortMappingException, PortAlreadyUsedException) as e:
+                    errors.append({'index': index, 'error': e.message})
+
+            # rolls back the reservations
+            if errors:
+                raise InvalidRegistrationException('batch rejected')
+
+            # the reservations are committed together with the jobs cloning the repositories
+            job_ids = [runner.submit('start', service_id, launch_service, service_id, volumes, files,
+                                     priority_class=priority_class, prepare=partial(initialize_repository, service_id,
+                                                                                    files))
+                       for service_id, files, (_, _, volumes) in zip(service_ids, spooled, specs)]
+    except InvalidRegistrationException:
+        return jsonify({'errors': errors}), 400
+
+    services = [{'id': service_id, 'state': 'CLONING', 'job': job_id}
+                for service_id, job_id in zip(service_ids, job_ids)]
+
+    logging.info(f'Registered {len(services)} services')
+
+    return jsonify({'services': services}), 202
+
+
+@app.route('/service/batch/update', methods=['POST'])
+def update_batch():
+    """
+    Endpoint to update several services at once
+
+    :return: ids and jobs of the updated services and ids of the services rejected by a full queue
+    """
+    try:
+        items, priority_class = batch_items()
+    except InvalidRegistrationException as e:
+        return e.message, 400
+
+    updates, errors = [], []
+
+    for index, item in enumerate(items):
+        service_id = item.get('id')
+        service = database.query_one('SELECT state FROM repos WHERE id = ?', (service_id,))
+
+        try:
+            files = parse_files(item)
+            volumes = parse_volumes(item)
+        except (InvalidFilesException, InvalidVolumeMappingException) as e:
+            errors.append({'index': index, 'error': e.message})
+            continue
+
+        # the same conflicts as of single updates
+        if not service:
+            errors.append({'index': index, 'error': f'{service_id} not found'})
+        elif service[0] == 'DELETING':
+            errors.append({'index': index, 'error': f'{service_id} is being deleted'})
+        elif service[0] == 'CLONING':
+            errors.append({'index': index, 'error': f'{service_id} is being cloned'})
+        else:
+            updates.append((service_id, files, volumes))
+
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    queued, rejected = [], []
+
+    for service_id, files, volumes in updates:
+        try:
+            job_id = start_update(service_id, files, volumes, priority_class=priority_class)
+        except QueueFullException as e:
+            logging.warning(f'{service_id}: {e.message}')
+            rejected.append(service_id)
+            continue
+
+        queued.append({'id': service_id, 'job': job_id})
+
+    response = jsonify({'services': queued, 'rejected': rejected})
+
+    if rejected and not queued:
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+
+    return response, 202
+
+
+@app.route('/webhook/github', methods=['POST'])
+def github_webhook():
+    """
+    Endpoint for GitHub push events, which updates all services deployed from the pushed branch
+
+    :return: ids and jobs of the updated services and ids of the skipped services, which already deployed the
+             commit or failed to, are registered but not deployed yet or are being deleted
+    """
+    if not webhook_secret:
+        logging.warning('Webhook received, but WEBHOOK_SECRET is not configured')
+        return 'webhooks disabled', 403
+
+    signature = 'sha256=' + hmac.new(webhook_secret.encode(), request.get_data(), sha256).hexdigest()
+
+    if not hmac.compare_digest(signature, request.headers.get('X-Hub-Signature-256', '')):
+        logging.warning('Webhook with invalid signature received')
+        return 'invalid signature', 401
+
+    event = request.headers.get('X-GitHub-Event')
+    payload = request.get_json(silent=True) or {}
+
+    # branch deletions and tags don't change any deployment
+    if event != 'push' or payload.get('deleted') or not payload.get('ref', '').startswith('refs/heads/'):
+        return jsonify({'event': event, 'queued': [], 'skipped': [], 'rejected': []}), 200
+
+    repository = payload.get('repository', {})
+    url_keys = list({normalize_url(repository[key]) for key in ['clone_url', 'ssh_url', 'git_url', 'html_url']
+                     if repository.get(key)})
+    branch = payload['ref'][len('refs/heads/'):]
+    # services registered without a branch deploy the default branch of the remote
+    branches = [branch, ''] if branch == repository.get('default_branch') else [branch]
+
+    services = database.query(f'SELECT id, commit_sha, failed_sha, state, payload FROM repos WHERE branch IN '
+                              f'({", ".join("?" * len(branches))}) AND url_key IN ({", ".join("?" * len(url_keys))})',
+                              [*branches, *url_keys])
+
+    queued, skipped, rejected = [], [], []
+
+    for service_id, commit_sha, failed_sha, state, deployed in services:
+        # the first deployment of a service stores its files and volumes
+        if payload.get('after') in [commit_sha, failed_sha] or state in ['DELETING', 'CLONING', 'INITIALIZING']:
+            skipped.append(service_id)
+            continue
+
+        # the files and volumes of the latest deployment are kept
+        deployed = json.loads(deployed)
+
+        try:
+            job_id = start_update(service_id, deployed['files'], deployed['volumes'], spooled=True)
+        except QueueFullException as e:
+            logging.warning(f'{service_id}: {e.message}')
+            rejected.append(service_id)
+            continue
+
+        queued.append({'id': service_id, 'job': job_id})
+
+    logging.info(f'Push to {branch} of {repository.get("full_name")}: {len(queued)} updates queued')
+
+    response = jsonify({'event': event, 'queued': queued, 'skipped': skipped, 'rejected': rejected})
+
+    # redelivering the event retries the rejected updates
+    if rejected and not queued:
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+
+    return response, 202 if queued else 200
+
+
+@app.route('/ports/free', methods=['GET'])
+def free_ports():
+    """
+    Endpoint to get the ranges of unallocated external ports
+
+    :return: list of [first port, last port] pairs within the optional "start" and "end" query parameters
+    """
+    start = request.args.get('start', 1, type=int)
+    end = request.args.get('end', 65535, type=int)
+
+    return jsonify(free_port_ranges(database.connect().cursor(), start, end)), 200
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Endpoint to compare the recorded clone, fetch and build durations
+
+    :return: number, mean duration in seconds and mean transferred bytes per operation and variant
+    """
+    conditions = []
+    params = []
+
+    for column in ['operation', 'service_id']:
+        if column in request.args:
+            conditions.append(f'{column} = ?')
+            params.append(request.args[column])
+
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    return jsonify([dict(row) for row in database.query(
+        f'SELECT operation, detail, COUNT(*) AS count, AVG(duration) AS duration, AVG(bytes) AS bytes FROM stats '
+        f'{where} GROUP BY operation, detail ORDER BY operation, detail', params)]), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Endpoint to get request latencies, deployment phase durations and outcomes of all API workers
+
+    :return: metrics in the Prometheus text format
+    """
+    services = database.query('SELECT state, COUNT(*) FROM repos GROUP BY state')
+
+    gauges = {
+        'background_jobs': ('Background jobs of all API workers per state',
+                            {(('state', state),): count for state, count in runner.queue_depth().items()}),
+        'services': ('Registered services per state', {(('state', state),): count for state, count in services})
+    }
+
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4'), 200
+
+
+@app.route('/admin/limits', methods=['GET', 'PUT'])
+def admin_limits():
+    """
+    Endpoint to inspect and change the concurrency limits of all API workers
+
+    :return: GET - limits and running and waiting operations per resource, PUT - changed limits
+    """
+    if request.method == 'PUT':
+        if request.content_type != 'application/json':
+            return 'JSON payload expected', 400
+
+        if 'API-KEY' not in request.json or request.json['API-KEY'] not in keys:
+            logging.warning('Invalid API key provided or missing')
+            return 'valid API-KEY required', 400
+
+        if type(request.json.get('limits')) is not dict:
+            return 'limits expected', 400
+
+        try:
+            scheduler.set_limits(request.json['limits'])
+        except ValueError as e:
+            return str(e), 400
+
+        logging.info(f'Limits changed: {request.json["limits"]}')
+
+    queued = database.query_one('SELECT COUNT(*) FROM jobs WHERE kind IN ("start", "update") AND state = "QUEUED"')[0]
+
+    return jsonify({'limits': scheduler.limits(), 'usage': {**scheduler.usage(), 'queue': {'queued': queued}}}), 200
+
+
+@app.route('/job', methods=['GET'])
+def job_queue():
+    """
+    Endpoint to get the number of unfinished background jobs
+
+    :return: number of queued and running jobs of all API workers
+    """
+    return jsonify({**runner.queue_depth(), 'workers': runner.workers}), 200
+
+
+@app.route('/job/<string:job_id>', methods=['GET'])
+def job_state(job_id: str):
+    """
+    Endpoint to get the state of a background job
+
+    :param job_id: id of the requested job
+    :return: job information
+    """
+    if job := get_job(job_id):
+        return jsonify(job), 200
 
-        return jsonify({'id': service_id, 'state': 'CREATED'}), 200
+    return f'job {job_id} not found', 404
 
 
 if __name__ == '__main__':
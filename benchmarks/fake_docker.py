@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+
+from docker.errors import APIError, NotFound
+
+# seconds a fake image build or pull takes
+build_time = 0.01
+
+
+class FakeContainer:
+    """
+    Container of the fake Docker daemon
+    """
+    def __init__(self, daemon, name: str, image: str, ports: dict):
+        self.daemon = daemon
+        self.name = name
+        self.image = image
+        self.ports = {f'{internal}/tcp': [{'HostIp': '0.0.0.0', 'HostPort': str(external or 0)}]
+                      for internal, external in (ports or {}).items()}
+        self.status = 'running'
+        self.attrs = {}
+        self.reload()
+
+    def reload(self):
+        self.attrs = {'State': {'Status': self.status}}
+
+    def logs(self, tail=None):
+        return b''
+
+    def stop(self):
+        self.status = 'exited'
+        self.daemon.emit('die', self.name)
+
+    def start(self):
+        self.status = 'running'
+        self.daemon.emit('start', self.name)
+
+    def rename(self, name: str):
+        with self.daemon.lock:
+            self.daemon.containers.items[name] = self.daemon.containers.items.pop(self.name)
+        self.daemon.emit('rename', name, oldName=f'/{self.name}')
+        self.name = name
+
+    def remove(self, force=False):
+        with self.daemon.lock:
+            self.daemon.containers.items.pop(self.name, None)
+        self.daemon.emit('destroy', self.name)
+
+
+class FakeContainers:
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.items = {}
+
+    def get(self, name: str) -> FakeContainer:
+        with self.daemon.lock:
+            if name not in self.items:
+                raise NotFound(f'No such container: {name}')
+            return self.items[name]
+
+    def list(self, all=False) -> list[FakeContainer]:
+        with self.daemon.lock:
+            return [container for container in self.items.values() if all or container.status == 'running']
+
+    def run(self, image: str, name: str | None = None, ports: dict | None = None, **kwargs) -> FakeContainer:
+        with self.daemon.lock:
+            if name in self.items:
+                raise APIError(f'Conflict. The container name "/{name}" is already in use')
+
+            container = self.items[name] = FakeContainer(self.daemon, name, image, ports)
+
+        self.daemon.emit('create', name)
+        self.daemon.emit('start', name)
+
+        return container
+
+
+class FakeApi:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def build(self, fileobj=None, tag: str | None = None, decode=False, **kwargs):
+        # consume the build context like the daemon does
+        size = sum(len(chunk) for chunk in fileobj)
+        time.sleep(build_time)
+
+        yield {'stream': f'Sending build context of {size} bytes\n'}
+        yield {'stream': f'Successfully tagged {tag}:latest\n'}
+
+    def pull(self, repository: str, tag: str | None = None, stream=False, decode=False):
+        time.sleep(build_time)
+
+        yield {'status': f'Pulling from {repository}', 'id': tag}
+        yield {'status': f'Downloaded newer image for {repository}:{tag}'}
+
+
+class FakeDocker:
+    """
+    In-process replacement of the client returned by docker.from_env(), limited to the calls of the updater
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = FakeContainers(self)
+        self.api = FakeApi(self)
+        self._subscribers = []
+
+    def emit(self, action: str, name: str, **attributes):
+        event = {'Type': 'container', 'Action': action, 'Actor': {'Attributes': {'name': name, **attributes}}}
+
+        with self.lock:
+            for subscriber in self._subscribers:
+                subscriber.put(event)
+
+    def events(self, decode=False, filters=None):
+        subscriber = queue.Queue()
+
+        with self.lock:
+            self._subscribers.append(subscriber)
+
+        def _stream():
+            while True:
+                yield subscriber.get()
+
+        return _stream()
@@ -0,0 +1,318 @@
+import argparse
+import importlib
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from benchmarks.fake_docker import FakeDocker
+from service_config import config
+from tasks.scheduler import set_limits
+
+API_KEY = 'benchmark-key'
+
+# first external port allocated to the benchmarked services
+first_port = 20000
+
+# seconds between two checks of the background jobs
+job_poll_interval = 0.05
+
+# concurrency limits of the benchmarked API, independent of the environment. All services are registered at
+# once, so the queue is unlimited.
+limits = {'deploys': 0, 'builds': 2, 'pulls': 4, 'queue': 0}
+
+
+def _git(*args, cwd=None):
+    subprocess.run(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', *args], cwd=cwd,
+                   check=True, capture_output=True)
+
+
+def create_remotes(directory: str, count: int) -> tuple[str, list[str]]:
+    """
+    Create a bare repository containing a Dockerfile and one clone URL per service
+
+    All URLs point to the same bare repository, so a single push updates every service.
+
+    :param directory: directory of the repositories
+    :param count: number of services
+    :return: path of the working copy and list of clone URLs
+    """
+    work = os.path.join(directory, 'work')
+    bare = os.path.join(directory, 'origin.git')
+
+    _git('init', '-b', 'main', work)
+    with open(os.path.join(work, 'Dockerfile'), 'w') as f:
+        f.write('FROM nginx:alpine\nCOPY index.html /usr/share/nginx/html/\n')
+    with open(os.path.join(work, 'index.html'), 'w') as f:
+        f.write('<h1>version 1</h1>\n')
+    _git('add', '.', cwd=work)
+    _git('commit', '-m', 'version 1', cwd=work)
+    _git('clone', '--bare', work, bare)
+    _git('remote', 'add', 'origin', bare, cwd=work)
+
+    urls = []
+    for number in range(count):
+        # the service id is derived from the URL
+        link = os.path.join(directory, f'svc-{number:04d}.git')
+        os.symlink(bare, link)
+        urls.append(f'file://{link}')
+
+    return work, urls
+
+
+def push_commit(work: str, version: int):
+    """
+    Push a new commit to the bare repository
+
+    :param work: path of the working copy
+    :param version: content version
+    """
+    with open(os.path.join(work, 'index.html'), 'w') as f:
+        f.write(f'<h1>version {version}</h1>\n')
+    _git('commit', '-am', f'version {version}', cwd=work)
+    _git('push', 'origin', 'main', cwd=work)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile
+
+    :param values: measured values
+    :param fraction: percentile between 0 and 1
+    :return: percentile of the values, 0 without values
+    """
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Benchmark:
+    """
+    Drives the Flask app through registration, GET, PATCH, update and delete with concurrent clients
+    """
+    def __init__(self, app_module, clients: int):
+        self.app_module = app_module
+        self.clients = clients
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app_module.app.test_client()
+        return self._local.client
+
+    def phase(self, requests: list[tuple]) -> tuple[dict, list]:
+        """
+        Send requests concurrently and measure their latency
+
+        :param requests: list of (HTTP method, path, JSON payload, expected status) tuples
+        :raises RuntimeError: if a response has an unexpected status
+        :return: statistics of the phase and the JSON responses
+        """
+        def _send(method, path, payload, expected):
+            start = time.perf_counter()
+            response = self._client().open(path, method=method, json=payload)
+            latency = time.perf_counter() - start
+
+            if response.status_code != expected:
+                raise RuntimeError(f'{method} {path}: {response.status_code} {response.get_data(as_text=True)}')
+
+            return latency, response.get_json(silent=True)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.clients) as executor:
+            results = list(executor.map(lambda request: _send(*request), requests))
+        duration = time.perf_counter() - start
+
+        latencies = [latency for latency, _ in results]
+
+        return {
+            'requests': len(requests),
+            'requests_per_second': round(len(requests) / duration, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+        }, [body for _, body in results]
+
+    def deploys(self, job_ids: list[str]) -> dict:
+        """
+        Wait for background jobs and measure the time from request to finished deployment or deletion
+
+        :param job_ids: ids of the jobs
+        :raises RuntimeError: if a job failed
+        :return: statistics of the deployments
+        """
+        pending, durations = set(job_ids), []
+
+        while pending:
+            for job_id in list(pending):
+                job = self.app_module.get_job(job_id)
+
+                if job['state'] == 'FAILED':
+                    raise RuntimeError(f'job {job_id} of {job["service_id"]} failed: {job["error"]}')
+                if job['state'] == 'DONE':
+                    pending.remove(job_id)
+                    durations.append(job['finished'] - job['created'])
+
+            time.sleep(job_poll_interval)
+
+        return {
+            'deploys': len(durations),
+            'p50_s': round(percentile(durations, 0.5), 3),
+            'p99_s': round(percentile(durations, 0.99), 3)
+        }
+
+
+def run(services: int, clients: int) -> dict:
+    """
+    Benchmark the API in a temporary directory against local git remotes and a fake Docker daemon
+
+    :param services: number of registered services
+    :param clients: number of concurrent clients
+    :return: statistics per phase and deployment kind
+    """
+    cwd = os.getcwd()
+    from_env = docker.from_env
+    fake = FakeDocker()
+    # the background threads of the app would outlive the benchmark directory
+    background = config.poll_workers, config.gc_interval
+
+    with tempfile.TemporaryDirectory() as directory:
+        work, urls = create_remotes(os.path.join(directory, 'remotes'), services)
+
+        os.chdir(directory)
+        docker.from_env = lambda: fake
+        config.poll_workers, config.gc_interval = 0, 0
+        try:
+            os.mkdir('services')
+            with open(os.path.join('services', 'api-keys.json'), 'w') as f:
+                json.dump([API_KEY], f)
+
+            sys.modules.pop('app', None)
+            app_module = importlib.import_module('app')
+            # measure the deployments, not the debounce window
+            app_module.runner.debounce = 0
+            set_limits(limits)
+
+            return _run_phases(Benchmark(app_module, clients), work, urls)
+        finally:
+            docker.from_env = from_env
+            config.poll_workers, config.gc_interval = background
+            os.chdir(cwd)
+
+
+def _run_phases(benchmark: Benchmark, work: str, urls: list[str]) -> dict:
+    phases, deploys = {}, {}
+    key = {'API-KEY': API_KEY}
+
+    phases['register'], responses = benchmark.phase([
+        ('POST', '/service', {**key, 'url': url, 'mode': 'docker', 'port': f'{first_port + number}:80'}, 202)
+        for number, url in enumerate(urls)])
+    service_ids = [response['id'] for response in responses]
+    deploys['start'] = benchmark.deploys([response['job'] for response in responses])
+
+    phases['get'], _ = benchmark.phase([('GET', f'/service/{service_id}', None, 200)
+                                        for service_id in service_ids * 5])
+    phases['list'], _ = benchmark.phase([('GET', '/service?expand=state&limit=100', None, 200)] * 50)
+
+    phases['patch'], responses = benchmark.phase([
+        ('PATCH', f'/service/{service_id}', {**key, 'port': f'{first_port + len(urls) + number}:80'}, 200)
+        for number, service_id in enumerate(service_ids)])
+    deploys['patch'] = benchmark.deploys([response['job'] for response in responses])
+
+    push_commit(work, 2)
+    phases['update'], responses = benchmark.phase([('POST', f'/service/{service_id}', key, 200)
+                                                   for service_id in service_ids])
+    deploys['update'] = benchmark.deploys([response['job'] for response in responses])
+
+    phases['delete'], responses = benchmark.phase([('DELETE', f'/service/{service_id}', key, 202)
+                                                   for service_id in service_ids])
+    deploys['delete'] = benchmark.deploys([response['job'] for response in responses])
+
+    return {'phases': phases, 'deploys': deploys}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare the median latencies and deploy durations with a stored baseline. Throughput and p99 latencies of a
+    few hundred requests depend on single slow requests, so they vary too much between runs.
+
+    :param results: results of run()
+    :param baseline: stored results
+    :param tolerance: accepted relative slowdown (e.g. 1.0 for twice the duration)
+    :return: descriptions of all regressions
+    """
+    regressions = []
+
+    for phase, stats in baseline.get('phases', {}).items():
+        current = results['phases'][phase]
+
+        if current['p50_ms'] > stats['p50_ms'] * (1 + tolerance):
+            regressions.append(f'{phase}: p50 {current["p50_ms"]} ms, baseline {stats["p50_ms"]}')
+
+    for kind, stats in baseline.get('deploys', {}).items():
+        current = results['deploys'][kind]
+
+        if current['p50_s'] > stats['p50_s'] * (1 + tolerance):
+            regressions.append(f'{kind} deploys: p50 {current["p50_s"]} s, baseline {stats["p50_s"]}')
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the microservice updater API offline')
+    parser.add_argument('--services', type=int, default=200, help='number of registered services')
+    parser.add_argument('--clients', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(__file__), 'baseline.json'),
+                        help='stored results to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='accepted relative slowdown')
+    parser.add_argument('--output', help='file to store the results in')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as new baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.services, args.clients)
+    results['config'] = {'services': args.services, 'clients': args.clients}
+
+    print(f'{"phase":<10}{"requests":>10}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for phase, stats in results['phases'].items():
+        print(f'{phase:<10}{stats["requests"]:>10}{stats["requests_per_second"]:>10}{stats["p50_ms"]:>10}'
+              f'{stats["p99_ms"]:>10}')
+    print(f'\n{"deploy":<10}{"count":>10}{"p50 s":>10}{"p99 s":>10}')
+    for kind, stats in results['deploys'].items():
+        print(f'{kind:<10}{stats["deploys"]:>10}{stats["p50_s"]:>10}{stats["p99_s"]:>10}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline.get('config') != results['config']:
+        print(f'\nbaseline was recorded with {baseline.get("config")}, skipping comparison')
+        return 0
+
+    if regressions := compare(results, baseline, args.tolerance):
+        print('\nregressions:\n' + '\n'.join(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
+import os
 import re
-from sqlite3 import Cursor
+from sqlite3 import Cursor, IntegrityError
 
 
 class PortAlreadyUsedException(Exception):
@@ -18,22 +19,215 @@ modes = [
     'dockerfile'
 ]
 
+# number of background tasks each API worker executes in parallel
+max_workers = int(os.environ.get('MAX_WORKERS', '4'))
 
-def regexp(expr, item):
-    reg = re.compile(expr)
-    return re.match(reg, item) is not None
+# number of repositories of new services each API worker clones in parallel, besides the background tasks
+clone_workers = int(os.environ.get('CLONE_WORKERS', '8'))
 
+# seconds an update waits for further update requests of the same service before it starts
+update_debounce = float(os.environ.get('UPDATE_DEBOUNCE', '5'))
+
+# maximum number of services per page of the service listing
+max_page_size = 1000
+
+clone_strategies = [
+    'full',
+    'shallow',
+    'single-branch',
+    'blobless'
+]
+
+# clone strategy of services registered without "clone_strategy"
+default_clone_strategy = os.environ.get('CLONE_STRATEGY', 'full')
+
+# number of commits fetched by the "shallow" clone strategy
+clone_depth = int(os.environ.get('CLONE_DEPTH', '1'))
+
+update_strategies = [
+    'recreate',
+    'blue-green'
+]
+
+# update strategy of services registered without "update_strategy"
+default_update_strategy = os.environ.get('UPDATE_STRATEGY', 'recreate')
+
+# share the objects of services cloned from the same remote in a bare mirror
+shared_mirrors = os.environ.get('SHARED_MIRRORS', 'true').lower() == 'true'
+
+# number of submodules fetched in parallel when a repository is cloned
+submodule_jobs = int(os.environ.get('SUBMODULE_JOBS', '4'))
+
+# number of docker-compose services built in parallel
+compose_build_workers = int(os.environ.get('COMPOSE_BUILD_WORKERS', '4'))
+
+# seconds a blue-green deployment waits for a new container to become ready
+readiness_timeout = float(os.environ.get('READINESS_TIMEOUT', '60'))
+
+# host of the published container ports probed by blue-green deployments
+readiness_host = os.environ.get('READINESS_HOST', '127.0.0.1')
+
+# number of deployment logs kept per service
+log_retention = int(os.environ.get('LOG_RETENTION', '10'))
+
+# maximum size of a single deployment log in bytes
+max_log_size = int(os.environ.get('MAX_LOG_SIZE', str(1024 * 1024)))
+
+# seconds between two transfers of the metrics of an API worker into the database
+metrics_flush_interval = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+# secret of the GitHub webhooks, the webhook endpoint is disabled without secret
+webhook_secret = os.environ.get('WEBHOOK_SECRET', '')
+
+# seconds between two polls of the remote of services registered without "poll_interval", 0 disables polling
+default_poll_interval = float(os.environ.get('POLL_INTERVAL', '0'))
+
+# number of remotes polled in parallel, 0 disables the poller
+poll_workers = int(os.environ.get('POLL_WORKERS', '4'))
+
+# maximum seconds between two polls of a failing remote
+max_poll_backoff = float(os.environ.get('MAX_POLL_BACKOFF', '3600'))
+
+# seconds between two runs of the image and build cache garbage collector, 0 disables it
+gc_interval = float(os.environ.get('GC_INTERVAL', '3600'))
+
+# seconds unused images, dangling images and build cache are kept
+image_retention = float(os.environ.get('IMAGE_RETENTION', str(24 * 3600)))
+
+priority_classes = [
+    'high',
+    'normal',
+    'low'
+]
+
+# concurrency limits of all API workers together, 0 means unlimited. They can be changed at runtime via
+# /admin/limits. "deploys" limits the running deployments, "deploys:<mode>" those of a single mode, "builds"
+# and "pulls" the image builds and pulls and "queue" the queued deployments before requests are rejected.
+default_limits = {
+    'deploys': int(os.environ.get('MAX_DEPLOYS', '0')),
+    **{f'deploys:{mode}': int(os.environ.get(f'MAX_DEPLOYS_{mode.upper().replace("-", "_")}', '0')) for mode in modes},
+    'builds': int(os.environ.get('MAX_BUILDS', '2')),
+    'pulls': int(os.environ.get('MAX_PULLS', '4')),
+    'queue': int(os.environ.get('MAX_QUEUED_DEPLOYS', '100'))
+}
+
+# seconds clients should wait before retrying a rejected deployment request
+retry_after = int(os.environ.get('RETRY_AFTER', '30'))
+
+
+def parse_ports(ports: str) -> list[tuple[int, int]]:
+    """
+    Parse a port mapping string like "8080:80,8443:443"
+
+    :param ports: comma separated list of external:internal port pairs
+    :raises InvalidPortMappingException
+    :raises PortAlreadyUsedException: if an external port is mapped twice
+    :return: list of (external port, internal port) pairs
+    """
+    mappings = []
 
-def check_ports(ports: str, cursor: Cursor):
     for port in ports.split(','):
         if not re.match(r'^\d+:\d+$', port):
             raise InvalidPortMappingException()
 
-        external = port.split(':')[0]
-        cursor.execute("select port from repos WHERE port REGEXP ?", (f'.*{external}:.*',))
-        existing_mappings = cursor.fetchall()
+        external, internal = (int(p) for p in port.split(':'))
 
-        if len(existing_mappings):
+        if not 0 < external < 65536 or not 0 < internal < 65536:
+            raise InvalidPortMappingException()
+        if external in [mapping[0] for mapping in mappings]:
+            raise PortAlreadyUsedException(external)
+
+        mappings.append((external, internal))
+
+    return mappings
+
+
+def normalize_url(url: str) -> str:
+    """
+    Reduce a Git clone URL to host and path, so HTTPS, SSH and web URLs of a repository are equal
+
+    :param url: clone URL (e.g. "git@github.com:owner/repo.git" or "https://github.com/owner/repo")
+    :return: lower case "host/path" without credentials, port, ".git" suffix and trailing slashes
+    """
+    url = url.strip().lower()
+
+    # scp-like SSH syntax "user@host:path"
+    if (match := re.match(r'^(?:[^@/]+@)?([^:/]+):(?!\d*/)(.*)$', url)) and '://' not in url:
+        host, path = match.groups()
+    else:
+        host, _, path = re.sub(r'^[a-z+]+://', '', url).partition('/')
+        host = host.rpartition('@')[2].partition(':')[0]
+
+    path = path.strip('/')
+    path = path.removesuffix('.git')
+
+    return f'{host}/{path.strip("/")}'
+
+
+def check_ports(ports: str, cursor: Cursor, service_id: str | None = None):
+    """
+    Check that a port mapping is valid and its external ports are free
+
+    :param ports: comma separated list of external:internal port pairs
+    :param cursor: cursor of the service database
+    :param service_id: service whose own mappings don't count as conflicts
+    :raises InvalidPortMappingException
+    :raises PortAlreadyUsedException
+    :return: True
+    """
+    for external, _ in parse_ports(ports):
+        cursor.execute('SELECT service_id FROM port_mappings WHERE external_port = ?', (external,))
+
+        if (owner := cursor.fetchone()) and owner[0] != service_id:
             raise PortAlreadyUsedException(external)
 
     return True
+
+
+def store_ports(ports: str, service_id: str, cursor: Cursor):
+    """
+    Replace the port allocations of a service. The caller commits the transaction.
+
+    :param ports: comma separated list of external:internal port pairs or an empty string
+    :param service_id: id of the service
+    :param cursor: cursor of the service database
+    :raises InvalidPortMappingException
+    :raises PortAlreadyUsedException
+    """
+    mappings = parse_ports(ports) if ports else []
+
+    cursor.execute('DELETE FROM port_mappings WHERE service_id = ?', (service_id,))
+
+    for external, internal in mappings:
+        try:
+            cursor.execute('INSERT INTO port_mappings VALUES (?, ?, ?)', (service_id, external, internal))
+        # port allocated concurrently by another service
+        except IntegrityError:
+            raise PortAlreadyUsedException(external)
+
+
+def free_port_ranges(cursor: Cursor, start: int = 1, end: int = 65535) -> list[tuple[int, int]]:
+    """
+    List the ranges of unallocated external ports
+
+    :param cursor: cursor of the service database
+    :param start: first port of the searched range
+    :param end: last port of the searched range
+    :return: list of (first port, last port) pairs
+    """
+    cursor.execute('SELECT external_port FROM port_mappings WHERE external_port BETWEEN ? AND ? '
+                   'ORDER BY external_port', (start, end))
+
+    ranges = []
+    first = start
+
+    for (used,) in cursor.fetchall():
+        if used > first:
+            ranges.append((first, used - 1))
+        first = used + 1
+
+    if first <= end:
+        ranges.append((first, end))
+
+    return ranges
+
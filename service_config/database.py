@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+
+from service_config.config import (
+    InvalidPortMappingException,
+    PortAlreadyUsedException,
+    normalize_url,
+    parse_ports,
+)
+
+db_path = os.path.join('services', 'services.db')
+
+# seconds a statement waits for locks held by other connections
+busy_timeout = float(os.environ.get('DB_BUSY_TIMEOUT', '30'))
+
+_local = threading.local()
+
+
+def connect(path: str | None = None) -> sqlite3.Connection:
+    """
+    Get the connection of the current thread to the service database.
+
+    Connections are reused per thread, so their prepared statement cache stays warm. They run in autocommit
+    mode: every statement outside of transaction() is committed immediately.
+
+    :param path: path of the SQLite database, defaults to services/services.db
+    :return: SQLite connection
+    """
+    path = os.path.abspath(path or db_path)
+
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+
+    if (db := _local.connections.get(path)) is None:
+        db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, cached_statements=256)
+        db.row_factory = sqlite3.Row
+        # readers don't block the writer and vice versa
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        _local.connections[path] = db
+
+    return db
+
+
+@contextmanager
+def transaction(path: str | None = None):
+    """
+    Execute statements in a write transaction, which is committed on success and rolled back on errors.
+
+    The write lock is acquired at the beginning, so keep the transaction short. Nested calls join the
+    outer transaction.
+
+    :param path: path of the SQLite database
+    :return: SQLite connection
+    """
+    db = connect(path)
+
+    if db.in_transaction:
+        yield db
+        return
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+
+def query(sql: str, params=(), path: str | None = None) -> list[sqlite3.Row]:
+    """
+    Fetch all rows of a query
+
+    :param sql: SQL statement with ? placeholders
+    :param params: values of the placeholders
+    :param path: path of the SQLite database
+    :return: list of rows
+    """
+    return connect(path).execute(sql, params).fetchall()
+
+
+def query_one(sql: str, params=(), path: str | None = None):
+    """
+    Fetch the first row of a query
+
+    :param sql: SQL statement with ? placeholders
+    :param params: values of the placeholders
+    :param path: path of the SQLite database
+    :return: row or None, if the query has no result
+    """
+    return connect(path).execute(sql, params).fetchone()
+
+
+def execute(sql: str, params=(), path: str | None = None) -> int:
+    """
+    Execute a single statement in its own short transaction
+
+    :param sql: SQL statement with ? placeholders
+    :param params: values of the placeholders
+    :param path: path of the SQLite database
+    :return: number of modified rows
+    """
+    return connect(path).execute(sql, params).rowcount
+
+
+def set_state(service_id: str, state: str, path: str | None = None):
+    """
+    Store the state of a service
+
+    :param service_id: id of the service
+    :param state: new state (e.g. "RUNNING")
+    :param path: path of the SQLite database
+    """
+    execute('UPDATE repos SET state = ? WHERE id = ?', (state, service_id), path)
+
+
+def record_image(service_id: str, reference: str, path: str | None = None):
+    """
+    Remember an image built or pulled for a service, so the garbage collector can remove it once it is unused
+
+    :param service_id: id of the service
+    :param reference: image name and tag
+    :param path: path of the SQLite database
+    """
+    execute('INSERT INTO images (reference, service_id, used) VALUES (?, ?, ?) ON CONFLICT (reference) DO UPDATE '
+            'SET service_id = excluded.service_id, used = excluded.used', (reference, service_id, time.time()), path)
+
+
+def record_stat(service_id: str, operation: str, detail: str, duration: float, size: int | None = None,
+                path: str | None = None):
+    """
+    Record the duration of a clone, fetch or build
+
+    :param service_id: id of the service
+    :param operation: recorded operation (e.g. "clone")
+    :param detail: variant of the operation (e.g. the clone strategy)
+    :param duration: duration in seconds
+    :param size: transferred bytes
+    :param path: path of the SQLite database
+    """
+    execute('INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?)',
+            (service_id, operation, detail, duration, size, time.time()), path)
+
+
+def _initial_schema(db: sqlite3.Connection):
+    db.execute('CREATE TABLE IF NOT EXISTS repos(id TEXT PRIMARY KEY, url TEXT, mode TEXT, state TEXT, port TEXT,'
+               'docker_root TEXT, image TEXT, tag TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS jobs(id TEXT PRIMARY KEY, service_id TEXT, kind TEXT, state TEXT,'
+               'created REAL, started REAL, finished REAL, error TEXT, pid INTEGER, payload TEXT, not_before REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_service_state ON jobs(service_id, state)')
+    db.execute('CREATE TABLE IF NOT EXISTS port_mappings(service_id TEXT, external_port INTEGER PRIMARY KEY,'
+               'internal_port INTEGER)')
+    db.execute('CREATE INDEX IF NOT EXISTS port_mappings_service ON port_mappings(service_id)')
+
+    # allocate ports of services registered before the port_mappings table existed
+    for registered_id, registered_port in db.execute('SELECT id, port FROM repos WHERE port != "" AND id NOT IN '
+                                                     '(SELECT service_id FROM port_mappings)').fetchall():
+        # the former format check accepted e.g. port 0 or an external port mapped twice
+        try:
+            mappings = parse_ports(registered_port)
+        except (InvalidPortMappingException, PortAlreadyUsedException) as e:
+            logging.warning(f'Ports of {registered_id} not allocated: {e.message}')
+            continue
+
+        for external_port, internal_port in mappings:
+            db.execute('INSERT OR IGNORE INTO port_mappings VALUES (?, ?, ?)',
+                       (registered_id, external_port, internal_port))
+
+
+def _clone_strategies(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN clone_strategy TEXT NOT NULL DEFAULT "full"')
+    db.execute('ALTER TABLE repos ADD COLUMN branch TEXT NOT NULL DEFAULT ""')
+    db.execute('CREATE TABLE stats(service_id TEXT, operation TEXT, detail TEXT, duration REAL, bytes INTEGER,'
+               'created REAL)')
+    db.execute('CREATE INDEX stats_operation ON stats(operation, detail)')
+
+
+def _deploy_fingerprints(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN fingerprint TEXT NOT NULL DEFAULT ""')
+    db.execute('ALTER TABLE repos ADD COLUMN commit_sha TEXT NOT NULL DEFAULT ""')
+    db.execute('ALTER TABLE jobs ADD COLUMN result TEXT')
+
+
+def _update_strategies(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN update_strategy TEXT NOT NULL DEFAULT "recreate"')
+
+
+def _metrics(db: sqlite3.Connection):
+    db.execute('CREATE TABLE metrics(family TEXT, suffix TEXT, labels TEXT, value REAL, '
+               'PRIMARY KEY (family, suffix, labels))')
+
+
+def _webhooks(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN url_key TEXT NOT NULL DEFAULT ""')
+    db.execute('ALTER TABLE repos ADD COLUMN payload TEXT NOT NULL DEFAULT \'{"files": {}, "volumes": []}\'')
+    db.execute('CREATE INDEX repos_url_branch ON repos(url_key, branch)')
+
+    for registered_id, url in db.execute('SELECT id, url FROM repos WHERE url != ""').fetchall():
+        db.execute('UPDATE repos SET url_key = ? WHERE id = ?', (normalize_url(url), registered_id))
+
+
+def _polling(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN poll_interval REAL NOT NULL DEFAULT 0')
+    db.execute('CREATE TABLE remotes(url_key TEXT PRIMARY KEY, polled REAL, failures INTEGER, retry_at REAL)')
+    db.execute('CREATE TABLE leases(name TEXT PRIMARY KEY, holder TEXT, expires REAL)')
+
+
+def _spool(db: sqlite3.Connection):
+    db.execute('CREATE TABLE custom_files(service_id TEXT, path TEXT, digest TEXT, size INTEGER, mtime_ns INTEGER, '
+               'PRIMARY KEY (service_id, path))')
+
+    # custom files are spooled next to the database and referenced by their digest
+    spool = os.path.join(os.path.dirname(db.execute('PRAGMA database_list').fetchone()[2]), '.spool')
+
+    for registered_id, payload in db.execute('SELECT id, payload FROM repos').fetchall():
+        payload = json.loads(payload)
+
+        if payload['files']:
+            os.makedirs(spool, exist_ok=True)
+
+        for file, content in payload['files'].items():
+            data = content.encode()
+            payload['files'][file] = digest = sha256(data).hexdigest()
+
+            with open(os.path.join(spool, digest), 'wb') as f:
+                f.write(data)
+
+        db.execute('UPDATE repos SET payload = ? WHERE id = ?', (json.dumps(payload), registered_id))
+
+
+def _compose_builds(db: sqlite3.Connection):
+    db.execute('CREATE TABLE compose_builds(service_id TEXT, name TEXT, hash TEXT, PRIMARY KEY (service_id, name))')
+
+
+def _image_gc(db: sqlite3.Connection):
+    db.execute('CREATE TABLE images(reference TEXT PRIMARY KEY, service_id TEXT, used REAL)')
+    db.execute('CREATE TABLE disk_usage(service_id TEXT PRIMARY KEY, repository INTEGER, images INTEGER, '
+               'containers INTEGER, measured REAL)')
+
+
+def _service_locks(db: sqlite3.Connection):
+    db.execute('CREATE TABLE locks(ticket INTEGER PRIMARY KEY AUTOINCREMENT, service_id TEXT, holder TEXT, '
+               'pid INTEGER, requested REAL, acquired REAL)')
+    db.execute('CREATE INDEX locks_service ON locks(service_id, ticket)')
+    db.execute('ALTER TABLE jobs ADD COLUMN ticket INTEGER')
+
+
+def _admission_control(db: sqlite3.Connection):
+    db.execute('CREATE TABLE limits(name TEXT PRIMARY KEY, value INTEGER)')
+    db.execute('CREATE TABLE slots(ticket INTEGER PRIMARY KEY AUTOINCREMENT, resource TEXT, priority INTEGER, '
+               'holder TEXT, pid INTEGER, requested REAL, acquired REAL)')
+    db.execute('CREATE INDEX slots_resource ON slots(resource, priority, ticket)')
+    db.execute('ALTER TABLE jobs ADD COLUMN priority TEXT NOT NULL DEFAULT "normal"')
+
+
+def _mirrors(db: sqlite3.Connection):
+    db.execute('CREATE TABLE mirrors(url_key TEXT PRIMARY KEY, fetched REAL)')
+    db.execute('ALTER TABLE repos ADD COLUMN mirror TEXT NOT NULL DEFAULT ""')
+    db.execute('ALTER TABLE jobs ADD COLUMN requested REAL')
+
+
+def _process_starts(db: sqlite3.Connection):
+    # rows of earlier versions belong to processes started before the upgrade, their start time doesn't match
+    for table in ['locks', 'slots', 'jobs']:
+        db.execute(f'ALTER TABLE {table} ADD COLUMN pid_start INTEGER NOT NULL DEFAULT -1')
+
+
+def _failed_deployments(db: sqlite3.Connection):
+    db.execute('ALTER TABLE repos ADD COLUMN failed_sha TEXT NOT NULL DEFAULT ""')
+    # failed updates stored their commit without fingerprint
+    db.execute('UPDATE repos SET failed_sha = commit_sha, commit_sha = "" WHERE fingerprint = "" AND commit_sha != ""')
+
+
+# schema migrations, the database's user_version is the number of applied migrations
+migrations = [
+    _initial_schema,
+    _clone_strategies,
+    _deploy_fingerprints,
+    _update_strategies,
+    _metrics,
+    _webhooks,
+    _polling,
+    _spool,
+    _compose_builds,
+    _image_gc,
+    _service_locks,
+    _admission_control,
+    _mirrors,
+    _process_starts,
+    _failed_deployments
+]
+
+
+def migrate(path: str | None = None):
+    """
+    Apply all pending schema migrations. Concurrent API workers wait for the first one to finish.
+
+    :param path: path of the SQLite database
+    """
+    with transaction(path) as db:
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            migration(db)
+            db.execute(f'PRAGMA user_version = {number}')
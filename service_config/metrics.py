@@ -0,0 +1,191 @@
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from service_config import database
+
+# upper bounds of the histogram buckets in seconds
+request_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+phase_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# exposed metric families: (type, description, histogram buckets)
+families = {
+    'http_request_duration_seconds': ('histogram', 'Duration of API requests', request_buckets),
+    'deploy_phase_duration_seconds': ('histogram', 'Duration of clone, build, pull, run and stop phases',
+                                      phase_buckets),
+    'deployments_total': ('counter', 'Finished deployments per resulting service state', None)
+}
+
+_lock = threading.Lock()
+# values observed since the last flush: (family, sample suffix, labels) -> value
+_pending = {}
+_flusher = None
+
+
+def _labels(labels: dict) -> str:
+    """
+    Render labels in the Prometheus text format
+
+    :param labels: label names and values
+    :return: comma separated list of name="value" pairs, sorted by name
+    """
+    escaped = {name: str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for name, value in labels.items()}
+
+    return ','.join(f'{name}="{escaped[name]}"' for name in sorted(escaped))
+
+
+def _add(family: str, suffix: str, labels: dict, value: float):
+    key = (family, suffix, _labels(labels))
+    _pending[key] = _pending.get(key, 0) + value
+
+
+def observe(family: str, value: float, **labels):
+    """
+    Record a value of a histogram
+
+    :param family: name of the histogram
+    :param value: observed value
+    :param labels: labels of the observation
+    """
+    with _lock:
+        # empty buckets are stored as well, so every series exposes all buckets
+        for bound in families[family][2]:
+            _add(family, '_bucket', {**labels, 'le': bound}, int(value <= bound))
+        _add(family, '_bucket', {**labels, 'le': '+Inf'}, 1)
+        _add(family, '_sum', labels, value)
+        _add(family, '_count', labels, 1)
+
+
+def increment(family: str, **labels):
+    """
+    Increment a counter
+
+    :param family: name of the counter
+    :param labels: labels of the counter
+    """
+    with _lock:
+        _add(family, '', labels, 1)
+
+
+@contextmanager
+def timer(family: str, **labels):
+    """
+    Observe the duration of a block in a histogram, also if it raises an error
+
+    :param family: name of the histogram
+    :param labels: labels of the observation
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(family, time.perf_counter() - start, **labels)
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _sample_order(sample: tuple):
+    # buckets of a series in ascending order, followed by sum and count
+    suffix, labels, _ = sample
+    le = re.search(r'(^|,)le="([^"]*)"', labels)
+
+    return re.sub(r'(^|,)le="[^"]*"', '', labels), suffix != '_bucket', float(le.group(2)) if le else 0, suffix
+
+
+def flush(path: str | None = None):
+    """
+    Add the values observed by this process to the totals in the database, which are shared by all API workers
+
+    :param path: path of the SQLite database
+    """
+    global _pending
+
+    with _lock:
+        pending, _pending = _pending, {}
+
+    if not pending:
+        return
+
+    try:
+        with database.transaction(path) as db:
+            db.executemany('INSERT INTO metrics (family, suffix, labels, value) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (family, suffix, labels) DO UPDATE SET value = value + excluded.value',
+                           [(*key, value) for key, value in pending.items()])
+    # keep the values for the next attempt
+    except Exception:
+        with _lock:
+            for key, value in pending.items():
+                _pending[key] = _pending.get(key, 0) + value
+        raise
+
+
+def start(interval: float, path: str | None = None):
+    """
+    Flush the observed values periodically and on exit
+
+    :param interval: seconds between two flushes
+    :param path: path of the SQLite database
+    """
+    global _flusher
+
+    # the working directory may change until the process exits
+    path = os.path.abspath(path or database.db_path)
+
+    def _flush():
+        # the database may have been removed, e.g. with the temporary directory of a benchmark
+        if not os.path.exists(path):
+            return
+
+        try:
+            flush(path)
+        except sqlite3.Error as e:
+            logging.warning(f'Flushing metrics failed: {e}')
+        except Exception:
+            logging.exception('Flushing metrics failed')
+
+    def _run():
+        while True:
+            time.sleep(interval)
+            _flush()
+
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run, name='metrics', daemon=True)
+            _flusher.start()
+            atexit.register(_flush)
+
+
+def render(gauges: dict | None = None, path: str | None = None) -> str:
+    """
+    Render the totals of all API workers in the Prometheus text format
+
+    :param gauges: current values of gauges, (name, (description, {labels: value})) pairs
+    :param path: path of the SQLite database
+    :return: text exposition of all metric families
+    """
+    flush(path)
+
+    samples = {}
+    for family, suffix, labels, value in database.query('SELECT family, suffix, labels, value FROM metrics',
+                                                        path=path):
+        samples.setdefault(family, []).append((suffix, labels, value))
+
+    lines = []
+    for family, (metric_type, description, _) in families.items():
+        lines += [f'# HELP {family} {description}', f'# TYPE {family} {metric_type}']
+        lines += [f'{family}{suffix}{{{labels}}} {_number(value)}' if labels else f'{family}{suffix} {_number(value)}'
+                  for suffix, labels, value in sorted(samples.get(family, []), key=_sample_order)]
+
+    for family, (description, values) in (gauges or {}).items():
+        lines += [f'# HELP {family} {description}', f'# TYPE {family} gauge']
+        lines += [f'{family}{{{_labels(dict(labels))}}} {_number(value)}' for labels, value in values.items()]
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,196 @@
+import logging
+import os
+import socket
+import time
+
+import docker
+from docker.errors import APIError, BuildError, ImageNotFound, NotFound
+
+from service_config import database, metrics
+from service_config.config import readiness_host, readiness_timeout
+from tasks.start_service import build_image, port_bindings, pull_image, read_env
+
+# seconds between two readiness checks of a container
+readiness_interval = 0.5
+
+
+def _port_open(host: str, port: int) -> bool:
+    """
+    Probe a published port of a container
+
+    :param host: host publishing the port
+    :param port: published port
+    :return: True, if a TCP connection has been established and isn't closed immediately
+    """
+    try:
+        with socket.create_connection((host, port), timeout=1) as connection:
+            connection.settimeout(0.2)
+            # Docker's userland proxy accepts connections before the container listens and closes them right away
+            return connection.recv(1) != b''
+    except TimeoutError:
+        return True
+    except OSError:
+        return False
+
+
+def wait_ready(container, timeout: float | None = None) -> bool:
+    """
+    Wait until a container passes its Docker healthcheck or, without healthcheck, accepts connections on all
+    published ports
+
+    :param container: started container
+    :param timeout: seconds to wait, defaults to service_config.config.readiness_timeout
+    :return: True, if the container is ready, False if it failed or the timeout expired
+    """
+    deadline = time.monotonic() + (readiness_timeout if timeout is None else timeout)
+
+    while True:
+        container.reload()
+        state = container.attrs['State']
+
+        if state['Status'] in ['exited', 'dead']:
+            return False
+
+        if 'Health' in state:
+            if state['Health']['Status'] != 'starting':
+                return state['Health']['Status'] == 'healthy'
+        elif state['Status'] == 'running':
+            published = [int(binding['HostPort']) for bindings in (container.ports or {}).values() if bindings
+                         for binding in bindings]
+
+            if all(_port_open(readiness_host, port) for port in published):
+                return True
+
+        if time.monotonic() >= deadline:
+            return False
+
+        time.sleep(readiness_interval)
+
+
+def _remove(docker_client: docker.DockerClient, name: str):
+    """
+    Remove a container, if it exists
+    """
+    try:
+        docker_client.containers.get(name).remove(force=True)
+    except NotFound:
+        pass
+
+
+def _fail(service_id: str, path: str, message: str) -> bool:
+    logging.error(message)
+
+    with open(os.path.join(path, 'error.txt'), 'w') as f:
+        f.write(message)
+
+    database.set_state(service_id, 'BUILD FAILED')
+
+    return False
+
+
+def _recover(docker_client: docker.DockerClient, service_id: str):
+    """
+    Clean up the containers of an interrupted deployment
+    """
+    _remove(docker_client, f'{service_id}-next')
+
+    try:
+        old = docker_client.containers.get(f'{service_id}-old')
+    except NotFound:
+        return
+
+    try:
+        docker_client.containers.get(service_id)
+        old.remove(force=True)
+    # interrupted during the swap
+    except NotFound:
+        logging.warning(f'Restoring previous container of {service_id}')
+        old.rename(service_id)
+        old.start()
+
+
+def replace_service(service_id: str, mode: str, port, dockerfile, tag, volumes: list[str], path='.') -> bool:
+    """
+    Replace the container of a "docker" or "dockerfile" service with minimal downtime.
+
+    The image is built or pulled while the old container keeps serving. A candidate container is started on
+    random host ports and has to become ready, before the old container is stopped and the new one is started
+    with the service's port mapping. If the new container doesn't become ready, the old one is restored.
+
+    :param service_id: id of the microservice
+    :param mode: initialization mode
+    :param port: provided port mapping
+    :param dockerfile: image from dockerhub
+    :param tag: tag of dockerfile
+    :param volumes: list of volume mappings
+    :param path: directory containing the Dockerfile
+    :return: True, if the new container is running, otherwise False
+    """
+    docker_client = docker.from_env()
+    env = read_env(path)
+    ports = port_bindings(port)
+    options = {'detach': True, 'environment': env, 'volumes': volumes, 'tty': mode == 'dockerfile'}
+
+    try:
+        if mode == 'docker':
+            image_name = build_image(docker_client, service_id, path)
+        else:
+            image_name = f'{dockerfile}:{tag}'
+            pull_image(docker_client, service_id, dockerfile, tag)
+    except (APIError, BuildError, ImageNotFound) as e:
+        return _fail(service_id, path, getattr(e, 'explanation', None) or getattr(e, 'msg', None) or str(e))
+
+    _recover(docker_client, service_id)
+
+    # check the new image on random host ports while the old container is still serving
+    logging.info(f'Starting candidate container of {service_id}')
+    try:
+        candidate = docker_client.containers.run(image_name, name=f'{service_id}-next',
+                                                 ports={internal: None for internal in ports}, **options)
+        ready = wait_ready(candidate)
+        logs = candidate.logs(tail=50).decode(errors='replace')
+    except APIError as e:
+        ready, logs = False, str(e.explanation)
+    finally:
+        _remove(docker_client, f'{service_id}-next')
+
+    if not ready:
+        return _fail(service_id, path, f'New container of {service_id} did not become ready\n{logs}')
+
+    # swap: the published ports can only be bound by one container at a time
+    with metrics.timer('deploy_phase_duration_seconds', phase='swap'):
+        try:
+            old = docker_client.containers.get(service_id)
+            old.rename(f'{service_id}-old')
+            old.stop()
+        except NotFound:
+            old = None
+
+        logging.info(f'Swapping container of {service_id}')
+        try:
+            container = docker_client.containers.run(image_name, name=service_id, ports=ports,
+                                                     restart_policy={'Name': 'always'}, **options)
+            ready = wait_ready(container)
+            logs = container.logs(tail=50).decode(errors='replace')
+        except APIError as e:
+            ready, logs = False, str(e.explanation)
+
+    if not ready:
+        _remove(docker_client, service_id)
+
+        if old is not None:
+            logging.warning(f'Restoring previous container of {service_id}')
+            old.rename(service_id)
+            old.start()
+
+        return _fail(service_id, path, f'New container of {service_id} did not become ready\n{logs}')
+
+    if old is not None:
+        old.remove(force=True)
+
+    database.set_state(service_id, 'RUNNING')
+
+    with open(os.path.join(path, 'error.txt'), 'w') as f:
+        f.write('')
+
+    return True
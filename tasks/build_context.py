@@ -0,0 +1,102 @@
+import os
+import tarfile
+
+from docker.utils.build import exclude_paths
+
+# bytes read from a context file at once
+chunk_size = 64 * 1024
+
+# excluded from every build context, in addition to the patterns of .dockerignore
+always_excluded = ['.git', '**/.git']
+
+
+class _Discard:
+    """
+    Write target of the TarFile, which is only used to create the tar headers
+    """
+    def write(self, data):
+        return len(data)
+
+    def tell(self):
+        return 0
+
+
+def read_dockerignore(path: str) -> list[str]:
+    """
+    Load the exclusion patterns of a build context
+
+    :param path: directory of the build context
+    :return: list of patterns, empty without .dockerignore
+    """
+    dockerignore = os.path.join(path, '.dockerignore')
+
+    if not os.path.exists(dockerignore):
+        return []
+
+    with open(dockerignore) as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip() and not line.startswith('#')]
+
+
+class BuildContext:
+    """
+    Uncompressed tar stream of a Docker build context, which is generated while it is uploaded to the daemon.
+
+    Only one file chunk is held in memory at a time. After the iteration, size contains the number of
+    generated bytes.
+    """
+    def __init__(self, path: str, dockerfile: str = 'Dockerfile'):
+        self.path = path
+        self.dockerfile = dockerfile
+        self.size = 0
+
+    def files(self) -> list[str]:
+        """
+        List the paths of the build context
+
+        :return: sorted list of relative paths, which are not excluded
+        """
+        return sorted(exclude_paths(self.path, read_dockerignore(self.path) + always_excluded, self.dockerfile))
+
+    def __iter__(self):
+        self.size = 0
+        # only used to create headers, keeps track of hard links
+        with tarfile.open(mode='w', fileobj=_Discard()) as tar:
+            for name in self.files():
+                full_path = os.path.join(self.path, name)
+
+                # sockets can't be archived
+                if (info := tar.gettarinfo(full_path, arcname=name)) is None:
+                    continue
+
+                # Workaround https://bugs.python.org/issue32713
+                if info.mtime < 0 or info.mtime > 8**11 - 1:
+                    info.mtime = int(info.mtime)
+
+                yield from self._emit(info.tobuf(tar.format, tar.encoding, tar.errors))
+
+                if info.isfile():
+                    yield from self._file_content(full_path, info.size)
+
+        # end of archive marker, padded to the tar record size
+        yield from self._emit(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        if remainder := self.size % tarfile.RECORDSIZE:
+            yield from self._emit(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+    def _emit(self, data: bytes):
+        self.size += len(data)
+        yield data
+
+    def _file_content(self, full_path: str, size: int):
+        remaining = size
+
+        with open(full_path, 'rb') as f:
+            while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield from self._emit(chunk)
+
+        # file shrunk after its header was written
+        if remaining > 0:
+            yield from self._emit(tarfile.NUL * remaining)
+
+        if padding := size % tarfile.BLOCKSIZE:
+            yield from self._emit(tarfile.NUL * (tarfile.BLOCKSIZE - padding))
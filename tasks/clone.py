@@ -0,0 +1,116 @@
+import logging
+import os
+import time
+
+from git import Repo
+
+from service_config import database, metrics
+from service_config.config import clone_depth
+
+# clone strategies, whose working trees borrow the objects of a mirror. Depth and filter of the other strategies
+# are only applied by the Git transport, so they are cloned from the mirror's file:// URL instead.
+shared_strategies = ['full', 'single-branch']
+
+
+def _clone_options(strategy: str, branch: str) -> dict:
+    """
+    Translate a clone strategy into options of "git clone"
+
+    :param strategy: one of service_config.config.clone_strategies
+    :param branch: branch to check out, the remote's default branch if empty
+    :return: keyword arguments of Repo.clone_from
+    """
+    options = {'branch': branch} if branch else {}
+
+    if strategy == 'shallow':
+        options.update(depth=clone_depth, single_branch=True)
+    elif strategy == 'single-branch':
+        options.update(single_branch=True)
+    elif strategy == 'blobless':
+        options.update(filter='blob:none')
+
+    return options
+
+
+def _git_size(repo_path: str) -> int:
+    """
+    Sum up the size of a repository's git directory
+
+    :param repo_path: path of the working tree
+    :return: size in bytes
+    """
+    size = 0
+
+    for directory, _, files in os.walk(os.path.join(repo_path, '.git')):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, file))
+            # files removed by concurrent git processes
+            except OSError:
+                pass
+
+    return size
+
+
+def clone_repository(service_id: str, url: str, repo_path: str, strategy: str = 'full', branch: str = '',
+                     mirror: str | None = None) -> Repo:
+    """
+    Clone a repository with a clone strategy and record duration and size of the transfer
+
+    :param service_id: id of the service
+    :param url: Git Clone URL
+    :param repo_path: target directory
+    :param strategy: one of service_config.config.clone_strategies
+    :param branch: branch to check out, the remote's default branch if empty
+    :param mirror: local mirror of the remote, which is cloned instead of the remote
+    :return: cloned repository
+    """
+    shared = mirror is not None and strategy in shared_strategies
+    logging.info(f'Cloning repository {url} ({strategy}{", shared" if shared else ""})...')
+
+    if mirror is None:
+        source = url
+    elif shared:
+        source = mirror
+    else:
+        source = f'file://{mirror}'
+
+    start = time.perf_counter()
+    # the clone's origin is the mirror, so fetches of updates don't contact the remote again
+    repo = Repo.clone_from(source, repo_path, **({'shared': True} if shared else {}),
+                           **_clone_options(strategy, branch))
+    duration = time.perf_counter() - start
+
+    database.record_stat(service_id, 'clone', strategy, duration, _git_size(repo_path))
+    metrics.observe('deploy_phase_duration_seconds', duration, phase='clone')
+
+    return repo
+
+
+def fetch_repository(service_id: str, repo_path: str, strategy: str = 'full', branch: str = '') -> Repo:
+    """
+    Fetch the tip of a branch and hard-reset the working tree to it
+
+    :param service_id: id of the service
+    :param repo_path: path of the working tree
+    :param strategy: clone strategy used for the repository
+    :param branch: fetched branch, the checked out branch if empty
+    :return: updated repository
+    """
+    repo = Repo(repo_path)
+    branch = branch or repo.active_branch.name
+    size = _git_size(repo_path)
+
+    logging.info(f'Fetching {branch} of {service_id}...')
+
+    start = time.perf_counter()
+    # only update the remote-tracking ref of the deployed branch
+    options = {'depth': clone_depth} if strategy == 'shallow' else {}
+    repo.remote('origin').fetch(f'+refs/heads/{branch}:refs/remotes/origin/{branch}', **options)
+    repo.head.reset(f'origin/{branch}', index=True, working_tree=True)
+    duration = time.perf_counter() - start
+
+    database.record_stat(service_id, 'fetch', strategy, duration, max(0, _git_size(repo_path) - size))
+    metrics.observe('deploy_phase_duration_seconds', duration, phase='fetch')
+
+    return repo
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+from service_config import database, metrics
+from service_config.config import compose_build_workers
+from tasks.build_context import BuildContext
+from tasks.deploy_log import build_output, output_of
+from tasks.scheduler import current_priority, slot
+
+
+def compose_config(path: str) -> dict:
+    """
+    Load the resolved configuration of a docker-compose project
+
+    :param path: directory containing the docker-compose.yml
+    :raises subprocess.CalledProcessError: if docker-compose can't render the configuration as JSON
+    :raises ValueError: if the output isn't valid JSON
+    :return: configuration with absolute build contexts
+    """
+    output = subprocess.run(['docker-compose', 'config', '--format', 'json'], cwd=path, capture_output=True,
+                            check=True).stdout
+
+    return json.loads(output)
+
+
+def _remote_context(context: str) -> bool:
+    return '://' in context or context.startswith('git@')
+
+
+def build_hashes(config: dict, path: str) -> dict:
+    """
+    Hash the build configuration and the build context of every built service of a docker-compose project
+
+    :param config: configuration of compose_config()
+    :param path: directory containing the docker-compose.yml
+    :return: dictionary with (service name, (hash, context size)) pairs, the hash of remote contexts is None
+    """
+    hashes = {}
+
+    for name, service in config.get('services', {}).items():
+        if not (build := service.get('build')):
+            continue
+
+        # short syntax: path of the build context
+        if isinstance(build, str):
+            build = {'context': build}
+
+        if _remote_context(context := build.get('context', '.')):
+            hashes[name] = (None, 0)
+            continue
+
+        digest = sha256(json.dumps(build, sort_keys=True).encode())
+        size = 0
+
+        # files excluded by .dockerignore don't change the image
+        context = os.path.join(path, context)
+        for file in BuildContext(context, build.get('dockerfile', 'Dockerfile')).files():
+            full_path = os.path.join(context, file)
+            digest.update(f'\0{file}\0'.encode())
+
+            if os.path.islink(full_path):
+                digest.update(os.readlink(full_path).encode())
+            elif os.path.isfile(full_path):
+                with open(full_path, 'rb') as f:
+                    while chunk := f.read(1024 * 1024):
+                        digest.update(chunk)
+                        size += len(chunk)
+
+        hashes[name] = (digest.hexdigest(), size)
+
+    return hashes
+
+
+def changed_services(service_id: str, hashes: dict) -> list[str]:
+    """
+    Select the services of a docker-compose project, whose build changed since their last successful build
+
+    :param service_id: id of the microservice
+    :param hashes: build hashes of build_hashes()
+    :return: sorted names of the services to rebuild
+    """
+    built = dict(database.query('SELECT name, hash FROM compose_builds WHERE service_id = ?', (service_id,)))
+
+    return sorted(name for name, (digest, _) in hashes.items() if digest is None or built.get(name) != digest)
+
+
+def build_services(service_id: str, path: str, hashes: dict, names: list[str]):
+    """
+    Build the images of docker-compose services in parallel and remember the hashes of the successful builds
+
+    :param service_id: id of the microservice
+    :param path: directory containing the docker-compose.yml
+    :param hashes: build hashes of build_hashes()
+    :param names: services to build
+    :raises subprocess.CalledProcessError: if a build failed, after all builds finished
+    """
+    deploy_thread = threading.get_ident()
+    # the build threads wait for slots with the priority of the deployment
+    priority_class = current_priority()
+
+    def _build(name: str):
+        with output_of(deploy_thread), slot('builds', holder=f'build {service_id}:{name}',
+                                            priority_class=priority_class):
+            build_output.info(f'Building {name}')
+            start = time.perf_counter()
+            output = b''
+            command = ['docker-compose', 'build', name]
+
+            with subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+                for line in process.stdout:
+                    output += line
+                    # the output of parallel builds is interleaved, the prefix tells the services apart
+                    build_output.info(f'{name} | {line.decode(errors="replace").rstrip()}')
+
+            duration = time.perf_counter() - start
+
+        metrics.observe('deploy_phase_duration_seconds', duration, phase='build')
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output, output)
+
+        logging.info(f'Built {name} of {service_id} in {duration:.1f}s')
+        database.record_stat(service_id, 'build', f'compose:{name}', duration, hashes[name][1])
+
+        database.execute('INSERT INTO compose_builds (service_id, name, hash) VALUES (?, ?, ?) '
+                         'ON CONFLICT (service_id, name) DO UPDATE SET hash = excluded.hash',
+                         (service_id, name, hashes[name][0] or ''))
+
+    if not names:
+        build_output.info('All images are up to date')
+        return
+
+    with ThreadPoolExecutor(max(1, min(compose_build_workers, len(names))), thread_name_prefix='build') as executor:
+        futures = [executor.submit(_build, name) for name in names]
+
+    # every build finishes, so successful ones aren't repeated by the next deployment
+    for future in futures:
+        future.result()
@@ -1,28 +1,56 @@
-import sys
-import shutil
-from update_service import stop_service
-import sqlite3
+import logging
 import os
+import shutil
 
-service_id = sys.argv[1]
-base_dir = os.getcwd()
+from docker.errors import DockerException
 
-with sqlite3.connect(os.path.join('services', 'services.db')) as db:
-    cursor = db.cursor()
+from service_config import database
+from tasks.deploy_log import remove_logs
+from tasks.mirror import remove_mirror
+from tasks.spool import collect_garbage
+from tasks.update_service import stop_service
 
-    # check if service exists
-    cursor.execute('SELECT mode, docker_root FROM repos WHERE id = ?', (service_id,))
 
-    if output := cursor.fetchone():
+def delete_repository(service_id: str):
+    """
+    Stop a service and remove its repository and configuration
+
+    :param service_id: microservice id
+    :raises OSError: if the repository couldn't be removed, the service is in state "DELETE FAILED"
+    :raises DockerException: if the containers couldn't be stopped
+    """
+    # check if service exists
+    if output := database.query_one('SELECT mode, docker_root, url_key, mirror FROM repos WHERE id = ?',
+                                    (service_id,)):
         mode = output[0]
         root = output[1]
 
-        os.chdir(os.path.join('services', service_id, root))
+        # an update finished before the deletion may have reset the state
+        database.set_state(service_id, 'DELETING')
+
+        try:
+            # stop container and delete git repository
+            stop_service(mode, service_id, os.path.join('services', service_id, root))
+            # a retried deletion may find the repository already removed
+            if os.path.exists(os.path.join('services', service_id)):
+                shutil.rmtree(os.path.join('services', service_id))
+        except (OSError, DockerException):
+            logging.exception(f'deletion of {service_id} failed')
+            database.set_state(service_id, 'DELETE FAILED')
+            raise
+
+        remove_logs(service_id)
+
+        with database.transaction() as db:
+            db.execute('DELETE FROM repos WHERE id = ?', (service_id,))
+            db.execute('DELETE FROM port_mappings WHERE service_id = ?', (service_id,))
+            db.execute('DELETE FROM custom_files WHERE service_id = ?', (service_id,))
+            db.execute('DELETE FROM compose_builds WHERE service_id = ?', (service_id,))
+            db.execute('DELETE FROM disk_usage WHERE service_id = ?', (service_id,))
 
-        # stop container and delete git repository
-        stop_service(mode, service_id)
-        shutil.rmtree(os.path.join(base_dir, 'services', service_id))
-        cursor.execute('DELETE FROM repos WHERE id = ?', (service_id,))
-        db.commit()
+        # custom files only used by the deleted service
+        collect_garbage()
 
-        os.chdir(base_dir)
+        # mirror only used by the deleted service
+        if output[3]:
+            remove_mirror(output[2])
@@ -0,0 +1,200 @@
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from service_config.config import log_retention, max_log_size
+
+# directory containing one log directory per service
+log_root = os.path.join('services', '.logs')
+
+# seconds between two reads of a followed log
+follow_interval = 0.5
+
+# output of builds, pulls and docker-compose, recorded by the DeployLog of the executing thread
+build_output = logging.getLogger('deploy')
+build_output.setLevel(logging.INFO)
+# keep build output out of the server log
+build_output.propagate = False
+
+# deployment thread of helper threads, e.g. parallel builds
+_owner = threading.local()
+
+
+def _stamp_owner(record: logging.LogRecord) -> bool:
+    record.deploy_thread = getattr(_owner, 'thread', record.thread)
+    return True
+
+
+build_output.addFilter(_stamp_owner)
+
+
+@contextmanager
+def output_of(thread: int):
+    """
+    Record the build output of the current thread in the DeployLog of another thread
+
+    :param thread: identifier of the thread executing the deployment
+    """
+    _owner.thread = thread
+    try:
+        yield
+    finally:
+        del _owner.thread
+
+
+class DeployLog(logging.Handler):
+    """
+    Log of a single deployment, which records the build output of the current thread line by line.
+
+    While the deployment runs, the log is an uncompressed "<deploy id>.log" file, so other API workers can
+    follow it. Afterwards, it is compressed and only the newest deployments of a service are kept.
+    """
+    def __init__(self, service_id: str, root: str | None = None):
+        super().__init__()
+        self.directory = os.path.join(root or log_root, service_id)
+        self.deploy_id = str(time.time_ns() // 1000000)
+        self.path = os.path.join(self.directory, f'{self.deploy_id}.log')
+        self.size = 0
+        self.truncated = False
+        self._thread = threading.get_ident()
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # unbuffered, so followers receive every line immediately
+        self._file = open(self.path, 'wb', buffering=0)
+        build_output.addHandler(self)
+
+        return self
+
+    def __exit__(self, *_):
+        build_output.removeHandler(self)
+        self._file.close()
+
+        # readers treat the deployment as finished, once the uncompressed log is gone
+        with open(self.path, 'rb') as source, gzip.open(f'{self.path}.gz.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(f'{self.path}.gz.tmp', f'{self.path}.gz')
+        os.remove(self.path)
+
+        # rotate: keep the newest deployments only
+        for deploy_id in sorted(self._finished(), key=int)[:-log_retention]:
+            os.remove(os.path.join(self.directory, f'{deploy_id}.log.gz'))
+
+    def _finished(self) -> list[str]:
+        return [name[:-len('.log.gz')] for name in os.listdir(self.directory) if name.endswith('.log.gz')]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # deployments of other services run in other threads
+        return getattr(record, 'deploy_thread', record.thread) == self._thread
+
+    def emit(self, record: logging.LogRecord):
+        for line in record.getMessage().splitlines() or ['']:
+            self.write(line)
+
+    def write(self, line: str):
+        """
+        Append a line to the log, until it reaches service_config.config.max_log_size
+
+        :param line: line without line break
+        """
+        if self.truncated:
+            return
+
+        data = f'{line}\n'.encode()
+
+        if self.size + len(data) > max_log_size:
+            self.truncated = True
+            data = f'[log truncated after {self.size} bytes]\n'.encode()
+
+        self._file.write(data)
+        self.size += len(data)
+
+
+def list_deploys(service_id: str, root: str | None = None) -> list[str]:
+    """
+    List the logged deployments of a service
+
+    :param service_id: id of the service
+    :param root: directory containing the log directories
+    :return: deploy ids, oldest first
+    """
+    directory = os.path.join(root or log_root, service_id)
+
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted({name.split('.')[0] for name in os.listdir(directory) if name.endswith(('.log', '.log.gz'))},
+                  key=int)
+
+
+def is_running(service_id: str, deploy_id: str, root: str | None = None) -> bool:
+    """
+    Check, if a deployment is still writing its log
+
+    :param service_id: id of the service
+    :param deploy_id: id of the deployment
+    :param root: directory containing the log directories
+    :return: True, if the uncompressed log exists
+    """
+    return os.path.exists(os.path.join(root or log_root, service_id, f'{deploy_id}.log'))
+
+
+def read_lines(service_id: str, deploy_id: str, follow: bool = False, root: str | None = None):
+    """
+    Read the lines of a deployment log
+
+    :param service_id: id of the service
+    :param deploy_id: id of the deployment
+    :param follow: wait for further lines, until the deployment has finished
+    :param root: directory containing the log directories
+    :return: generator of lines without line breaks
+    """
+    path = os.path.join(root or log_root, service_id, f'{deploy_id}.log')
+
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            # the open file stays readable after the writer compressed and removed it
+            yield from _tail(f, path, follow)
+        return
+    # finished deployment
+    except FileNotFoundError:
+        pass
+
+    with gzip.open(f'{path}.gz', 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def _tail(f, path: str, follow: bool):
+    buffer = ''
+
+    while True:
+        # checked before reading, so the lines written before the removal are read
+        finished = not follow or not os.path.exists(path)
+
+        if chunk := f.read():
+            buffer += chunk
+            *lines, buffer = buffer.split('\n')
+            yield from lines
+        elif finished:
+            break
+        else:
+            time.sleep(follow_interval)
+
+    if buffer:
+        yield buffer
+
+
+def remove_logs(service_id: str, root: str | None = None):
+    """
+    Delete all deployment logs of a service
+
+    :param service_id: id of the service
+    :param root: directory containing the log directories
+    """
+    shutil.rmtree(os.path.join(root or log_root, service_id), ignore_errors=True)
@@ -10,3 +10,36 @@ class InvalidVolumeMappingException(Exception):
     """
     def __init__(self, message):
         self.message = message
+
+
+class InvalidRegistrationException(Exception):
+    """
+    Raised, if parameters of a service registration are missing or unsupported
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+class InvalidFilesException(Exception):
+    """
+    Raised, if the custom files of a request aren't a mapping of file paths to file contents
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+class InvalidFilePathException(Exception):
+    """
+    Raised, if a custom file would be written outside of the repository of its service
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+class QueueFullException(Exception):
+    """
+    Raised, if too many deployments are queued to accept another one
+    """
+    def __init__(self, queued: int, retry_after: int):
+        self.retry_after = retry_after
+        self.message = f'{queued} deployments queued, retry in {retry_after} seconds'
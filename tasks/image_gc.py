@@ -0,0 +1,200 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import docker
+from docker.errors import APIError, DockerException, ImageNotFound
+
+from service_config import database
+from service_config.config import gc_interval, image_retention
+from tasks.poller import acquire_lease
+
+# seconds between two checks, if a collection is due
+gc_tick = 60.0
+
+# seconds the collector lease stays valid without renewal
+lease_duration = 3 * gc_tick
+
+
+def directory_size(path: str) -> int:
+    """
+    Sum the sizes of all files below a directory
+
+    :param path: directory
+    :return: size in bytes, 0 if the directory doesn't exist
+    """
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            # removed during the walk
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+def images_in_use(path: str | None = None) -> set[str]:
+    """
+    Collect the images currently deployed by the registered services
+
+    :param path: path of the SQLite database
+    :return: image names and tags
+    """
+    return {f'{service_id}:latest' if mode == 'docker' else f'{image}:{tag}'
+            for service_id, mode, image, tag in database.query('SELECT id, mode, image, tag FROM repos WHERE mode IN '
+                                                               '("docker", "dockerfile")', path=path)}
+
+
+class ImageCollector:
+    """
+    Background thread removing unused images, dangling images and build cache, and measuring the disk use of
+    the services.
+
+    Only the API worker holding the "image-gc" lease collects. Collections are deferred while deployments run,
+    so they don't compete with builds for the I/O of the Docker daemon, but at most for one interval.
+    """
+    def __init__(self, interval: float = gc_interval, retention: float = image_retention, db_path: str | None = None):
+        self.interval = interval
+        self.retention = retention
+        self.db_path = db_path
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self.collected = 0
+        # time the first collection was deferred by running deployments
+        self.deferred = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start the collector thread
+        """
+        self._thread = threading.Thread(target=self._loop, name='image-gc', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            # the API worker finishes its startup first
+            time.sleep(gc_tick)
+
+            try:
+                if acquire_lease('image-gc', self.holder, lease_duration, self.db_path) and self.due(time.time()):
+                    self.collect()
+            # the collector must survive unavailable databases and daemons
+            except (sqlite3.Error, DockerException) as e:
+                logging.warning(f'Collecting images failed: {e}')
+            except Exception:
+                logging.exception('Collecting images failed')
+
+    def due(self, now: float) -> bool:
+        """
+        Check, if a collection should run now
+
+        :param now: current time
+        :return: True, if the interval passed and no deployment runs or the collection was deferred too long
+        """
+        if now - self.collected < self.interval:
+            return False
+
+        if database.query_one('SELECT 1 FROM jobs WHERE state = "RUNNING" AND kind != "prepull"', path=self.db_path):
+            self.deferred = self.deferred or now
+            return now - self.deferred >= self.interval
+
+        return True
+
+    def collect(self) -> dict:
+        """
+        Remove images, which no service has used within the retention period, dangling images and build cache
+        older than the retention period. Afterwards, the disk use of all services is measured.
+
+        :return: number of removed images and reclaimed bytes
+        """
+        docker_client = docker.from_env()
+        now = time.time()
+        self.collected = now
+        self.deferred = None
+        in_use = images_in_use(self.db_path)
+        removed = 0
+
+        for reference, used in database.query('SELECT reference, used FROM images', path=self.db_path):
+            if reference in in_use:
+                database.execute('UPDATE images SET used = ? WHERE reference = ?', (now, reference), self.db_path)
+                continue
+
+            if used > now - self.retention:
+                continue
+
+            try:
+                docker_client.images.remove(reference)
+                removed += 1
+            except ImageNotFound:
+                pass
+            # still used by a container, e.g. of a failed blue-green deployment
+            except APIError as e:
+                logging.warning(f'Removing image {reference} failed: {e}')
+                continue
+
+            database.execute('DELETE FROM images WHERE reference = ?', (reference,), self.db_path)
+
+        until = {'until': f'{int(self.retention)}s'}
+        images = docker_client.images.prune(filters={'dangling': True, **until})
+        cache = docker_client.images.prune_builds(filters=until)
+        reclaimed = (images.get('SpaceReclaimed') or 0) + (cache.get('SpaceReclaimed') or 0)
+
+        logging.info(f'Removed {removed + len(images.get("ImagesDeleted") or [])} images and reclaimed {reclaimed} '
+                     f'bytes')
+
+        self.measure(docker_client)
+
+        return {'images': removed + len(images.get('ImagesDeleted') or []), 'reclaimed': reclaimed}
+
+    def measure(self, docker_client: docker.DockerClient):
+        """
+        Store the disk use of the repository, the images and the containers of every service
+
+        :param docker_client: client of the Docker daemon
+        """
+        # a single, expensive query of the daemon for all services
+        usage = docker_client.df()
+        sizes = {image['Id']: image.get('Size') or 0 for image in usage.get('Images') or []}
+        tags = {tag: image['Id'] for image in usage.get('Images') or [] for tag in image.get('RepoTags') or []}
+
+        # images built or pulled for a service and images of its containers, e.g. built by docker-compose
+        image_ids = {}
+        for reference, service_id in database.query('SELECT reference, service_id FROM images', path=self.db_path):
+            if reference in tags:
+                image_ids.setdefault(service_id, set()).add(tags[reference])
+
+        containers = {}
+        for container in usage.get('Containers') or []:
+            containers.setdefault(_owner(container), []).append(container)
+
+        rows = []
+
+        for service_id, docker_root in database.query('SELECT id, docker_root FROM repos', path=self.db_path):
+            repository = os.path.join('services', service_id)
+            owned = containers.get(service_id, []) + containers.get(
+                os.path.abspath(os.path.join(repository, docker_root)), [])
+            ids = image_ids.get(service_id, set()) | {container.get('ImageID') for container in owned}
+
+            rows.append((service_id, directory_size(repository), sum(sizes.get(image_id, 0) for image_id in ids),
+                         sum(container.get('SizeRw') or 0 for container in owned), time.time()))
+
+        with database.transaction(self.db_path) as db:
+            db.execute('DELETE FROM disk_usage')
+            db.executemany('INSERT INTO disk_usage (service_id, repository, images, containers, measured) '
+                           'VALUES (?, ?, ?, ?, ?)', rows)
+
+
+def _owner(container: dict) -> str:
+    # compose containers belong to the project directory, others are named after the service
+    if project := (container.get('Labels') or {}).get('com.docker.compose.project.working_dir'):
+        return os.path.abspath(project)
+
+    name = (container.get('Names') or [''])[0].lstrip('/')
+
+    return name.removesuffix('-next').removesuffix('-old')
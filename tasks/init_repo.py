@@ -1,67 +1,199 @@
 import logging
+import os
+import shutil
+import tempfile
+from sqlite3 import Connection, Cursor
 
 from git import Repo
-import sqlite3
+
+from service_config import database, metrics
+from service_config.config import (
+    default_clone_strategy,
+    default_poll_interval,
+    default_update_strategy,
+    normalize_url,
+    shared_mirrors,
+    store_ports,
+    submodule_jobs,
+)
+from tasks.clone import clone_repository
 from tasks.exceptions import RepositoryAlreadyExistsException
-import os
+from tasks.jobs import requested_at
+from tasks.locks import process_tag, tag_alive
+from tasks.mirror import update_mirror
+from tasks.spool import store_files, write_files
+
+# temporary directories of running clones, moved to services/<id> once complete
+clone_dir = os.path.join('services', '.clones')
 
 
-def load_repository(url: str, mode: str, port: str, docker_root: str, dockerfile='.', tag='.', files=None):
+def service_id_of(url: str, image: str, docker_root: str = '.') -> str:
     """
-    Clone a repository and store configuration into database
+    Derive the id of a service from its Docker image or its Git clone URL
 
-    :param files: Dictionary with (file_path, file_content) pairs
-    :param port: Port Mapping for Dockerfile setups
+    :param url: Git Clone URL
+    :param image: docker image name from dockerhub, empty for repositories
+    :param docker_root: directory of repo with Dockerfile/docker-compose.yml
+    :return: id of the service
+    """
+    if image:
+        return image.replace('/', '-')
+
+    service_id = '-'.join(url.lower().replace('//', '').split('/')[1:]).replace('.git', '')
+
+    # several services can be deployed from subdirectories of the same repository
+    if (docker_root := os.path.normpath(docker_root or '.').strip('/')) != '.':
+        service_id += '-' + docker_root.lower().replace('/', '-')
+
+    return service_id
+
+
+def _update_submodules(repo: Repo):
+    # initialize all submodules, git fetches up to submodule_jobs of them in parallel
+    with metrics.timer('deploy_phase_duration_seconds', phase='submodules'):
+        if repo.submodules:
+            repo.git.submodule('update', '--init', '--recursive', f'--jobs={max(1, submodule_jobs)}')
+
+
+def _remove_reservation(db: Connection, service_id: str):
+    db.execute('DELETE FROM repos WHERE id = ?', (service_id,))
+    db.execute('DELETE FROM port_mappings WHERE service_id = ?', (service_id,))
+    db.execute('DELETE FROM custom_files WHERE service_id = ?', (service_id,))
+
+
+def reserve_repository(cursor: Cursor, url: str, mode: str, port: str, docker_root: str, image='', tag='',
+                       clone_strategy=default_clone_strategy, branch='', update_strategy=default_update_strategy,
+                       poll_interval=default_poll_interval) -> str:
+    """
+    Register a service in state "CLONING" and allocate its ports before its repository is cloned by
+    initialize_repository(). The caller commits the transaction, so several services can be reserved at once.
+
+    :param cursor: cursor of the service database inside of a transaction
     :param url: Git Clone URL
     :param mode: mode of docker execution
+    :param port: Port Mapping for Dockerfile setups
     :param docker_root: directory of repo with Dockerfile/docker-compose.yml
-    :param dockerfile: docker image name from dockerhub
-    :param tag: tag of dockerfile
+    :param image: docker image name from dockerhub
+    :param tag: tag of the image
+    :param clone_strategy: one of service_config.config.clone_strategies
+    :param branch: deployed branch, the remote's default branch if empty
+    :param update_strategy: one of service_config.config.update_strategies
+    :param poll_interval: seconds between two polls of the remote, 0 disables polling
     :raises RepositoryAlreadyExistsException
-    :return: id of the created repository
+    :raises InvalidPortMappingException
+    :raises PortAlreadyUsedException: if a port is allocated by another service, also one reserved in the same
+        transaction
+    :return: id of the reserved service
     """
-    if files is None:
-        files = {}
-    if dockerfile:
-        link = dockerfile.replace('/', '-')
-    else:
-        link = '-'.join(url.lower().replace('//', '').split('/')[1:]).replace('.git', '')
-
-    repo_path = os.path.join('services', link)
+    service_id = service_id_of(url, image, docker_root)
 
-    # repository already exists
-    if os.path.exists(repo_path):
+    if os.path.exists(os.path.join('services', service_id)) or \
+            cursor.execute('SELECT 1 FROM repos WHERE id = ?', (service_id,)).fetchone():
         raise RepositoryAlreadyExistsException()
 
-    if mode != 'dockerfile':
-        # clone repository
-        logging.info(f'Cloning repository {url}...')
-        repo = Repo.clone_from(url, repo_path)
+    cursor.execute('INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag, clone_strategy, '
+                   'branch, update_strategy, url_key, poll_interval) '
+                   'VALUES (?, ?, ?, "CLONING", ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (service_id, url, mode, port, docker_root, image, tag, clone_strategy, branch,
+                    update_strategy, normalize_url(url) if url else '', poll_interval))
+    store_ports(port, service_id, cursor)
 
-        # initialize all submodules
-        for submodule in repo.submodules:
-            submodule.update()
-    else:
-        logging.info(f'Creating directory {link}')
-        os.mkdir(repo_path)
+    return service_id
 
-    # add all optional files to repository
-    for file in files:
-        file_path = os.path.join(repo_path, file.replace("..", "."))
 
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+def initialize_repository(service_id: str, files: dict):
+    """
+    Clone the repository of a reserved service and write its custom files. The clone is created in a
+    temporary directory and moved to services/<id> once it is complete, so an interrupted clone never leaves
+    a partial repository. If the clone fails, the reservation is removed, so the service can be registered
+    again. Afterwards, the service is in state "INITIALIZING".
+
+    :param service_id: id of reserve_repository()
+    :param files: spooled custom files, dictionary with (file_path, content digest) pairs
+    :raises GitCommandError: if the repository couldn't be cloned
+    """
+    url, url_key, mode, clone_strategy, branch = database.query_one('SELECT url, url_key, mode, clone_strategy, '
+                                                                    'branch FROM repos WHERE id = ?', (service_id,))
+    mirror = ''
+    os.makedirs(clone_dir, exist_ok=True)
+    # the process tag tells the clones of terminated API workers apart
+    temp_path = tempfile.mkdtemp(prefix=f'{process_tag()}-{service_id}-', dir=clone_dir)
+    # mkdtemp() only permits the owner to access the directory
+    os.chmod(temp_path, 0o755)
+
+    try:
+        if mode != 'dockerfile':
+            # services cloned from the same remote are cloned from its mirror
+            if shared_mirrors and url_key:
+                mirror = update_mirror(service_id, url, url_key, requested_at())
+
+            repo = clone_repository(service_id, url, temp_path, clone_strategy, branch, mirror or None)
+            branch = repo.active_branch.name
+            _update_submodules(repo)
+        else:
+            logging.info(f'Creating directory {service_id}')
+
+        write_files(service_id, temp_path, files)
+        os.rename(temp_path, os.path.join('services', service_id))
+    except Exception:
+        logging.exception(f'Initializing {service_id} failed')
+
+        shutil.rmtree(temp_path, ignore_errors=True)
+        with database.transaction() as db:
+            _remove_reservation(db, service_id)
+        raise
+
+    database.execute('UPDATE repos SET state = "INITIALIZING", branch = ?, mirror = ? WHERE id = ?',
+                     (branch, mirror, service_id))
+
+
+def remove_stale_clones():
+    """
+    Remove the temporary directories and the reservations of clones interrupted by terminated API workers.
+    Call after JobRunner.recover(), which marks their jobs as failed.
+    """
+    if os.path.isdir(clone_dir):
+        for name in os.listdir(clone_dir):
+            if not tag_alive(name.split('-')[0]):
+                logging.warning(f'Removing interrupted clone {name}')
+                shutil.rmtree(os.path.join(clone_dir, name), ignore_errors=True)
+
+    with database.transaction() as db:
+        # reservations are committed together with the job cloning the repository
+        for row in db.execute('SELECT id FROM repos WHERE state = "CLONING" AND id NOT IN (SELECT service_id FROM jobs '
+                              'WHERE state IN ("QUEUED", "RUNNING"))').fetchall():
+            service_id = row[0]
+            logging.warning(f'Removing reservation of {service_id}, its clone was interrupted')
+            _remove_reservation(db, service_id)
 
-        with open(file_path, 'w') as f:
-            f.write(files[file])
 
-    with sqlite3.connect(os.path.join('services', 'services.db')) as db:
-        logging.info(f'Registration of service {link}...')
-        cursor = db.cursor()
+def load_repository(url: str, mode: str, port: str, docker_root: str, dockerfile='.', tag='.', files=None,
+                    clone_strategy=default_clone_strategy, branch='', update_strategy=default_update_strategy,
+                    poll_interval=default_poll_interval):
+    """
+    Clone a repository and store configuration into database, within the calling thread
+
+    :param files: Dictionary with (file_path, file_content) pairs
+    :param port: Port Mapping for Dockerfile setups
+    :param url: Git Clone URL
+    :param mode: mode of docker execution
+    :param docker_root: directory of repo with Dockerfile/docker-compose.yml
+    :param dockerfile: docker image name from dockerhub
+    :param tag: tag of dockerfile
+    :param clone_strategy: one of service_config.config.clone_strategies
+    :param branch: deployed branch, the remote's default branch if empty
+    :param update_strategy: one of service_config.config.update_strategies
+    :param poll_interval: seconds between two polls of the remote, 0 disables polling
+    :raises RepositoryAlreadyExistsException
+    :raises PortAlreadyUsedException: if a port is allocated by another service
+    :raises GitCommandError: if the repository couldn't be cloned
+    :return: id of the created repository
+    """
+    with database.transaction() as db:
+        link = reserve_repository(db.cursor(), url, mode, port, docker_root, dockerfile, tag, clone_strategy, branch,
+                                  update_strategy, poll_interval)
 
-        # store configuration in SQLite db
-        cursor.execute('INSERT INTO repos VALUES (?, ?, ?, "INITIALIZING", ?, ?, ?, ?)',
-                       (link, url, mode, port, docker_root, dockerfile, tag))
-        db.commit()
-        cursor.close()
+    logging.info(f'Registration of service {link}...')
+    initialize_repository(link, store_files(files or {}))
 
     return link
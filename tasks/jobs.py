@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from service_config import database
+from service_config.config import clone_workers, max_workers, priority_classes, update_debounce
+from tasks import scheduler
+from tasks.locks import is_alive, process_start, release, request_lock, try_acquire
+
+# seconds to wait before checking again, if another job of the same service is running
+poll_interval = 1.0
+
+# time of the latest request served by the job of the current thread
+_request = threading.local()
+
+
+def requested_at() -> float:
+    """
+    Get the time of the latest request merged into the job executed by the current thread
+
+    :return: timestamp, the current time outside of jobs
+    """
+    return getattr(_request, 'time', None) or time.time()
+
+
+class JobRunner:
+    """
+    Long-lived pool of worker threads executing service tasks inside the API process.
+
+    Jobs are tracked in the "jobs" table, so their state and the queue depth are visible to every
+    API worker process. Preparations of jobs, e.g. the clones of new services, run in a separate pool, so they
+    neither wait for nor occupy the workers executing the tasks.
+    """
+    def __init__(self, workers: int = max_workers, db_path: str | None = None, debounce: float = update_debounce,
+                 preparers: int = clone_workers):
+        self.workers = workers
+        self.db_path = db_path
+        self.debounce = debounce
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.preparation = ThreadPoolExecutor(max_workers=preparers, thread_name_prefix='prepare')
+
+    def submit(self, kind: str, service_id: str, task, *args, coalesce=False, priority_class='normal',
+               prepare=None) -> str:
+        """
+        Queue a task for execution in the worker pool.
+
+        Jobs of the same service never run in parallel: each job queues for the lock of its service on
+        submission and runs, once all earlier jobs of the service finished. With coalesce, the job is merged
+        into an already queued job of the same kind and service: the queued job is executed once with the
+        latest arguments after the debounce window passed without further requests.
+
+        :param kind: type of the job (e.g. "update", "start")
+        :param service_id: id of the affected service
+        :param task: callable executed by the worker
+        :param args: JSON serializable positional arguments of task
+        :param coalesce: merge the job into a queued job of the same kind and service
+        :param priority_class: priority of the job's requests for limited resources, see tasks.scheduler
+        :param prepare: callable without arguments executed in the preparation pool, before the job is scheduled.
+            It runs outside of the service's lock, so it may only prepare services no other job can access yet.
+            If it fails, the job fails.
+        :return: id of the created or merged job
+        """
+        payload = json.dumps(args)
+        requested = time.time()
+        not_before = requested + (self.debounce if coalesce else 0)
+
+        # the write lock prevents concurrent API workers from queueing the same job twice
+        with database.transaction(self.db_path) as db:
+            if coalesce and (queued := db.execute('SELECT id, priority FROM jobs WHERE service_id = ? AND kind = ? '
+                                                  'AND state = "QUEUED"', (service_id, kind)).fetchone()):
+                # the merged job keeps the highest priority of its requests
+                db.execute('UPDATE jobs SET payload = ?, not_before = ?, priority = ?, requested = ? WHERE id = ?',
+                           (payload, not_before, min(queued[1], priority_class, key=priority_classes.index),
+                            requested, queued[0]))
+
+                logging.info(f'Merged {kind} request for {service_id} into job {queued[0]}')
+                return queued[0]
+
+            job_id = uuid4().hex
+            ticket = request_lock(db, service_id, f'{kind} job {job_id}')
+            db.execute('INSERT INTO jobs (id, service_id, kind, state, created, pid, pid_start, payload, not_before, '
+                       'ticket, priority, requested) VALUES (?, ?, ?, "QUEUED", ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (job_id, service_id, kind, requested, os.getpid(), process_start(os.getpid()), payload,
+                        not_before, ticket, priority_class, requested))
+
+        logging.info(f'Queued {kind} job {job_id} for {service_id}')
+
+        if prepare is None:
+            self._schedule(job_id, task, not_before - time.time())
+        else:
+            self.preparation.submit(self._prepare, job_id, task, prepare, priority_class, requested)
+
+        return job_id
+
+    def _prepare(self, job_id: str, task, prepare, priority_class: str, requested: float):
+        # waits for the transaction submitting the job, which e.g. also reserves the prepared service
+        with database.transaction(self.db_path) as db:
+            if not db.execute('SELECT 1 FROM jobs WHERE id = ?', (job_id,)).fetchone():
+                return
+
+        _request.time = requested
+
+        try:
+            with scheduler.priority(priority_class):
+                prepare()
+        except Exception as e:
+            logging.exception(f'Preparing job {job_id} failed')
+            self._set_state(job_id, 'FAILED', str(e))
+            self._release(job_id)
+            return
+        finally:
+            _request.time = None
+
+        self._schedule(job_id, task, 0)
+
+    def _schedule(self, job_id: str, task, delay: float):
+        if delay > 0:
+            # wait outside the pool, so delayed jobs don't block a worker thread
+            timer = threading.Timer(delay, self.executor.submit, (self._run, job_id, task))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.executor.submit(self._run, job_id, task)
+
+    def _claim(self, job_id: str):
+        """
+        Mark a job as running, if its debounce window passed and no other job of its service is running
+
+        :param job_id: id of the job
+        :return: (arguments, priority class and request time of the job, None) if claimed, otherwise
+            (None, seconds to wait)
+        """
+        with database.transaction(self.db_path) as db:
+            service_id, payload, not_before, ticket, priority_class, requested = db.execute(
+                'SELECT service_id, payload, not_before, ticket, priority, requested FROM jobs WHERE id = ?',
+                (job_id,)).fetchone()
+
+            if (delay := not_before - time.time()) > 0:
+                return None, delay
+
+            # earlier jobs of the service, e.g. of other API workers, run first
+            if db.execute('SELECT 1 FROM jobs WHERE service_id = ? AND state = "RUNNING"', (service_id,)).fetchone() \
+                    or (ticket is not None and not try_acquire(db, ticket)):
+                return None, poll_interval
+
+            db.execute('UPDATE jobs SET state = "RUNNING", started = ? WHERE id = ?', (time.time(), job_id))
+
+        return (json.loads(payload), priority_class, requested), None
+
+    def _release(self, job_id: str):
+        if ticket := database.query_one('SELECT ticket FROM jobs WHERE id = ?', (job_id,), self.db_path)[0]:
+            release(ticket, self.db_path)
+
+    def _set_state(self, job_id: str, state: str, error=None, result=None):
+        database.execute('UPDATE jobs SET state = ?, finished = ?, error = ?, result = ? WHERE id = ?',
+                         (state, time.time(), error, result, job_id), self.db_path)
+
+    def _run(self, job_id: str, task):
+        claimed, delay = self._claim(job_id)
+
+        # debounce window extended or service busy
+        if claimed is None:
+            self._schedule(job_id, task, delay)
+            return
+
+        args, priority_class, _request.time = claimed
+
+        try:
+            with scheduler.priority(priority_class):
+                result = task(*args)
+            self._set_state(job_id, 'DONE', result=None if result is None else str(result))
+        # a failing task must not take down the worker thread
+        except Exception as e:
+            logging.exception(f'Job {job_id} failed')
+            self._set_state(job_id, 'FAILED', str(e))
+        finally:
+            _request.time = None
+            self._release(job_id)
+
+    def queue_depth(self) -> dict:
+        """
+        Count unfinished jobs of all API workers
+
+        :return: dictionary with the number of queued and running jobs
+        """
+        counts = dict(database.query('SELECT state, COUNT(*) FROM jobs WHERE state IN ("QUEUED", "RUNNING") '
+                                     'GROUP BY state', path=self.db_path))
+
+        return {'queued': counts.get('QUEUED', 0), 'running': counts.get('RUNNING', 0)}
+
+    def recover(self):
+        """
+        Mark unfinished jobs of terminated processes as failed
+        """
+        with database.transaction(self.db_path) as db:
+            jobs = db.execute('SELECT id, pid, pid_start, ticket FROM jobs WHERE state IN ("QUEUED", "RUNNING")'
+                              ).fetchall()
+
+            for job_id, pid, started, ticket in jobs:
+                if not is_alive(pid, started):
+                    logging.warning(f'Job {job_id} was interrupted')
+                    db.execute('UPDATE jobs SET state = "FAILED", finished = ?, error = "interrupted" WHERE id = ?',
+                               (time.time(), job_id))
+                    db.execute('DELETE FROM locks WHERE ticket = ?', (ticket,))
+
+
+def get_job(job_id: str, db_path: str | None = None):
+    """
+    Load the state of a job
+
+    :param job_id: id of the job
+    :param db_path: path of the SQLite database
+    :return: dictionary describing the job or None, if the job doesn't exist
+    """
+    job = database.query_one('SELECT id, service_id, kind, state, priority, created, started, finished, error, result '
+                             'FROM jobs WHERE id = ?', (job_id,), db_path)
+
+    return dict(job) if job else None
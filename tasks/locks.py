@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from service_config import database
+
+# seconds between two attempts to acquire a lock held by another operation
+lock_poll_interval = 0.5
+
+
+def process_start(pid: int) -> int:
+    """
+    Get the start time of a process. Together with the pid, it identifies a process across restarts of the
+    container, whose new API workers get the same small pids as the terminated ones.
+
+    :param pid: process id
+    :return: start time in clock ticks since boot, 0 if unknown (e.g. without /proc)
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # the process name in parentheses may contain spaces, the start time is the 22nd field
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def is_alive(pid: int, started: int = 0) -> bool:
+    """
+    Check, if a process with the given pid is still running
+
+    :param pid: process id
+    :param started: start time of process_start(), the pid was reused by another process if it differs
+    :return: True, if the process exists, otherwise False
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return not started or (current := process_start(pid)) == 0 or current == started
+
+
+def process_tag() -> str:
+    """
+    Identify the current process in the names of its temporary files
+
+    :return: pid and start time of the process
+    """
+    return f'{os.getpid()}.{process_start(os.getpid())}'
+
+
+def tag_alive(tag: str) -> bool:
+    """
+    Check, if the process of a process_tag() is still running
+
+    :param tag: tag of process_tag() or a pid
+    :return: True, if the process exists, otherwise False
+    """
+    pid, _, started = tag.partition('.')
+
+    if not pid.isdigit() or (started and not started.isdigit()):
+        return False
+
+    return is_alive(int(pid), int(started or 0))
+
+
+def request_lock(db: sqlite3.Connection, service_id: str, holder: str) -> int:
+    """
+    Queue for the lock of a service. Tickets are granted in the order they were requested.
+
+    :param db: connection inside of a transaction
+    :param service_id: id of the locked service
+    :param holder: description of the operation, e.g. "update job <id>"
+    :return: ticket number
+    """
+    return db.execute('INSERT INTO locks (service_id, holder, pid, pid_start, requested) VALUES (?, ?, ?, ?, ?)',
+                      (service_id, holder, os.getpid(), process_start(os.getpid()), time.time())).lastrowid
+
+
+def try_acquire(db: sqlite3.Connection, ticket: int) -> bool:
+    """
+    Acquire a lock, if all earlier tickets of the service have been released
+
+    Tickets of terminated processes are released, so crashed API workers don't block a service forever.
+
+    :param db: connection inside of a transaction
+    :param ticket: ticket number of request_lock()
+    :return: True, if the ticket holds the lock
+    """
+    row = db.execute('SELECT service_id, acquired FROM locks WHERE ticket = ?', (ticket,)).fetchone()
+
+    if row is None:
+        raise KeyError(f'lock ticket {ticket} was released')
+
+    if row[1]:
+        return True
+
+    for earlier, pid, started in db.execute('SELECT ticket, pid, pid_start FROM locks WHERE service_id = ? AND '
+                                            'ticket < ? ORDER BY ticket', (row[0], ticket)).fetchall():
+        if is_alive(pid, started):
+            return False
+
+        db.execute('DELETE FROM locks WHERE ticket = ?', (earlier,))
+
+    db.execute('UPDATE locks SET acquired = ? WHERE ticket = ?', (time.time(), ticket))
+
+    return True
+
+
+def release(ticket: int, path: str | None = None):
+    """
+    Release a lock or leave its queue
+
+    :param ticket: ticket number of request_lock()
+    :param path: path of the SQLite database
+    """
+    database.execute('DELETE FROM locks WHERE ticket = ?', (ticket,), path)
+
+
+@contextmanager
+def service_lock(service_id: str, holder: str, path: str | None = None):
+    """
+    Hold the lock of a service, which is shared by all API workers, while the block executes
+
+    :param service_id: id of the locked service
+    :param holder: description of the operation
+    :param path: path of the SQLite database
+    """
+    with database.transaction(path) as db:
+        ticket = request_lock(db, service_id, holder)
+
+    try:
+        while True:
+            with database.transaction(path) as db:
+                if try_acquire(db, ticket):
+                    break
+            time.sleep(lock_poll_interval)
+
+        yield ticket
+    finally:
+        release(ticket, path)
+
+
+def lock_state(service_id: str, path: str | None = None):
+    """
+    Describe the lock of a service
+
+    :param service_id: id of the service
+    :param path: path of the SQLite database
+    :return: holder, pid and acquisition time of the lock and number of waiting operations or None, if unlocked
+    """
+    tickets = database.query('SELECT holder, pid, acquired FROM locks WHERE service_id = ? ORDER BY ticket',
+                             (service_id,), path)
+
+    if not tickets:
+        return None
+
+    holder = next((ticket for ticket in tickets if ticket['acquired']), None)
+
+    return {
+        'holder': holder['holder'] if holder else None,
+        'pid': holder['pid'] if holder else None,
+        'since': holder['acquired'] if holder else None,
+        'waiting': len(tickets) - (holder is not None)
+    }
@@ -0,0 +1,123 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from hashlib import sha256
+
+from git import Repo
+
+from service_config import database, metrics
+from tasks.image_gc import directory_size
+from tasks.locks import process_tag, service_lock, tag_alive
+
+# bare mirrors shared by the services cloned from the same remote
+mirror_dir = os.path.join('services', '.mirrors')
+
+
+def mirror_path(url_key: str) -> str:
+    """
+    Locate the mirror of a remote
+
+    :param url_key: normalized clone URL of the remote
+    :return: absolute path of the bare repository
+    """
+    return os.path.abspath(os.path.join(mirror_dir, f'{sha256(url_key.encode()).hexdigest()[:16]}.git'))
+
+
+def update_mirror(service_id: str, url: str, url_key: str, since: float = 0.0, path: str | None = None) -> str:
+    """
+    Create the mirror of a remote or fetch all its branches, unless it has been fetched since the given time.
+
+    The mirrors are shared by all API workers: concurrent updates of services cloned from the same remote wait
+    for a running fetch and reuse it. Objects are never pruned from a mirror, as the clones of the services
+    reference them.
+
+    :param service_id: id of the service requesting the update, used for the statistics
+    :param url: Git Clone URL
+    :param url_key: normalized clone URL
+    :param since: time of the request, a fetch started later contains all commits pushed before
+    :param path: path of the SQLite database
+    :raises GitCommandError: if the remote couldn't be cloned or fetched
+    :return: absolute path of the mirror
+    """
+    target = mirror_path(url_key)
+
+    with service_lock(f'mirror:{url_key}', f'mirror update of {service_id}', path):
+        fetched = database.query_one('SELECT fetched FROM mirrors WHERE url_key = ?', (url_key,), path)
+
+        if fetched and fetched[0] >= since and os.path.isdir(target):
+            logging.info(f'Mirror of {url} is up to date')
+            return target
+
+        started = time.time()
+        start = time.perf_counter()
+
+        if os.path.isdir(target):
+            size = directory_size(target)
+            Repo(target).git.fetch('--prune', 'origin')
+            operation = 'fetch'
+        else:
+            logging.info(f'Mirroring {url}...')
+            size = 0
+            os.makedirs(mirror_dir, exist_ok=True)
+            # the process tag tells the mirrors of terminated API workers apart
+            temp_path = tempfile.mkdtemp(prefix=f'{process_tag()}-', suffix='.tmp', dir=mirror_dir)
+
+            try:
+                repo = Repo.clone_from(url, temp_path, mirror=True)
+
+                with repo.config_writer() as config:
+                    config.set_value('gc', 'auto', 0)
+                    config.set_value('gc', 'pruneExpire', 'never')
+                    config.set_value('maintenance', 'auto', 'false')
+                    # blobless clones of the services request a filtered pack
+                    config.set_value('uploadpack', 'allowFilter', 'true')
+
+                os.rename(temp_path, target)
+            except Exception:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+
+            operation = 'clone'
+
+        duration = time.perf_counter() - start
+
+        database.record_stat(service_id, 'mirror', operation, duration, max(0, directory_size(target) - size), path)
+        metrics.observe('deploy_phase_duration_seconds', duration, phase='mirror')
+        database.execute('INSERT INTO mirrors (url_key, fetched) VALUES (?, ?) ON CONFLICT (url_key) DO UPDATE SET '
+                         'fetched = excluded.fetched', (url_key, started), path)
+
+    return target
+
+
+def remove_mirror(url_key: str, path: str | None = None):
+    """
+    Remove the mirror of a remote, if no service is cloned from it anymore
+
+    :param url_key: normalized clone URL
+    :param path: path of the SQLite database
+    """
+    with service_lock(f'mirror:{url_key}', 'mirror removal', path):
+        # registrations in progress may not have finished their clone yet
+        if database.query_one('SELECT 1 FROM repos WHERE url_key = ?', (url_key,), path):
+            return
+
+        if os.path.isdir(target := mirror_path(url_key)):
+            logging.info(f'Removing unused mirror {target}')
+            shutil.rmtree(target)
+
+        database.execute('DELETE FROM mirrors WHERE url_key = ?', (url_key,), path)
+
+
+def remove_stale_mirrors():
+    """
+    Remove the partial mirrors of clones interrupted by terminated API workers
+    """
+    if not os.path.isdir(mirror_dir):
+        return
+
+    for name in os.listdir(mirror_dir):
+        if name.endswith('.tmp') and not tag_alive(name.split('-')[0]):
+            logging.warning(f'Removing interrupted mirror {name}')
+            shutil.rmtree(os.path.join(mirror_dir, name), ignore_errors=True)
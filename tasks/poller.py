@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from git.cmd import Git
+from git.exc import GitCommandError
+
+from service_config import database
+from service_config.config import max_poll_backoff, poll_workers
+from tasks.exceptions import QueueFullException
+
+# seconds between two checks for due remotes
+poll_tick = 5.0
+
+# seconds a "git ls-remote" may take
+ls_remote_timeout = 60
+
+# seconds the poller lease stays valid without renewal
+lease_duration = 3 * poll_tick
+
+
+def ls_remote(url: str) -> dict:
+    """
+    Read the branch heads of a remote repository without cloning it
+
+    :param url: Git Clone URL
+    :raises GitCommandError
+    :return: dictionary with (ref name, commit) pairs, including "HEAD"
+    """
+    output = Git().ls_remote(url, 'HEAD', 'refs/heads/*', kill_after_timeout=ls_remote_timeout)
+
+    return {ref: sha for sha, ref in (line.split('\t') for line in output.splitlines() if '\t' in line)}
+
+
+def acquire_lease(name: str, holder: str, duration: float, path: str | None = None) -> bool:
+    """
+    Acquire or renew a lease, which is held by at most one API worker at a time
+
+    :param name: name of the lease
+    :param holder: id of the acquiring worker
+    :param duration: seconds the lease stays valid
+    :param path: path of the SQLite database
+    :return: True, if the worker holds the lease
+    """
+    now = time.time()
+
+    with database.transaction(path) as db:
+        current = db.execute('SELECT holder, expires FROM leases WHERE name = ?', (name,)).fetchone()
+
+        if current and current[0] != holder and current[1] > now:
+            return False
+
+        db.execute('INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                   'holder = excluded.holder, expires = excluded.expires', (name, holder, now + duration))
+
+    return True
+
+
+class Poller:
+    """
+    Background thread polling the remotes of services without webhooks.
+
+    Only the API worker holding the "poller" lease polls. Each cycle runs "git ls-remote" once per due remote,
+    even if several services share it, and queues updates of services whose deployed branch moved. Failing
+    remotes are retried with exponential backoff.
+    """
+    def __init__(self, queue_update, workers: int = poll_workers, db_path: str | None = None):
+        self.queue_update = queue_update
+        self.workers = workers
+        self.db_path = db_path
+        self.holder = f'{socket.gethostname()}:{os.getpid()}'
+        self._thread = None
+
+    def start(self):
+        """
+        Start the polling thread
+        """
+        self._thread = threading.Thread(target=self._loop, name='poller', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                if acquire_lease('poller', self.holder, lease_duration, self.db_path):
+                    self.poll()
+            # the poller must survive unavailable databases
+            except sqlite3.Error as e:
+                logging.warning(f'Polling remotes failed: {e}')
+            except Exception:
+                logging.exception('Polling remotes failed')
+
+            time.sleep(poll_tick)
+
+    def due_remotes(self, now: float) -> dict:
+        """
+        Group the polled services by remote and select the remotes due for polling
+
+        :param now: current time
+        :return: dictionary with (normalized URL, list of service rows) pairs
+        """
+        services = database.query('SELECT r.id, r.url, r.url_key, r.branch, r.commit_sha, r.failed_sha, '
+                                  'r.poll_interval, r.payload, p.polled, p.retry_at FROM repos r LEFT JOIN remotes p '
+                                  'ON r.url_key = p.url_key WHERE r.poll_interval > 0 AND r.url_key != "" AND '
+                                  'r.state NOT IN ("DELETING", "CLONING", "INITIALIZING")', path=self.db_path)
+
+        remotes = {}
+        for service in services:
+            remotes.setdefault(service['url_key'], []).append(service)
+
+        # the shortest interval of the services sharing a remote applies
+        return {url_key: services for url_key, services in remotes.items()
+                if now >= (services[0]['retry_at'] or 0) and
+                now - (services[0]['polled'] or 0) >= min(service['poll_interval'] for service in services)}
+
+    def poll(self) -> list[str]:
+        """
+        Poll all due remotes and queue updates of changed services
+
+        :return: ids of the services with queued updates
+        """
+        now = time.time()
+
+        if not (remotes := self.due_remotes(now)):
+            return []
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='poll') as executor:
+            results = dict(zip(remotes, executor.map(self._ls_remote, [services[0]['url']
+                                                                       for services in remotes.values()])))
+
+        updated = []
+
+        for url_key, services in remotes.items():
+            if (heads := results[url_key]) is None:
+                self._backoff(url_key, services, now)
+                continue
+
+            database.execute('INSERT INTO remotes (url_key, polled, failures, retry_at) VALUES (?, ?, 0, 0) '
+                             'ON CONFLICT (url_key) DO UPDATE SET polled = excluded.polled, failures = 0, '
+                             'retry_at = 0', (url_key, now), self.db_path)
+
+            for service in services:
+                head = heads.get(f'refs/heads/{service["branch"]}' if service['branch'] else 'HEAD')
+
+                # failed commits are retried by the next push or an update request
+                if head and head not in [service['commit_sha'], service['failed_sha']] and \
+                        not self._busy(service['id']):
+                    logging.info(f'{service["id"]}: remote moved to {head}, queueing update')
+                    payload = json.loads(service['payload'])
+
+                    # polled updates yield to requested deployments, the next poll retries rejected ones
+                    try:
+                        self.queue_update(service['id'], payload['files'], payload['volumes'], spooled=True,
+                                          priority_class='low')
+                    except QueueFullException as e:
+                        logging.warning(f'{service["id"]}: {e.message}')
+                        continue
+
+                    updated.append(service['id'])
+
+        return updated
+
+    def _ls_remote(self, url: str):
+        try:
+            return ls_remote(url)
+        except GitCommandError as e:
+            logging.warning(f'Polling {url} failed: {e}')
+            return None
+
+    def _backoff(self, url_key: str, services: list, now: float):
+        failures = database.query_one('SELECT failures FROM remotes WHERE url_key = ?', (url_key,), self.db_path)
+        failures = (failures[0] if failures else 0) + 1
+        delay = min(max_poll_backoff, min(service['poll_interval'] for service in services) * 2 ** failures)
+
+        database.execute('INSERT INTO remotes (url_key, polled, failures, retry_at) VALUES (?, 0, ?, ?) '
+                         'ON CONFLICT (url_key) DO UPDATE SET failures = excluded.failures, '
+                         'retry_at = excluded.retry_at', (url_key, failures, now + delay), self.db_path)
+
+    def _busy(self, service_id: str) -> bool:
+        # a queued or running job deploys the newest commit anyway
+        return database.query_one('SELECT 1 FROM jobs WHERE service_id = ? AND state IN ("QUEUED", "RUNNING")',
+                                  (service_id,), self.db_path) is not None
@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from service_config import database
+from service_config.config import default_limits, priority_classes, retry_after
+from tasks.exceptions import QueueFullException
+from tasks.locks import is_alive, process_start
+
+# seconds between the first two attempts to acquire a slot of an exhausted resource, doubled after every further
+# attempt up to max_slot_poll_interval. Slots released by the own API worker wake up its waiting threads
+# immediately, the interval bounds the delay for slots of other API workers.
+slot_poll_interval = 0.05
+max_slot_poll_interval = 1.0
+
+# seconds between two checks of a waiting request for slots of terminated processes
+stale_slot_interval = 5.0
+
+# priority class of the job executed by the current thread
+_context = threading.local()
+
+# notified whenever the API worker releases slots, counts the releases
+_released = threading.Condition()
+_releases = 0
+
+
+def limits(path: str | None = None) -> dict:
+    """
+    Load the concurrency limits, including the ones changed at runtime
+
+    :param path: path of the SQLite database
+    :return: dictionary with (limit name, value) pairs, 0 means unlimited
+    """
+    return {**default_limits, **dict(database.query('SELECT name, value FROM limits', path=path))}
+
+
+def set_limits(values: dict, path: str | None = None):
+    """
+    Change concurrency limits of all API workers
+
+    :param values: dictionary with (limit name, value) pairs
+    :param path: path of the SQLite database
+    :raises ValueError: if a limit is unknown or not a non-negative integer
+    """
+    for name, value in values.items():
+        if name not in default_limits:
+            raise ValueError(f'unknown limit {name}')
+        if type(value) is not int or value < 0:
+            raise ValueError(f'invalid value of limit {name}')
+
+    with database.transaction(path) as db:
+        db.executemany('INSERT INTO limits (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET '
+                       'value = excluded.value', values.items())
+
+
+def usage(path: str | None = None) -> dict:
+    """
+    Count the running and waiting operations per limited resource
+
+    :param path: path of the SQLite database
+    :return: dictionary with (resource, {"running": count, "waiting": count}) pairs
+    """
+    counts = {name: {'running': 0, 'waiting': 0} for name in default_limits if name != 'queue'}
+
+    for resource, acquired, count in database.query('SELECT resource, acquired IS NOT NULL, COUNT(*) FROM slots '
+                                                    'GROUP BY resource, acquired IS NOT NULL', path=path):
+        counts.setdefault(resource, {'running': 0, 'waiting': 0})['running' if acquired else 'waiting'] = count
+
+    return counts
+
+
+@contextmanager
+def priority(priority_class: str):
+    """
+    Execute a block with the given priority class, which orders the waiting slot requests of the thread
+
+    :param priority_class: element of service_config.config.priority_classes
+    """
+    previous = getattr(_context, 'priority', None)
+    _context.priority = priority_class
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority() -> str:
+    """
+    Get the priority class of the current thread
+
+    :return: priority class, "normal" outside of jobs
+    """
+    return getattr(_context, 'priority', None) or 'normal'
+
+
+def _remove_stale(db, resource: str):
+    for other, pid, started in db.execute('SELECT ticket, pid, pid_start FROM slots WHERE resource = ?',
+                                          (resource,)).fetchall():
+        if not is_alive(pid, started):
+            db.execute('DELETE FROM slots WHERE ticket = ?', (other,))
+
+
+def _is_next(db, ticket: int, resource: str, rank: int, limit: int) -> bool:
+    running = db.execute('SELECT COUNT(*) FROM slots WHERE resource = ? AND acquired IS NOT NULL',
+                         (resource,)).fetchone()[0]
+
+    if limit and running >= limit:
+        return False
+
+    # higher priority classes first, requests of the same class in order
+    return not db.execute('SELECT 1 FROM slots WHERE resource = ? AND acquired IS NULL AND (priority < ? OR '
+                          '(priority = ? AND ticket < ?))', (resource, rank, rank, ticket)).fetchone()
+
+
+def _wait_for_release(releases: int, interval: float):
+    # returns early, if a slot was released since the failed attempt
+    with _released:
+        _released.wait_for(lambda: _releases != releases, interval)
+
+
+def _notify_release():
+    global _releases
+
+    with _released:
+        _releases += 1
+        _released.notify_all()
+
+
+@contextmanager
+def slot(*resources: str, holder: str = '', priority_class: str | None = None, path: str | None = None):
+    """
+    Hold a slot of each resource while the block executes. The slots are acquired in the given order, once
+    fewer operations than the resource's limit hold one.
+
+    :param resources: limited resources, e.g. "deploys" and "builds"
+    :param holder: description of the operation
+    :param priority_class: priority class of the request, defaults to the one of the current thread
+    :param path: path of the SQLite database
+    """
+    rank = priority_classes.index(priority_class or current_priority())
+    tickets = []
+
+    try:
+        for resource in resources:
+            with database.transaction(path) as db:
+                ticket = db.execute('INSERT INTO slots (resource, priority, holder, pid, pid_start, requested) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)', (resource, rank, holder, os.getpid(),
+                                                                  process_start(os.getpid()), time.time())).lastrowid
+            tickets.append(ticket)
+            start = time.time()
+            interval = slot_poll_interval
+            swept = 0.0
+
+            while True:
+                limit = limits(path).get(resource, 0)
+                releases = _releases
+                sweep = time.time() - swept >= stale_slot_interval
+
+                # the write lock is only requested, if the slot is free, so waiting requests don't delay others
+                if sweep or _is_next(database.connect(path), ticket, resource, rank, limit):
+                    with database.transaction(path) as db:
+                        # slots of terminated processes are released
+                        if sweep:
+                            _remove_stale(db, resource)
+                            swept = time.time()
+
+                        if _is_next(db, ticket, resource, rank, limit):
+                            db.execute('UPDATE slots SET acquired = ? WHERE ticket = ?', (time.time(), ticket))
+                            break
+
+                _wait_for_release(releases, interval)
+                interval = min(interval * 2, max_slot_poll_interval)
+
+            if (waited := time.time() - start) >= 1:
+                logging.info(f'{holder} waited {waited:.1f}s for a {resource} slot')
+
+        yield
+    finally:
+        for ticket in tickets:
+            database.execute('DELETE FROM slots WHERE ticket = ?', (ticket,), path)
+
+        if tickets:
+            _notify_release()
+
+
+def admit(kind: str, service_id: str, priority_class: str, path: str | None = None, count: int = 1):
+    """
+    Check, if a deployment request can be queued.
+
+    Requests of the class "high" are always accepted, requests of the class "low" only while the queue is
+    less than half full. Updates merged into an already queued update don't extend the queue.
+
+    :param kind: kind of the job, "start" or "update"
+    :param service_id: id of the deployed service
+    :param priority_class: priority class of the request
+    :param path: path of the SQLite database
+    :param count: number of requested deployments, e.g. of a batch registration
+    :raises QueueFullException: if the request has to be rejected
+    """
+    if priority_class == 'high' or not (limit := limits(path)['queue']):
+        return
+
+    if kind == 'update' and database.query_one('SELECT 1 FROM jobs WHERE service_id = ? AND kind = "update" AND '
+                                               'state = "QUEUED"', (service_id,), path):
+        return
+
+    queued = database.query_one('SELECT COUNT(*) FROM jobs WHERE kind IN ("start", "update") AND state = "QUEUED"',
+                                path=path)[0]
+
+    if queued + count > (limit if priority_class != 'low' else limit // 2):
+        raise QueueFullException(queued, retry_after)
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from hashlib import sha256
+
+from service_config import database
+from tasks.exceptions import InvalidFilePathException
+
+# directory of the content-addressed custom files
+spool_dir = os.path.join('services', '.spool')
+
+# seconds a spooled file is kept at least, so it isn't removed between storing it and queueing its job
+gc_grace = 3600
+
+
+def store_files(files: dict, directory: str | None = None) -> dict:
+    """
+    Store the contents of custom files in the spool, so jobs only reference them
+
+    :param files: Dictionary with (file_path, file_content) pairs
+    :param directory: spool directory, defaults to services/.spool
+    :return: Dictionary with (file_path, content digest) pairs
+    """
+    directory = directory or spool_dir
+    os.makedirs(directory, exist_ok=True)
+
+    refs = {}
+
+    for file, content in files.items():
+        data = content.encode()
+        refs[file] = digest = sha256(data).hexdigest()
+        blob = os.path.join(directory, digest)
+
+        # identical contents are stored once, refreshing the modification time protects them from collection
+        try:
+            os.utime(blob)
+        except FileNotFoundError:
+            with open(f'{blob}.{os.getpid()}.{threading.get_ident()}.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(f'{blob}.{os.getpid()}.{threading.get_ident()}.tmp', blob)
+
+    return refs
+
+
+def load(digest: str, directory: str | None = None) -> bytes:
+    """
+    Read the content of a spooled file
+
+    :param digest: content digest
+    :param directory: spool directory
+    :return: content of the file
+    """
+    with open(os.path.join(directory or spool_dir, digest), 'rb') as f:
+        return f.read()
+
+
+def write_files(service_id: str, repo_path: str, refs: dict, directory: str | None = None) -> int:
+    """
+    Write spooled custom files into the repository of a service.
+
+    Files are skipped, if they have been written with the same content before and haven't been modified
+    since (e.g. by a checkout).
+
+    :param service_id: id of the service
+    :param repo_path: path of the service's repository
+    :param refs: Dictionary with (file_path, content digest) pairs
+    :param directory: spool directory
+    :raises InvalidFilePathException: if a file is outside of the repository, e.g. an absolute path
+    :return: number of written files
+    """
+    root = os.path.realpath(repo_path)
+    paths = {file: os.path.join(repo_path, file.replace('..', '.')) for file in refs}
+
+    # checked before any file is written, symlinks of the repository must not lead outside of it either
+    for file, file_path in paths.items():
+        if os.path.commonpath([root, os.path.realpath(file_path)]) != root:
+            raise InvalidFilePathException(f'{file} is outside of the repository')
+
+    written = {row['path']: row for row in database.query('SELECT path, digest, size, mtime_ns FROM custom_files '
+                                                          'WHERE service_id = ?', (service_id,))}
+    count = 0
+
+    for file, digest in refs.items():
+        file_path = paths[file]
+
+        if (previous := written.get(file)) and previous['digest'] == digest:
+            try:
+                stat = os.stat(file_path)
+                if stat.st_size == previous['size'] and stat.st_mtime_ns == previous['mtime_ns']:
+                    continue
+            except FileNotFoundError:
+                pass
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(file_path, 'wb') as f:
+            f.write(load(digest, directory))
+
+        stat = os.stat(file_path)
+        database.execute('INSERT INTO custom_files (service_id, path, digest, size, mtime_ns) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT (service_id, path) DO UPDATE SET digest = excluded.digest, '
+                         'size = excluded.size, mtime_ns = excluded.mtime_ns',
+                         (service_id, file, digest, stat.st_size, stat.st_mtime_ns))
+        count += 1
+
+    logging.info(f'{service_id}: {count} of {len(refs)} custom files written')
+
+    return count
+
+
+def collect_garbage(directory: str | None = None) -> int:
+    """
+    Remove spooled files, which are neither part of a service's latest deployment nor of an unfinished job
+
+    :param directory: spool directory
+    :return: number of removed files
+    """
+    directory = directory or spool_dir
+
+    if not os.path.isdir(directory):
+        return 0
+
+    referenced = set()
+
+    for (payload,) in database.query('SELECT payload FROM repos'):
+        referenced.update(json.loads(payload)['files'].values())
+
+    # arguments of update jobs: service id, files, volumes; of start jobs: service id, volumes, files
+    for kind, payload in database.query('SELECT kind, payload FROM jobs WHERE state IN ("QUEUED", "RUNNING")'):
+        args = json.loads(payload)
+        files = args[1] if kind == 'update' else args[2] if kind == 'start' and len(args) > 2 else None
+        referenced.update((files or {}).values())
+
+    removed = 0
+    expired = time.time() - gc_grace
+
+    for name in os.listdir(directory):
+        blob = os.path.join(directory, name)
+
+        try:
+            if name not in referenced and os.path.getmtime(blob) < expired:
+                os.remove(blob)
+                removed += 1
+        # removed by another API worker
+        except FileNotFoundError:
+            pass
+
+    return removed
@@ -1,41 +1,227 @@
-import sys
+import logging
 import os
-import sqlite3
 import subprocess
+import time
+from hashlib import sha256
+from json import dumps
+
 import docker
-import logging
 from docker.errors import APIError, BuildError, ImageNotFound
-from json import loads
+from git import Repo
+
+from service_config import database, metrics
+from tasks.build_context import BuildContext
+from tasks.compose import build_hashes, build_services, changed_services, compose_config
+from tasks.deploy_log import DeployLog, build_output
+from tasks.scheduler import slot
+
+
+def read_env(path: str):
+    """
+    Load the environment variables of a service
+
+    :param path: directory containing the Dockerfile or docker-compose.yml
+    :return: list of "KEY=value" lines of the .env file or None, if the service has no environment file
+    """
+    if '.env' not in os.listdir(path):
+        return None
+
+    with open(os.path.join(path, '.env')) as f:
+        return [line.strip('\n\r') for line in f]
+
+
+def port_bindings(port: str) -> dict:
+    """
+    Translate a port mapping into the port bindings of the Docker API
+
+    :param port: provided port mapping (e.g. "8080:80,8443:443")
+    :return: dictionary with (internal port, external port) pairs
+    """
+    ports = {}
+
+    for port_mapping in port.split(','):
+        ex_port, in_port = port_mapping.split(':')
+        ports[in_port] = ex_port
+
+    return ports
+
+
+def build_image(docker_client: docker.DockerClient, service_id: str, path: str) -> str:
+    """
+    Build the image of a service from its Dockerfile
+
+    :param docker_client: client of the Docker daemon
+    :param service_id: id of the microservice, used as image name
+    :param path: directory containing the Dockerfile
+    :raises BuildError
+    :raises APIError
+    :return: name of the built image
+    """
+    logging.info('Building local Dockerfile...')
+    # stream the build context without .git and the files excluded by .dockerignore
+    context = BuildContext(path)
+    output = []
+
+    with slot('builds', holder=f'build {service_id}'):
+        start = time.perf_counter()
+
+        # low-level API, so the output is logged while the build runs
+        for chunk in docker_client.api.build(fileobj=iter(context), custom_context=True, tag=service_id, rm=True,
+                                             decode=True):
+            output.append(chunk)
+
+            if 'stream' in chunk:
+                build_output.info(chunk['stream'].rstrip('\n'))
+            if 'error' in chunk:
+                build_output.info(chunk['error'])
+                raise BuildError(chunk['error'], output)
+
+        duration = time.perf_counter() - start
+    logging.info(f'Built {service_id} in {duration:.1f}s from a {context.size} bytes build context')
+    database.record_stat(service_id, 'build', 'docker', duration, context.size)
+    metrics.observe('deploy_phase_duration_seconds', duration, phase='build')
+    database.record_image(service_id, f'{service_id}:latest')
+
+    return f'{service_id}:latest'
+
+
+def pull_image(docker_client: docker.DockerClient, service_id: str, image: str, tag: str):
+    """
+    Pull an image and log the progress of its layers
+
+    :param docker_client: client of the Docker daemon
+    :param service_id: id of the service using the image
+    :param image: image name
+    :param tag: image tag
+    :raises APIError
+    """
+    logging.info('Pulling docker image...')
+    states = {}
+
+    with slot('pulls', holder=f'pull {image}:{tag}'), metrics.timer('deploy_phase_duration_seconds', phase='pull'):
+        for chunk in docker_client.api.pull(image, tag, stream=True, decode=True):
+            if 'error' in chunk:
+                build_output.info(chunk['error'])
+                raise APIError(chunk['error'], explanation=chunk['error'])
+
+            # progress bars are omitted, only changes of a layer's status are logged
+            if 'status' in chunk and states.get(layer := chunk.get('id')) != chunk['status']:
+                states[layer] = chunk['status']
+                build_output.info(f'{layer}: {chunk["status"]}' if layer else chunk['status'])
+
+    database.record_image(service_id, f'{image}:{tag}')
+
+
+def registry_digest(docker_client: docker.DockerClient, image: str, tag: str) -> str:
+    """
+    Resolve the digest a tag currently refers to in the registry, without pulling the image
+
+    :param docker_client: client of the Docker daemon
+    :param image: image name
+    :param tag: image tag
+    :return: digest of the image manifest, empty if the registry couldn't be queried
+    """
+    try:
+        return docker_client.images.get_registry_data(f'{image}:{tag}').id
+    except APIError as e:
+        logging.warning(f'Resolving the digest of {image}:{tag} failed: {e}')
+        return ''
+
+
+def image_digests(docker_client: docker.DockerClient, reference: str) -> set[str]:
+    """
+    Collect the registry digests of a local image
+
+    :param docker_client: client of the Docker daemon
+    :param reference: image name or id
+    :return: digests of the image, empty if it doesn't exist or wasn't pulled from a registry
+    """
+    try:
+        return {digest.split('@')[-1] for digest in docker_client.images.get(reference).attrs.get('RepoDigests') or []}
+    except ImageNotFound:
+        return set()
+
+
+def prepull_image(service_id: str, image: str, tag: str) -> str:
+    """
+    Pull an image in advance, so switching a service to it doesn't wait for the download
+
+    :param service_id: id of the service switching to the image
+    :param image: image name
+    :param tag: image tag
+    :raises APIError
+    :return: digests of the pulled image
+    """
+    docker_client = docker.from_env()
+    pull_image(docker_client, service_id, image, tag)
+
+    return ' '.join(sorted(image_digests(docker_client, f'{image}:{tag}')))
 
 
-def start_service(service_id: str, mode: str, db, cursor, port, dockerfile, tag, volumes: list[str]):
+def run_logged(command: list[str], path: str, check: bool = True) -> bytes:
+    """
+    Run a command and log its output line by line
+
+    :param command: command and arguments
+    :param path: working directory
+    :param check: raise an error, if the command fails
+    :raises subprocess.CalledProcessError: if check is set and the command fails, stderr contains the output
+    :return: combined stdout and stderr
+    """
+    output = b''
+
+    with subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+        for line in process.stdout:
+            output += line
+            build_output.info(line.decode(errors='replace').rstrip('\r\n'))
+
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output, output)
+
+    return output
+
+
+def build_compose(service_id: str, path: str):
+    """
+    Rebuild the images of the docker-compose services, whose build context or configuration changed since their
+    last build. Without a JSON rendering of the configuration (docker-compose v1), all images are rebuilt.
+
+    :param service_id: id of the microservice
+    :param path: directory containing the docker-compose.yml
+    :raises subprocess.CalledProcessError: if a build failed, stderr contains the output
+    """
+    try:
+        hashes = build_hashes(compose_config(path), path)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logging.warning(f'Reading the docker-compose configuration of {service_id} failed, rebuilding all: {e}')
+
+        with (slot('builds', holder=f'build {service_id}'),
+              metrics.timer('deploy_phase_duration_seconds', phase='build')):
+            run_logged(['docker-compose', 'build'], path)
+        return
+
+    changed = changed_services(service_id, hashes)
+    logging.info(f'Rebuilding {len(changed)} of {len(hashes)} docker-compose services of {service_id}')
+
+    build_services(service_id, path, hashes, changed)
+
+
+def start_service(service_id: str, mode: str, port, dockerfile, tag, volumes: list[str], path='.', pull=True):
     """
     Builds a docker image and starts a corresponding container
 
     :param service_id: id of the microservice
     :param mode: initialization mode
-    :param db: reference to SQLite database
-    :param cursor: cursor of db
     :param port: provided port mapping
     :param dockerfile: image from dockerhub
     :param tag: tag of dockerfile
     :param volumes: list of volume mappings
+    :param path: directory containing the Dockerfile or docker-compose.yml
+    :param pull: pull the image of a "dockerfile" service, False if the caller has already pulled it
+    :return: True, if the service has been started, otherwise False
     """
-    # service has an environment file
-    if '.env' in os.listdir():
-        # read environment variables
-        with open('.env') as f:
-            env = [line.strip('\n\r') for line in f.readlines()]
-    else:
-        env = None
-
-    ports = {}
-
-    docker_mode = mode
-    if docker_mode in ['docker', 'dockerfile']:
-        for port_mapping in port.split(','):
-            ex_port, in_port = port_mapping.split(':')
-            ports[in_port] = ex_port
+    env = read_env(path)
+    ports = port_bindings(port) if mode in ['docker', 'dockerfile'] else {}
 
     # docker image from git repository
     if mode == 'docker':
@@ -43,61 +229,60 @@ def start_service(service_id: str, mode: str, db, cursor, port, dockerfile, tag,
 
         # build docker image
         try:
-            logging.info('Building local Dockerfile...')
-            # build docker image
-            image, _ = docker_client.images.build(path='.', tag=service_id, rm=True)
+            build_image(docker_client, service_id, path)
 
             logging.info('Starting container from local Dockerfile')
             # start container
-            docker_client.containers.run(f'{service_id}:latest', detach=True, ports=ports,
-                                         name=service_id, restart_policy={'Name': 'always'}, environment=env,
-                                         volumes=volumes)
+            with metrics.timer('deploy_phase_duration_seconds', phase='run'):
+                docker_client.containers.run(f'{service_id}:latest', detach=True, ports=ports,
+                                             name=service_id, restart_policy={'Name': 'always'}, environment=env,
+                                             volumes=volumes)
 
-            cursor.execute('UPDATE repos SET state = \'RUNNING\' WHERE id = ?', (service_id,))
-            db.commit()
+            database.set_state(service_id, 'RUNNING')
 
-            with open('error.txt', 'w') as f:
+            with open(os.path.join(path, 'error.txt'), 'w') as f:
                 f.write('')
 
+            return True
+
         # image build failed
         except (APIError, BuildError) as e:
             logging.error('Build process failed!')
             logging.error(e.explanation if e is APIError else e.msg)
             # write error message
-            with open('error.txt', 'w') as f:
+            with open(os.path.join(path, 'error.txt'), 'w') as f:
                 f.write(e.explanation if e is APIError else e.msg)
 
             # set state to BUILD FAILED
-            cursor.execute('UPDATE repos SET state = \'BUILD FAILED\' WHERE id = ?', (service_id,))
-            db.commit()
+            database.set_state(service_id, 'BUILD FAILED')
 
     # docker-compose from git repository
     elif mode == 'docker-compose':
         # build docker images
         try:
             logging.info('Build from docker-compose...')
-            # build docker containers
-            subprocess.run(['docker-compose', 'build'], check=True, capture_output=True)
+            build_compose(service_id, path)
 
             logging.info('Start from docker-compose...')
-            # start services
-            subprocess.run(['docker-compose', 'up', '-d'])
-            cursor.execute('UPDATE repos SET state = \'RUNNING\' WHERE id = ?', (service_id,))
-            db.commit()
+            # start services, only containers with changed images or configuration are recreated
+            with metrics.timer('deploy_phase_duration_seconds', phase='run'):
+                run_logged(['docker-compose', 'up', '-d', '--remove-orphans'], path, check=False)
+            database.set_state(service_id, 'RUNNING')
 
-            with open('error.txt', 'w') as f:
+            with open(os.path.join(path, 'error.txt'), 'w') as f:
                 f.write('')
+
+            return True
         # build failed
         except subprocess.CalledProcessError as e:
             logging.error('Build process failed!')
             logging.error(e.stderr)
             # write error message
-            with open('error.txt', 'wb') as f:
+            with open(os.path.join(path, 'error.txt'), 'wb') as f:
                 f.write(e.stderr)
 
             # set state to BUILD FAILED
-            cursor.execute('UPDATE repos SET state = \'BUILD FAILED\' WHERE id = ?', (service_id,))
-            db.commit()
+            database.set_state(service_id, 'BUILD FAILED')
 
     # docker image from docker hub
     elif mode == 'dockerfile':
@@ -107,65 +292,130 @@ def start_service(service_id: str, mode: str, db, cursor, port, dockerfile, tag,
             # set image name and port mapping
             image_name = f'{dockerfile}:{tag}'
 
-            logging.info('Pulling docker image...')
             # pull image and start container
-            docker_client.images.pull(dockerfile, tag)
+            if pull:
+                pull_image(docker_client, service_id, dockerfile, tag)
 
             logging.info('Start container with pulled image...')
-            docker_client.containers.run(image_name, detach=True, tty=True, ports=ports,
-                                         name=service_id, restart_policy={'Name': 'always'}, environment=env,
-                                         volumes=volumes)
+            with metrics.timer('deploy_phase_duration_seconds', phase='run'):
+                docker_client.containers.run(image_name, detach=True, tty=True, ports=ports,
+                                             name=service_id, restart_policy={'Name': 'always'}, environment=env,
+                                             volumes=volumes)
 
-            cursor.execute('UPDATE repos SET state = \'RUNNING\' WHERE id = ?', (service_id,))
-            db.commit()
+            database.set_state(service_id, 'RUNNING')
 
-            with open('error.txt', 'w') as f:
+            with open(os.path.join(path, 'error.txt'), 'w') as f:
                 f.write('')
+
+            return True
         # image pull failed
         except (APIError, ImageNotFound) as e:
             logging.error('docker pull failed!')
             logging.error(e)
             # write error message
-            with open('error.txt', 'w') as f:
+            with open(os.path.join(path, 'error.txt'), 'w') as f:
                 f.write(e.explanation)
 
             # set state to BUILD failed
-            cursor.execute('UPDATE repos SET state = \'BUILD FAILED\' WHERE id = ?', (service_id,))
-            db.commit()
+            database.set_state(service_id, 'BUILD FAILED')
 
+    return False
 
-if __name__ == '__main__':
-    # load service id, initialization mode, docker directory and port mapping
-    s_id = sys.argv[1]
-    docker_mode = sys.argv[2]
-    docker_directory = sys.argv[3]
 
-    if docker_mode in ['docker', 'dockerfile']:
-        p = sys.argv[4]
+def deploy_fingerprint(service_id: str, files: dict, volumes: list[str], digest: str = '') -> tuple[str, str]:
+    """
+    Hash everything a deployment depends on: the checked out commit, the custom files and the configuration
 
-        if docker_mode == 'dockerfile':
-            docker_file = sys.argv[5]
-            docker_tag = sys.argv[6]
-        else:
-            docker_file = None
-            docker_tag = None
-    else:
-        p = '.'
-        docker_file = None
-        docker_tag = None
+    :param service_id: id of the microservice
+    :param files: Dictionary with (file_path, content digest) pairs of spooled files
+    :param volumes: list of volume mappings
+    :param digest: registry digest of the deployed image in "dockerfile" mode
+    :return: fingerprint and checked out commit (empty without git repository)
+    """
+    config = database.query_one('SELECT mode, port, docker_root, image, tag FROM repos WHERE id = ?', (service_id,))
+    repo_path = os.path.join('services', service_id)
+
+    commit = Repo(repo_path).head.commit.hexsha if os.path.exists(os.path.join(repo_path, '.git')) else ''
+    content = {'commit': commit, 'files': files, 'volumes': volumes, 'config': list(config)}
 
-    volume_mapping = loads(sys.argv[7])
+    # fingerprints of deployments without pulled images stay valid
+    if digest:
+        content['digest'] = digest
 
-    base_path = os.getcwd()
+    content = dumps(content, sort_keys=True)
 
-    with sqlite3.connect(os.path.join('services', 'services.db')) as database:
-        os.chdir(os.path.join(base_path, 'services', s_id, docker_directory))
-        db_cursor = database.cursor()
+    return sha256(content.encode()).hexdigest(), commit
 
-        # check if service exists
-        db_cursor.execute('SELECT url FROM repos WHERE id = ?', (s_id,))
 
-        if fetch_url := db_cursor.fetchone():
-            start_service(s_id, docker_mode, database, db_cursor, p, docker_file, docker_tag, volume_mapping)
+def store_fingerprint(service_id: str, fingerprint: str, commit: str):
+    """
+    Remember the fingerprint and commit of the last successful deployment
+
+    :param service_id: id of the microservice
+    :param fingerprint: fingerprint of the deployment
+    :param commit: deployed commit
+    """
+    database.execute('UPDATE repos SET fingerprint = ?, commit_sha = ?, failed_sha = "" WHERE id = ?',
+                     (fingerprint, commit, service_id))
+
+
+def store_failure(service_id: str, commit: str):
+    """
+    Remember the commit of a failed deployment, which pushes and polling don't deploy again. The next update
+    rebuilds the service.
+
+    :param service_id: id of the microservice
+    :param commit: commit, which failed to deploy
+    """
+    database.execute('UPDATE repos SET fingerprint = "", failed_sha = ? WHERE id = ?', (commit, service_id))
+
 
-        os.chdir(base_path)
+def store_payload(service_id: str, files: dict, volumes: list[str]):
+    """
+    Remember the custom files and volumes of the latest deployment, which are reused by webhook updates
+
+    :param service_id: id of the microservice
+    :param files: Dictionary with (file_path, content digest) pairs of spooled files
+    :param volumes: list of volume mappings
+    """
+    database.execute('UPDATE repos SET payload = ? WHERE id = ?',
+                     (dumps({'files': files, 'volumes': volumes}), service_id))
+
+
+def launch_service(service_id: str, volumes: list[str], files=None):
+    """
+    Start the container(s) of a registered service
+
+    :param service_id: id of the microservice
+    :param volumes: list of volume mappings
+    :param files: spooled custom files written at the registration
+    :return: resulting state of the service
+    """
+    # check if service exists
+    if service := database.query_one('SELECT mode, docker_root, port, image, tag FROM repos WHERE id = ?',
+                                     (service_id,)):
+        mode, docker_root, port, image, tag = service
+        path = os.path.join('services', service_id, docker_root)
+        # updates compare the digest the tag refers to with the one of the first deployment
+        digest = registry_digest(docker.from_env(), image, tag) if mode == 'dockerfile' else ''
+        fingerprint, commit = deploy_fingerprint(service_id, files or {}, volumes, digest)
+        store_payload(service_id, files or {}, volumes)
+
+        with DeployLog(service_id):
+            build_output.info(f'Deploying {service_id} {commit}'.rstrip())
+
+            # waits, while too many deployments run
+            with slot('deploys', f'deploys:{mode}', holder=f'start {service_id}'):
+                started = start_service(service_id, mode, port, image, tag, volumes, path)
+
+            if started:
+                store_fingerprint(service_id, fingerprint, commit)
+                state = 'RUNNING'
+            else:
+                store_failure(service_id, commit)
+                state = 'BUILD FAILED'
+
+            build_output.info(f'Deployment finished: {state}')
+
+        metrics.increment('deployments_total', kind='start', state=state)
+        return state
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+
+import docker
+from docker.errors import DockerException, NotFound
+from requests.exceptions import RequestException
+
+# container status after a Docker event, None removes the container from the cache
+event_states = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+    'stop': 'exited',
+    'destroy': None
+}
+
+# seconds to wait before reconnecting to a lost event stream
+reconnect_delay = 5.0
+
+
+class StatusCache:
+    """
+    In-memory container states kept up to date by a background subscriber to the Docker events stream.
+
+    While the subscriber is connected, lookups are answered without contacting the Docker daemon. Otherwise,
+    the state is fetched live.
+    """
+    def __init__(self):
+        self._states = {}
+        self._errors = {}
+        self._synced = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._client = None
+
+    def start(self):
+        """
+        Start the event subscriber, if it isn't running yet
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='docker-events', daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                client = docker.from_env()
+                # subscribe before listing the containers, so no event between both calls is lost
+                events = client.events(decode=True, filters={'type': 'container'})
+                states = {container.name: container.status for container in client.containers.list(all=True)}
+
+                with self._lock:
+                    self._states = states
+                    self._synced = True
+
+                for event in events:
+                    self.apply(event)
+            # the daemon may be restarted or unavailable at all
+            except (DockerException, RequestException) as e:
+                logging.warning(f'Docker event stream unavailable: {e}')
+            except Exception:
+                logging.exception('Docker event stream failed')
+
+            with self._lock:
+                self._synced = False
+
+            time.sleep(reconnect_delay)
+
+    def apply(self, event: dict):
+        """
+        Update the cache with a container event
+
+        :param event: decoded event of the Docker events stream
+        """
+        action = event.get('Action', '')
+        attributes = event.get('Actor', {}).get('Attributes', {})
+
+        if not (name := attributes.get('name')):
+            return
+
+        with self._lock:
+            if action == 'rename':
+                old_name = attributes.get('oldName', '').lstrip('/')
+                if old_name in self._states:
+                    self._states[name] = self._states.pop(old_name)
+            elif action in event_states:
+                if (state := event_states[action]) is None:
+                    self._states.pop(name, None)
+                else:
+                    self._states[name] = state
+
+    def status(self, container_name: str) -> str:
+        """
+        Get the status of a container
+
+        :param container_name: name of the container
+        :raises NotFound: if the container doesn't exist
+        :return: Docker status of the container (e.g. "running")
+        """
+        with self._lock:
+            if self._synced:
+                if container_name in self._states:
+                    return self._states[container_name]
+                raise NotFound(f'Container {container_name} not found')
+
+        # cache miss, subscriber not connected
+        if self._client is None:
+            self._client = docker.from_env()
+
+        return self._client.containers.get(container_name).status
+
+    def snapshot(self) -> dict:
+        """
+        Get the status of all containers with at most one request to the Docker daemon
+
+        :return: dictionary with (container name, Docker status) pairs
+        """
+        with self._lock:
+            if self._synced:
+                return dict(self._states)
+
+        # cache miss, subscriber not connected
+        if self._client is None:
+            self._client = docker.from_env()
+
+        return {container.name: container.status for container in self._client.containers.list(all=True)}
+
+    def errors(self, path: str) -> str:
+        """
+        Read an error file, which is only reloaded after it has been modified
+
+        :param path: path of the error file
+        :return: content of the file, empty if it doesn't exist yet
+        """
+        # written by the first deployment, e.g. after the clone of a new service
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return ''
+
+        with self._lock:
+            if path in self._errors and self._errors[path][0] == modified:
+                return self._errors[path][1]
+
+        try:
+            with open(path) as f:
+                content = f.read()
+        # removed together with its service
+        except FileNotFoundError:
+            return ''
+
+        with self._lock:
+            self._errors[path] = (modified, content)
+
+        return content
@@ -1,85 +1,198 @@
-import sys
-import sqlite3
+import logging
 import os
-from git.repo import Repo
-from json import loads
 import subprocess
-from start_service import start_service
-import docker
-from docker.errors import NotFound
-import logging
 
-
-def stop_service(docker_mode: str, s_id: str):
+import docker
+from docker.errors import APIError, ImageNotFound, NotFound
+
+from service_config import database, metrics
+from tasks.blue_green import replace_service
+from tasks.clone import fetch_repository
+from tasks.deploy_log import DeployLog, build_output
+from tasks.jobs import requested_at
+from tasks.mirror import update_mirror
+from tasks.scheduler import slot
+from tasks.spool import write_files
+from tasks.start_service import (
+    deploy_fingerprint,
+    image_digests,
+    pull_image,
+    registry_digest,
+    start_service,
+    store_failure,
+    store_fingerprint,
+    store_payload,
+)
+
+
+def stop_service(docker_mode: str, s_id: str, path='.'):
     """
     Stops a docker container
 
     :param docker_mode: initialization mode
     :param s_id: microservice id
+    :param path: directory containing the docker-compose.yml
+    """
+    with metrics.timer('deploy_phase_duration_seconds', phase='stop'):
+        # single dockerfile used
+        if docker_mode in ['docker', 'dockerfile']:
+            docker_client = docker.from_env()
+
+            try:
+                logging.info(f'Stopping container {s_id}')
+                # get, stop and remove container
+                container = docker_client.containers.get(s_id)
+                container.stop()
+                container.remove()
+            # container doesn't exist
+            except NotFound:
+                logging.warning(f'Container {s_id} not found!')
+        # docker-compose used
+        elif docker_mode == 'docker-compose':
+            logging.info('Stopping containers with docker-compose')
+            subprocess.run(['docker-compose', 'down'], cwd=path, check=False)
+
+
+def _container_running(docker_mode: str, s_id: str):
     """
-    # single dockerfile used
-    if docker_mode in ['docker', 'dockerfile']:
-        docker_client = docker.from_env()
+    Check, if the container of a service is still running
 
-        try:
-            logging.info(f'Stopping container {s_id}')
-            # get, stop and remove container
-            container = docker_client.containers.get(s_id)
-            container.stop()
-            container.remove()
-        # container doesn't exist
-        except NotFound:
-            logging.warning(f'Container {s_id} not found!')
-    # docker-compose used
-    elif docker_mode == 'docker-compose':
-        logging.info('Stopping containers with docker-compose')
-        subprocess.run(['docker-compose', 'down'])
+    :param docker_mode: initialization mode
+    :param s_id: microservice id
+    :return: False, if the container of a single container service isn't running, otherwise True
+    """
+    if docker_mode not in ['docker', 'dockerfile']:
+        return True
 
+    try:
+        return docker.from_env().containers.get(s_id).status == 'running'
+    except NotFound:
+        return False
 
-if __name__ == '__main__':
-    base_dir = os.getcwd()
 
-    service_id = sys.argv[1]
+def _running_digests(s_id: str) -> set[str]:
+    """
+    Collect the registry digests of the image of a service's container
 
-    if file_string := sys.argv[2]:
-        files = loads(file_string)
-    else:
-        files = {}
+    :param s_id: microservice id
+    :return: digests of the running image, empty if the container doesn't exist
+    """
+    docker_client = docker.from_env()
 
-    volumes = loads(sys.argv[3])
+    try:
+        return image_digests(docker_client, docker_client.containers.get(s_id).attrs['Image'])
+    except NotFound:
+        return set()
 
-    with sqlite3.connect('services/services.db') as db:
-        cursor = db.cursor()
 
-        # check, if service exists
-        cursor.execute('SELECT docker_root, mode, port, image, tag FROM repos WHERE id = ?', (service_id,))
+def _pull(s_id: str, image: str, tag: str, path: str) -> bool:
+    """
+    Pull the image of a "dockerfile" service before its container is stopped
+
+    :param s_id: microservice id
+    :param image: image name
+    :param tag: image tag
+    :param path: directory of the service's error.txt
+    :return: True, if the image has been pulled
+    """
+    try:
+        pull_image(docker.from_env(), s_id, image, tag)
+        return True
+    except (APIError, ImageNotFound) as e:
+        logging.error(f'Pulling {image}:{tag} for {s_id} failed, keeping the running container: {e}')
 
-        # service exists
-        if service := cursor.fetchone():
-            cursor.execute('UPDATE repos SET state = \'UPDATING\' WHERE id = ?', (service_id,))
-            db.commit()
+        with open(os.path.join(path, 'error.txt'), 'w') as f:
+            f.write(e.explanation or str(e))
 
-            # pull the newest commits from remote server
-            if os.path.exists(f'services/{service_id}/.git'):
-                repo = Repo(f'services/{service_id}/.git')
-                repo.head.reset('--hard')
-                repo.remote('origin').pull()
+        database.set_state(s_id, 'BUILD FAILED')
+        return False
 
-            # update custom files
-            for file in files:
-                file_path = f'services/{service_id}/{file.replace("..", ".")}'
 
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    
-                with open(file_path, 'w') as f:
-                    f.write(files[file])
+def update_repository(service_id: str, files: dict, volumes: list[str]):
+    """
+    Pull the newest commits of a service, update its custom files and rebuild its containers.
 
-            os.chdir(f'services/{service_id}/{service[0]}')
+    Services with the "blue-green" update strategy are replaced without stopping them during the build. The
+    rebuild is skipped, if commit, custom files and configuration match the last successful deployment.
 
-            mode = service[1]
+    :param service_id: microservice id
+    :param files: Dictionary with (file_path, content digest) pairs of spooled files
+    :param volumes: list of volume mappings
+    :return: resulting state of the service or "NO CHANGE"
+    """
+    # check, if service exists
+    service = database.query_one('SELECT docker_root, mode, port, image, tag, clone_strategy, branch, state, '
+                                 'fingerprint, update_strategy, url, url_key, mirror FROM repos WHERE id = ?',
+                                 (service_id,))
 
-            # build new images and containers
-            stop_service(mode, service_id)
-            start_service(service_id, mode, db, cursor, service[2], service[3], service[4], volumes)
+    # service exists
+    if service:
+        with DeployLog(service_id):
+            state = _update(service_id, service, files, volumes)
+            build_output.info(f'Deployment finished: {state}')
 
-            os.chdir(base_dir)
+        metrics.increment('deployments_total', kind='update', state=state)
+        return state
+
+
+def _update(service_id: str, service, files: dict, volumes: list[str]) -> str:
+    """
+    Deploy the newest state of an existing service
+
+    :param service_id: microservice id
+    :param service: row of the service's configuration
+    :param files: Dictionary with (file_path, content digest) pairs of spooled files
+    :param volumes: list of volume mappings
+    :return: resulting state of the service or "NO CHANGE"
+    """
+    # fetch the newest commit of the deployed branch from remote server
+    if os.path.exists(f'services/{service_id}/.git'):
+        # the mirror is fetched once for all services cloned from the same remote, the clone fetches from it
+        if service[12]:
+            update_mirror(service_id, service[10], service[11], requested_at())
+
+        fetch_repository(service_id, f'services/{service_id}', service[5], service[6])
+
+    # update changed custom files
+    write_files(service_id, f'services/{service_id}', files)
+
+    path = f'services/{service_id}/{service[0]}'
+    mode = service[1]
+
+    # image the tag currently refers to, a moved tag requires a new container
+    digest = registry_digest(docker.from_env(), service[3], service[4]) if mode == 'dockerfile' else ''
+
+    fingerprint, commit = deploy_fingerprint(service_id, files, volumes, digest)
+    store_payload(service_id, files, volumes)
+    build_output.info(f'Deploying {service_id} {commit or digest}'.rstrip())
+
+    # identical to the running deployment
+    if fingerprint == service[8] and service[7] == 'RUNNING' and _container_running(mode, service_id) and \
+            (not digest or digest in _running_digests(service_id)):
+        build_output.info(f'{service_id} unchanged, skipping rebuild')
+        return 'NO CHANGE'
+
+    # waits, while too many deployments run
+    with slot('deploys', f'deploys:{mode}', holder=f'update {service_id}'):
+        database.set_state(service_id, 'UPDATING')
+
+        # keep the old container running until its replacement is ready
+        if service[9] == 'blue-green' and mode in ['docker', 'dockerfile']:
+            started = replace_service(service_id, mode, service[2], service[3], service[4], volumes, path)
+        # "docker-compose up" recreates only the containers with changed images or configuration
+        elif mode == 'docker-compose':
+            started = start_service(service_id, mode, service[2], service[3], service[4], volumes, path)
+        # the service keeps running while the image is downloaded or if the pull fails
+        elif mode == 'dockerfile' and not _pull(service_id, service[3], service[4], path):
+            started = False
+        else:
+            # build new images and containers, the image of a "dockerfile" service has already been pulled
+            stop_service(mode, service_id, path)
+            started = start_service(service_id, mode, service[2], service[3], service[4], volumes, path, pull=False)
+
+    if started:
+        store_fingerprint(service_id, fingerprint, commit)
+        return 'RUNNING'
+
+    store_failure(service_id, commit)
+    return 'BUILD FAILED'
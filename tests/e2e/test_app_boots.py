@@ -2,6 +2,7 @@
 import importlib
 import json
 import os
+import sqlite3
 import sys
 
 import pytest
@@ -16,6 +17,9 @@ def test_app_boots_and_lists_services(tmp_path, monkeypatch):
     with open(os.path.join("services", "api-keys.json"), "w") as f:
         json.dump(["e2e-key"], f)
 
+    # background threads of earlier imports would follow the working directory into later tests
+    monkeypatch.setattr("service_config.config.poll_workers", 0)
+    monkeypatch.setattr("service_config.config.gc_interval", 0)
     sys.modules.pop("app", None)
     app_module = importlib.import_module("app")
 
@@ -26,3 +30,26 @@ def test_app_boots_and_lists_services(tmp_path, monkeypatch):
     resp = client.get("/service")
     assert resp.status_code == 200
     assert resp.get_json() == []
+
+
+def test_app_allocates_ports_of_existing_services(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("services")
+    with open(os.path.join("services", "api-keys.json"), "w") as f:
+        json.dump(["e2e-key"], f)
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        db.execute(
+            "CREATE TABLE repos(id TEXT PRIMARY KEY, url TEXT, mode TEXT, state TEXT,"
+            " port TEXT, docker_root TEXT, image TEXT, tag TEXT)"
+        )
+        db.execute("INSERT INTO repos VALUES ('svc', '', 'dockerfile', 'RUNNING', '8080:80', '.', 'img', 'tag')")
+        db.commit()
+
+    # background threads of earlier imports would follow the working directory into later tests
+    monkeypatch.setattr("service_config.config.poll_workers", 0)
+    monkeypatch.setattr("service_config.config.gc_interval", 0)
+    sys.modules.pop("app", None)
+    app_module = importlib.import_module("app")
+
+    resp = app_module.app.test_client().get("/ports/free?start=8079&end=8081")
+    assert resp.get_json() == [[8079, 8079], [8081, 8081]]
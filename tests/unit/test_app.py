@@ -5,35 +5,50 @@ to the current working directory, so the fixture first chdir's into a temp dir
 and seeds a known API key. We exercise only the validation / routing branches
 that don't shell out to git or docker.
 """
+import hashlib
+import hmac
 import importlib
 import json
 import os
+import sqlite3
 import sys
+import threading
+import time
 
+import docker
 import pytest
 
+from tasks import locks
+
 API_KEY = "test-key"
 
 
+def _import_app(monkeypatch):
+    # background threads of earlier imports would follow the working directory into later tests
+    monkeypatch.setattr("service_config.config.poll_workers", 0)
+    monkeypatch.setattr("service_config.config.gc_interval", 0)
+
+    sys.modules.pop("app", None)
+    return importlib.import_module("app")
+
+
 @pytest.fixture
 def client(tmp_path, monkeypatch):
     monkeypatch.chdir(tmp_path)
     os.mkdir("services")
-    # a placeholder file so the GET /service listing (which strips .gitkeep) works
+    # mirrors the placeholder file of the shipped services/ directory
     open(os.path.join("services", ".gitkeep"), "w").close()
     with open(os.path.join("services", "api-keys.json"), "w") as f:
         json.dump([API_KEY], f)
 
     # ensure a fresh import so module-level setup runs against this temp dir
-    sys.modules.pop("app", None)
-    app_module = importlib.import_module("app")
+    app_module = _import_app(monkeypatch)
     app_module.app.config.update(TESTING=True)
     return app_module.app.test_client()
 
 
-def test_check_volumes_validation():
-    sys.modules.pop("app", None)
-    import app as app_module
+def test_check_volumes_validation(monkeypatch):
+    app_module = _import_app(monkeypatch)
     from tasks.exceptions import InvalidVolumeMappingException
 
     # valid mapping passes silently
@@ -83,6 +98,13 @@ def test_register_invalid_volume_mapping(client):
     assert b"Volume" in resp.data or b"mapping" in resp.data
 
 
+@pytest.mark.parametrize("files", [None, [], {"a.conf": 1}])
+def test_register_invalid_files(client, files):
+    resp = client.post("/service", json={"API-KEY": API_KEY, "mode": "docker-compose", "files": files})
+    assert resp.status_code == 400
+    assert resp.data == b"Custom files object expected"
+
+
 def test_get_unknown_service_returns_404(client):
     resp = client.get("/service/does-not-exist")
     assert resp.status_code == 404
@@ -109,18 +131,17 @@ def test_service_trailing_slash_redirects(client):
 @pytest.fixture
 def registered(tmp_path, monkeypatch):
     """A booted app with one service row + workspace, plus the app module so
-    tests can stub out subprocess/docker side effects."""
-    import sqlite3
-
+    tests can stub out background-task/docker side effects."""
     monkeypatch.chdir(tmp_path)
     os.mkdir("services")
     open(os.path.join("services", ".gitkeep"), "w").close()
     with open(os.path.join("services", "api-keys.json"), "w") as f:
         json.dump([API_KEY], f)
 
-    sys.modules.pop("app", None)
-    app_module = importlib.import_module("app")
+    app_module = _import_app(monkeypatch)
     app_module.app.config.update(TESTING=True)
+    # execute updates immediately instead of waiting for further requests
+    app_module.runner.debounce = 0
 
     # register a service directly in the DB
     os.makedirs(os.path.join("services", "svc1"), exist_ok=True)
@@ -128,54 +149,121 @@ def registered(tmp_path, monkeypatch):
         f.write("no errors")
     with sqlite3.connect(os.path.join("services", "services.db")) as db:
         db.execute(
-            "INSERT INTO repos VALUES ('svc1', 'http://x/y.git', 'docker',"
-            " 'RUNNING', '8080:80', '.', 'img', 'tag')"
+            "INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag)"
+            " VALUES ('svc1', 'http://x/y.git', 'docker', 'RUNNING', '8080:80', '.', 'img', 'tag')"
         )
+        db.execute("INSERT INTO port_mappings VALUES ('svc1', 8080, 80)")
         db.commit()
 
     return app_module, app_module.app.test_client()
 
 
+def _wait_for_job(client, job_id):
+    for _ in range(100):
+        job = client.get(f"/job/{job_id}").get_json()
+        if job["state"] in ("DONE", "FAILED"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
 def test_post_update_initiates_background_task(registered, monkeypatch):
     app_module, client = registered
     calls = []
-    monkeypatch.setattr(app_module.subprocess, "Popen", lambda *a, **k: calls.append(a))
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: calls.append(a))
     resp = client.post("/service/svc1", json={"API-KEY": API_KEY, "volumes": ["data:/data", ""]})
     assert resp.status_code == 200
-    assert b"Update initiated" in resp.data
-    assert calls  # background update was spawned
+    data = resp.get_json()
+    assert data["state"] == "Update initiated"
+    assert _wait_for_job(client, data["job"])["state"] == "DONE"
+    assert calls == [("svc1", {}, ["data:/data"])]  # background update was executed
 
 
 def test_post_update_rejects_invalid_volumes(registered, monkeypatch):
     app_module, client = registered
-    monkeypatch.setattr(app_module.subprocess, "Popen", lambda *a, **k: None)
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
     resp = client.post("/service/svc1", json={"API-KEY": API_KEY, "volumes": ["bad"]})
     assert resp.status_code == 400
 
 
 def test_patch_updates_port_and_restarts(registered, monkeypatch):
     app_module, client = registered
-    monkeypatch.setattr(app_module.subprocess, "Popen", lambda *a, **k: None)
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
     resp = client.patch("/service/svc1", json={"API-KEY": API_KEY, "port": "9090:90"})
     assert resp.status_code == 200
-    assert b"patched and restarted" in resp.data
+    assert "patched and restarted" in resp.get_json()["state"]
 
 
-def test_delete_service(registered, monkeypatch):
+def test_patch_rejects_invalid_volumes(registered, monkeypatch):
     app_module, client = registered
+    calls = []
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: calls.append(a))
 
-    class _Done:
-        returncode = 0
+    for volumes in [None, ["bad"]]:
+        resp = client.patch("/service/svc1", json={"API-KEY": API_KEY, "tag": "2.0", "volumes": volumes})
+        assert resp.status_code == 400
+    # the configuration is only changed together with the restart
+    assert app_module.database.query_one("SELECT tag FROM repos WHERE id = 'svc1'")[0] != "2.0"
 
-    monkeypatch.setattr(app_module.subprocess, "run", lambda *a, **k: _Done())
-    resp = client.delete("/service/svc1", json={"API-KEY": API_KEY})
+    resp = client.patch("/service/svc1", json={"API-KEY": API_KEY, "volumes": ["data:/data", ""]})
     assert resp.status_code == 200
-    assert b"removed" in resp.data
+    _wait_for_job(client, resp.get_json()["job"])
+    assert calls == [("svc1", {}, ["data:/data"])]
 
 
-def test_get_service_state_build_failed(registered, monkeypatch):
+def test_failed_job_reports_error(registered, monkeypatch):
     app_module, client = registered
 
+    def _fail(*_):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app_module, "update_repository", _fail)
+    resp = client.post("/service/svc1", json={"API-KEY": API_KEY})
+    job = _wait_for_job(client, resp.get_json()["job"])
+    assert job["state"] == "FAILED"
+    assert job["error"] == "boom"
+
+
+def test_job_queue_depth(registered):
+    _, client = registered
+    resp = client.get("/job")
+    assert resp.status_code == 200
+    assert resp.get_json()["queued"] == 0
+
+
+def test_unknown_job_returns_404(client):
+    resp = client.get("/job/missing")
+    assert resp.status_code == 404
+
+
+def test_delete_service_runs_in_background(registered, monkeypatch):
+    app_module, client = registered
+    calls = []
+    release = threading.Event()
+
+    def _delete(service_id):
+        release.wait(5)
+        calls.append(service_id)
+
+    monkeypatch.setattr(app_module, "delete_repository", _delete)
+    resp = client.delete("/service/svc1", json={"API-KEY": API_KEY})
+    assert resp.status_code == 202
+    job_id = resp.get_json()["job"]
+    assert resp.get_json()["state"] == "DELETING"
+
+    # the running deletion is reported until it has finished
+    assert client.get("/service/svc1").get_json() == {"id": "svc1", "job": job_id, "state": "DELETING"}
+    assert client.delete("/service/svc1", json={"API-KEY": API_KEY}).get_json()["job"] == job_id
+    assert client.post("/service/svc1", json={"API-KEY": API_KEY}).status_code == 409
+
+    release.set()
+    assert _wait_for_job(client, job_id)["state"] == "DONE"
+    assert calls == ["svc1"]
+
+
+def test_get_service_state_build_failed(registered, monkeypatch):
+    _, client = registered
+
     class _FakeClient:
         class containers:
             @staticmethod
@@ -183,9 +271,415 @@ def test_get_service_state_build_failed(registered, monkeypatch):
                 from docker.errors import NotFound
                 raise NotFound("missing")
 
-    monkeypatch.setattr(app_module.docker, "from_env", lambda: _FakeClient())
+    monkeypatch.setattr(docker, "from_env", lambda: _FakeClient())
     resp = client.get("/service/svc1")
     assert resp.status_code == 200
     data = resp.get_json()
     assert data["state"] == "BUILD FAILED"
     assert data["id"] == "svc1"
+
+
+def test_patch_rejects_port_of_other_service(registered, monkeypatch):
+    app_module, client = registered
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        db.execute("INSERT INTO port_mappings VALUES ('svc2', 9090, 90)")
+        db.commit()
+
+    resp = client.patch("/service/svc1", json={"API-KEY": API_KEY, "port": "9090:90"})
+    assert resp.status_code == 400
+    # the service keeps its previous allocation
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        assert db.execute("SELECT port FROM repos WHERE id = 'svc1'").fetchone() == ("8080:80",)
+
+
+def test_free_ports(registered):
+    _, client = registered
+    resp = client.get("/ports/free?start=8000&end=8100")
+    assert resp.status_code == 200
+    assert resp.get_json() == [[8000, 8079], [8081, 8100]]
+
+
+def test_get_service_state_from_event_cache(registered, monkeypatch):
+    app_module, client = registered
+
+    def _no_daemon():
+        raise AssertionError("daemon contacted")
+
+    monkeypatch.setattr(docker, "from_env", _no_daemon)
+    monkeypatch.setattr(app_module.status_cache, "start", lambda: None)
+    app_module.status_cache._synced = True
+    app_module.status_cache.apply({"Action": "start", "Actor": {"Attributes": {"name": "svc1"}}})
+
+    resp = client.get("/service/svc1")
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["state"] == "RUNNING"
+    assert data["errors"] == "no errors"
+    assert data["lock"] is None
+
+    # the holder of the service's lock is visible to every API worker
+    with app_module.database.transaction() as db:
+        locks.try_acquire(db, locks.request_lock(db, "svc1", "update job 1"))
+    assert client.get("/service/svc1").get_json()["lock"]["holder"] == "update job 1"
+
+
+@pytest.fixture
+def many_services(registered):
+    app_module, client = registered
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        for i, (mode, state) in enumerate([("docker-compose", "RUNNING"), ("dockerfile", "BUILD FAILED"),
+                                           ("dockerfile", "RUNNING")], start=2):
+            db.execute("INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag)"
+                       " VALUES (?, '', ?, ?, '', '.', '', '')", (f"svc{i}", mode, state))
+        db.commit()
+    return app_module, client
+
+
+def test_list_services_from_database(many_services):
+    _, client = many_services
+    resp = client.get("/service")
+    assert resp.get_json() == ["svc1", "svc2", "svc3", "svc4"]
+    assert "Link" not in resp.headers
+
+
+def test_list_services_filters(many_services):
+    _, client = many_services
+    assert client.get("/service?mode=dockerfile").get_json() == ["svc3", "svc4"]
+    assert client.get("/service?state=RUNNING&mode=dockerfile").get_json() == ["svc4"]
+
+
+def test_list_services_pagination(many_services):
+    _, client = many_services
+    resp = client.get("/service?limit=3&mode=docker-compose")
+    assert resp.get_json() == ["svc2"]
+    assert "Link" not in resp.headers
+
+    resp = client.get("/service?limit=3")
+    assert resp.get_json() == ["svc1", "svc2", "svc3"]
+    assert resp.headers["Link"] == '</service?limit=3&cursor=svc3>; rel="next"'
+
+    resp = client.get("/service?limit=3&cursor=svc3")
+    assert resp.get_json() == ["svc4"]
+    assert "Link" not in resp.headers
+
+
+def test_list_services_expanded_states_use_single_listing(many_services, monkeypatch):
+    app_module, client = many_services
+    listings = []
+
+    class _Container:
+        def __init__(self, name, status):
+            self.name = name
+            self.status = status
+
+    class _FakeClient:
+        class containers:
+            @staticmethod
+            def list(all=False):
+                listings.append(all)
+                return [_Container("svc1", "running"), _Container("svc4", "exited")]
+
+    monkeypatch.setattr(docker, "from_env", lambda: _FakeClient())
+    monkeypatch.setattr(app_module.status_cache, "start", lambda: None)
+
+    resp = client.get("/service?expand=state&mode=docker")
+    assert resp.get_json() == [{"id": "svc1", "mode": "docker", "registration": "RUNNING", "state": "RUNNING"}]
+
+    resp = client.get("/service?expand=state")
+    states = {service["id"]: service["state"] for service in resp.get_json()}
+    assert states == {"svc1": "RUNNING", "svc2": "BUILD FAILED", "svc3": "BUILD FAILED", "svc4": "EXITED"}
+    assert listings == [True, True]
+
+
+def test_register_unsupported_clone_strategy(client):
+    resp = client.post("/service", json={"API-KEY": API_KEY, "mode": "docker-compose", "clone_strategy": "bogus"})
+    assert resp.status_code == 400
+    assert b"unsupported clone strategy" in resp.data
+
+
+def test_stats_aggregate_per_operation(registered):
+    app_module, client = registered
+    app_module.database.record_stat("svc1", "clone", "shallow", 1.0, 100)
+    app_module.database.record_stat("svc2", "clone", "shallow", 3.0, 300)
+    app_module.database.record_stat("svc1", "fetch", "shallow", 0.5, 10)
+
+    resp = client.get("/stats?operation=clone")
+    assert resp.get_json() == [{"operation": "clone", "detail": "shallow", "count": 2, "duration": 2.0, "bytes": 200}]
+    assert len(client.get("/stats?service_id=svc1").get_json()) == 2
+
+
+def test_deploy_log_events(registered):
+    from tasks.deploy_log import DeployLog, build_output
+
+    _, client = registered
+    with DeployLog("svc1") as log:
+        build_output.info("Step 1/1 : FROM scratch")
+
+    resp = client.get("/service/svc1/logs?follow=1")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    assert resp.get_data(as_text=True) == (
+        f"event: deploy\ndata: {log.deploy_id}\n\n"
+        "event: log\ndata: Step 1/1 : FROM scratch\n\n"
+        "event: end\ndata: RUNNING\n\n"
+    )
+    assert client.get("/service/svc1/logs?deploy=1").status_code == 404
+    assert client.get("/service/missing/logs").status_code == 404
+
+
+def test_metrics_include_request_latency_and_gauges(registered):
+    _, client = registered
+    client.get("/service/svc1/logs")
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    text = resp.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="GET",route="/service/<string:service_id>/logs",' \
+           'status="200"}' in text
+    assert 'background_jobs{state="queued"} 0' in text
+    assert 'services{state="RUNNING"} 1' in text
+
+
+def _push(client, payload, secret="hook-secret", event="push"):
+    body = json.dumps(payload).encode()
+    signature = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return client.post("/webhook/github", data=body, content_type="application/json",
+                       headers={"X-GitHub-Event": event, "X-Hub-Signature-256": signature})
+
+
+def test_github_push_updates_matching_services(registered, monkeypatch):
+    app_module, client = registered
+    calls = []
+    monkeypatch.setattr(app_module, "webhook_secret", "hook-secret")
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: calls.append(a))
+    app_module.database.execute(
+        "UPDATE repos SET url_key = 'github.com/owner/repo', branch = 'main', commit_sha = 'old',"
+        " payload = '{\"files\": {\"a.conf\": \"x\"}, \"volumes\": [\"data:/data\"]}' WHERE id = 'svc1'"
+    )
+    push = {"ref": "refs/heads/main", "after": "new",
+            "repository": {"clone_url": "https://github.com/Owner/Repo.git",
+                           "ssh_url": "git@github.com:owner/repo.git"}}
+
+    resp = _push(client, push)
+    assert resp.status_code == 202
+    queued = resp.get_json()["queued"]
+    assert [service["id"] for service in queued] == ["svc1"]
+    _wait_for_job(client, queued[0]["job"])
+    # the files and volumes of the latest deployment are reused
+    assert calls == [("svc1", {"a.conf": "x"}, ["data:/data"])]
+
+    # other branches and already deployed commits are ignored
+    assert _push(client, {**push, "ref": "refs/heads/dev"}).get_json()["queued"] == []
+    app_module.database.execute("UPDATE repos SET commit_sha = 'new' WHERE id = 'svc1'")
+    assert _push(client, push).get_json() == {"event": "push", "queued": [], "skipped": ["svc1"], "rejected": []}
+    app_module.database.execute("UPDATE repos SET commit_sha = 'old', failed_sha = 'new' WHERE id = 'svc1'")
+    assert _push(client, push).get_json()["skipped"] == ["svc1"]
+
+    # the first deployment of a registration in progress deploys the pushed commit with its files and volumes
+    for state in ["CLONING", "INITIALIZING"]:
+        app_module.database.execute("UPDATE repos SET commit_sha = '', state = ? WHERE id = 'svc1'", (state,))
+        assert _push(client, push).get_json()["skipped"] == ["svc1"]
+    assert len(calls) == 1
+
+
+def test_github_push_updates_services_without_branch(registered, monkeypatch):
+    app_module, client = registered
+    monkeypatch.setattr(app_module, "webhook_secret", "hook-secret")
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
+    # services registered before branches were stored
+    app_module.database.execute(
+        "UPDATE repos SET url_key = 'github.com/owner/repo', branch = '', commit_sha = 'old',"
+        " payload = '{\"files\": {}, \"volumes\": []}' WHERE id = 'svc1'"
+    )
+    push = {"ref": "refs/heads/main", "after": "new",
+            "repository": {"clone_url": "https://github.com/owner/repo.git", "default_branch": "main"}}
+
+    assert [service["id"] for service in _push(client, push).get_json()["queued"]] == ["svc1"]
+    assert _push(client, {**push, "ref": "refs/heads/dev"}).get_json()["queued"] == []
+
+
+def test_github_webhook_requires_valid_signature(registered, monkeypatch):
+    app_module, client = registered
+    assert _push(client, {}).status_code == 403
+
+    monkeypatch.setattr(app_module, "webhook_secret", "hook-secret")
+    assert _push(client, {}, secret="wrong").status_code == 401
+    assert _push(client, {"zen": "hi"}, event="ping").status_code == 200
+
+
+def test_patch_poll_interval(registered, monkeypatch):
+    app_module, client = registered
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
+
+    for invalid in [-1, "inf", "nan", True]:
+        assert client.patch("/service/svc1", json={"API-KEY": API_KEY, "poll_interval": invalid}).status_code == 400
+    assert client.patch("/service/svc1", json={"API-KEY": API_KEY, "poll_interval": 300}).status_code == 200
+    assert app_module.database.query_one("SELECT poll_interval FROM repos WHERE id = 'svc1'")[0] == 300
+
+
+def test_prepull_image_tag_in_background(registered, monkeypatch):
+    app_module, client = registered
+    pulls = []
+    monkeypatch.setattr(app_module, "prepull_image",
+                        lambda service_id, image, tag: pulls.append((image, tag)) or "sha256:1")
+
+    resp = client.post("/service/svc1/prepull", json={"API-KEY": API_KEY, "tag": "next"})
+    assert resp.status_code == 400
+
+    app_module.database.execute("UPDATE repos SET mode = 'dockerfile' WHERE id = 'svc1'")
+    resp = client.post("/service/svc1/prepull", json={"API-KEY": API_KEY, "tag": "next"})
+    assert resp.status_code == 202
+    assert resp.get_json()["tag"] == "next"
+
+    assert _wait_for_job(client, resp.get_json()["job"])["result"] == "sha256:1"
+    assert pulls == [("img", "next")]
+    assert client.post("/service/missing/prepull", json={"API-KEY": API_KEY}).status_code == 404
+
+
+def test_disk_usage_of_last_collection(registered):
+    app_module, client = registered
+
+    assert client.get("/service/svc1/disk").get_json()["total"] is None
+    assert client.get("/service/missing/disk").status_code == 404
+
+    app_module.database.execute("INSERT INTO disk_usage (service_id, repository, images, containers, measured) "
+                                "VALUES ('svc1', 1, 20, 300, 5)")
+    assert client.get("/service/svc1/disk").get_json() == {"id": "svc1", "repository": 1, "images": 20,
+                                                           "containers": 300, "total": 321, "measured": 5}
+
+
+def test_full_queue_rejects_deployments(registered, monkeypatch):
+    app_module, client = registered
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: None)
+    app_module.scheduler.set_limits({"queue": 1})
+    app_module.database.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('1', 'other', 'start', "
+                                "'QUEUED')")
+
+    resp = client.post("/service/svc1", json={"API-KEY": API_KEY})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == str(app_module.retry_after)
+    assert client.patch("/service/svc1", json={"API-KEY": API_KEY, "tag": "new"}).status_code == 429
+    assert app_module.database.query_one("SELECT tag FROM repos WHERE id = 'svc1'")[0] == "tag"
+
+    assert client.post("/service/svc1", json={"API-KEY": API_KEY, "priority": "urgent"}).status_code == 400
+    resp = client.post("/service/svc1", json={"API-KEY": API_KEY, "priority": "high"})
+    assert resp.status_code == 200
+    assert _wait_for_job(client, resp.get_json()["job"])["state"] == "DONE"
+
+
+def test_admin_limits(registered):
+    _, client = registered
+
+    resp = client.get("/admin/limits")
+    assert resp.status_code == 200
+    assert resp.get_json()["usage"]["queue"] == {"queued": 0}
+
+    assert client.put("/admin/limits", json={"API-KEY": "wrong", "limits": {"builds": 1}}).status_code == 400
+    assert client.put("/admin/limits", json={"API-KEY": API_KEY, "limits": {"bogus": 1}}).status_code == 400
+
+    resp = client.put("/admin/limits", json={"API-KEY": API_KEY, "limits": {"builds": 1, "deploys:docker": 2}})
+    assert resp.status_code == 200
+    assert resp.get_json()["limits"]["builds"] == 1
+    assert client.get("/admin/limits").get_json()["limits"]["deploys:docker"] == 2
+
+
+def test_batch_registration_is_validated_jointly(registered, monkeypatch):
+    app_module, client = registered
+    launched = []
+    monkeypatch.setattr(app_module, "launch_service", lambda service_id, volumes, files: launched.append(service_id))
+
+    def _spec(image, port):
+        return {"mode": "dockerfile", "image": image, "tag": "1.0", "port": port}
+
+    assert client.post("/service/batch", json={"API-KEY": API_KEY, "services": {}}).status_code == 400
+    resp = client.post("/service/batch", json={"API-KEY": API_KEY, "services": [
+        {**_spec("org/a", "9001:80"), "files": None}]})
+    assert resp.get_json()["errors"] == [{"index": 0, "error": "Custom files object expected"}]
+
+    # ports conflicting with each other or with registered services reject the whole batch
+    resp = client.post("/service/batch", json={"API-KEY": API_KEY, "services": [
+        _spec("org/a", "9001:80"), _spec("org/b", "9001:80"), _spec("org/c", "8080:80"), {"mode": "bogus"}]})
+    assert resp.status_code == 400
+    assert [error["index"] for error in resp.get_json()["errors"]] == [3]
+
+    resp = client.post("/service/batch", json={"API-KEY": API_KEY, "services": [
+        _spec("org/a", "9001:80"), _spec("org/b", "9001:80"), _spec("org/c", "8080:80")]})
+    assert resp.status_code == 400
+    assert [error["index"] for error in resp.get_json()["errors"]] == [1, 2]
+    assert app_module.database.query_one("SELECT COUNT(*) FROM repos")[0] == 1
+
+    resp = client.post("/service/batch", json={"API-KEY": API_KEY, "services": [
+        _spec("org/a", "9001:80"), _spec("org/b", "9002:80")]})
+    assert resp.status_code == 202
+    services = resp.get_json()["services"]
+    assert [service["id"] for service in services] == ["org-a", "org-b"]
+
+    for service in services:
+        assert _wait_for_job(client, service["job"])["state"] == "DONE"
+    assert sorted(launched) == ["org-a", "org-b"]
+    assert os.path.isdir(os.path.join("services", "org-a"))
+
+
+def test_batch_update(registered, monkeypatch):
+    app_module, client = registered
+    calls = []
+    monkeypatch.setattr(app_module, "update_repository", lambda *a: calls.append(a))
+
+    resp = client.post("/service/batch/update", json={"API-KEY": API_KEY, "services": [{"id": "svc1"},
+                                                                                       {"id": "missing"}]})
+    assert resp.status_code == 400
+    assert resp.get_json()["errors"] == [{"index": 1, "error": "missing not found"}]
+
+    # invalid payloads and services being cloned are rejected as by single updates
+    app_module.database.execute("INSERT INTO repos (id, url, mode, state) VALUES ('cloning', '', 'docker', "
+                                "'CLONING')")
+    resp = client.post("/service/batch/update", json={"API-KEY": API_KEY, "services": [
+        {"id": "svc1", "volumes": None}, {"id": "svc1", "files": None}, {"id": "cloning"}]})
+    assert resp.status_code == 400
+    assert [error["index"] for error in resp.get_json()["errors"]] == [0, 1, 2]
+    assert resp.get_json()["errors"][2]["error"] == "cloning is being cloned"
+    assert client.post("/service/cloning", json={"API-KEY": API_KEY}).status_code == 409
+    assert client.post("/service/svc1", json={"API-KEY": API_KEY, "volumes": None}).status_code == 400
+    assert client.post("/service/svc1", json={"API-KEY": API_KEY, "files": None}).status_code == 400
+    assert client.post("/service/svc1", json={"API-KEY": API_KEY, "files": {"a.conf": 1}}).status_code == 400
+
+    resp = client.post("/service/batch/update", json={"API-KEY": API_KEY, "services": [
+        {"id": "svc1", "volumes": ["data:/data", ""]}]})
+    assert resp.status_code == 202
+    assert _wait_for_job(client, resp.get_json()["services"][0]["job"])["state"] == "DONE"
+    assert calls == [("svc1", {}, ["data:/data"])]
+
+    app_module.scheduler.set_limits({"queue": 1})
+    app_module.database.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('1', 'other', 'start', "
+                                "'QUEUED')")
+    resp = client.post("/service/batch/update", json={"API-KEY": API_KEY, "services": [{"id": "svc1"}]})
+    assert resp.status_code == 429
+    assert resp.get_json()["rejected"] == ["svc1"]
+
+
+def test_registration_clones_in_background(registered, monkeypatch):
+    app_module, client = registered
+    release = threading.Event()
+    initialize = app_module.initialize_repository
+    monkeypatch.setattr(app_module, "initialize_repository",
+                        lambda service_id, files: release.wait(5) and initialize(service_id, files))
+    monkeypatch.setattr(app_module, "launch_service", lambda service_id, volumes, files: "RUNNING")
+
+    resp = client.post("/service", json={"API-KEY": API_KEY, "mode": "dockerfile", "image": "org/img", "tag": "1",
+                                         "port": "9001:80", "files": {"a.conf": "x"}})
+    assert resp.status_code == 202
+    assert resp.get_json()["state"] == "CLONING"
+    job_id = resp.get_json()["job"]
+
+    # the id and the ports are reserved while the clone runs
+    assert client.get("/service/org-img").get_json()["job"] == job_id
+    assert client.get("/service/org-img").get_json()["state"] == "CLONING"
+    assert client.post("/service/org-img", json={"API-KEY": API_KEY}).status_code == 409
+    assert client.post("/service", json={"API-KEY": API_KEY, "mode": "dockerfile", "image": "org/other",
+                                         "tag": "1", "port": "9001:80"}).status_code == 400
+
+    release.set()
+    assert _wait_for_job(client, job_id)["result"] == "RUNNING"
+    with open(os.path.join("services", "org-img", "a.conf")) as f:
+        assert f.read() == "x"
@@ -0,0 +1,29 @@
+"""Smoke test of the offline benchmark suite (benchmarks/run.py)."""
+from benchmarks import run
+
+
+def test_benchmark_runs_offline():
+    results = run.run(services=3, clients=2)
+
+    assert list(results["phases"]) == ["register", "get", "list", "patch", "update", "delete"]
+    assert results["phases"]["get"]["requests"] == 15
+    assert list(results["deploys"]) == ["start", "patch", "update", "delete"]
+    assert all(stats["deploys"] == 3 for stats in results["deploys"].values())
+
+
+def test_regressions_beyond_tolerance():
+    baseline = {"phases": {"get": {"requests_per_second": 1000, "p50_ms": 1, "p99_ms": 10}},
+                "deploys": {"start": {"p50_s": 1, "p99_s": 2}}}
+    results = {"phases": {"get": {"requests_per_second": 100, "p50_ms": 1.6, "p99_ms": 100}},
+               "deploys": {"start": {"p50_s": 2.5, "p99_s": 20}}}
+
+    # throughput and p99 latencies aren't compared
+    assert run.compare(results, baseline, 1.0) == ["start deploys: p50 2.5 s, baseline 1"]
+    assert len(run.compare(results, baseline, 0.5)) == 2
+    assert run.compare(results, baseline, 2.0) == []
+
+
+def test_percentile():
+    assert run.percentile([], 0.99) == 0
+    assert run.percentile(list(range(1, 101)), 0.5) == 50
+    assert run.percentile(list(range(1, 101)), 0.99) == 99
@@ -0,0 +1,154 @@
+"""Tests for blue-green replacements (tasks/blue_green.py) against a fake Docker client."""
+import os
+import socket
+
+import docker
+import pytest
+from docker.errors import NotFound
+
+from service_config import database
+from tasks import blue_green
+
+
+class FakeContainer:
+    def __init__(self, client, name, image, healthy=True):
+        self.client = client
+        self.name = name
+        self.image = image
+        self.status = "running"
+        self.healthy = healthy
+        self.attrs = {}
+        self.ports = {}
+        self.reload()
+
+    def reload(self):
+        health = "healthy" if self.healthy else "unhealthy"
+        self.attrs = {"State": {"Status": self.status, "Health": {"Status": health}}}
+
+    def logs(self, tail=None):
+        return b"log output"
+
+    def rename(self, name):
+        self.client.containers.items[name] = self.client.containers.items.pop(self.name)
+        self.name = name
+
+    def stop(self):
+        self.status = "exited"
+
+    def start(self):
+        self.status = "running"
+
+    def remove(self, force=False):
+        del self.client.containers.items[self.name]
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.items = {}
+        self.runs = []
+
+    def get(self, name):
+        if name not in self.items:
+            raise NotFound(name)
+        return self.items[name]
+
+    def run(self, image, name, ports, **kwargs):
+        self.runs.append((name, ports))
+        container = FakeContainer(self.client, name, image, self.client.healthy.pop(0))
+        self.items[name] = container
+        return container
+
+
+class FakeApi:
+    def pull(self, image, tag, stream=False, decode=False):
+        return iter([{"status": f"Pulling from {image}", "id": tag}, {"status": "Downloaded newer image"}])
+
+
+class FakeClient:
+    def __init__(self):
+        self.containers = FakeContainers(self)
+        self.api = FakeApi()
+        self.healthy = []
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join("services", "svc"))
+    database.migrate()
+    database.execute(
+        "INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag, update_strategy)"
+        " VALUES ('svc', '', 'dockerfile', 'RUNNING', '8080:80', '.', 'nginx', 'alpine', 'blue-green')"
+    )
+
+    fake = FakeClient()
+    old = FakeContainer(fake, "svc", "nginx:old")
+    fake.containers.items["svc"] = old
+
+    monkeypatch.setattr(docker, "from_env", lambda: fake)
+    monkeypatch.setattr(blue_green, "readiness_interval", 0)
+    return fake
+
+
+def _replace():
+    return blue_green.replace_service("svc", "dockerfile", "8080:80", "nginx", "alpine", [],
+                                      os.path.join("services", "svc"))
+
+
+def _state():
+    return database.query_one("SELECT state FROM repos WHERE id = 'svc'")[0]
+
+
+def test_ready_container_replaces_old_one(client):
+    client.healthy = [True, True]
+
+    assert _replace()
+    assert list(client.containers.items) == ["svc"]
+    assert client.containers.items["svc"].image == "nginx:alpine"
+    # the candidate is checked on random host ports, the replacement gets the service's ports
+    assert client.containers.runs == [("svc-next", {"80": None}), ("svc", {"80": "8080"})]
+    assert _state() == "RUNNING"
+
+
+def test_unready_candidate_keeps_old_container(client):
+    client.healthy = [False]
+
+    assert not _replace()
+    assert list(client.containers.items) == ["svc"]
+    assert client.containers.items["svc"].image == "nginx:old"
+    assert client.containers.items["svc"].status == "running"
+    assert _state() == "BUILD FAILED"
+    with open(os.path.join("services", "svc", "error.txt")) as f:
+        assert "did not become ready" in f.read()
+
+
+def test_unready_replacement_restores_old_container(client):
+    client.healthy = [True, False]
+
+    assert not _replace()
+    assert list(client.containers.items) == ["svc"]
+    assert client.containers.items["svc"].image == "nginx:old"
+    assert client.containers.items["svc"].status == "running"
+
+
+def test_interrupted_swap_is_recovered(client):
+    client.containers.items["svc"].rename("svc-old")
+    client.containers.items["svc-old"].stop()
+    client.healthy = [False]
+
+    _replace()
+
+    assert client.containers.items["svc"].image == "nginx:old"
+    assert client.containers.items["svc"].status == "running"
+
+
+def test_port_probe():
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+
+        assert blue_green._port_open("127.0.0.1", port)
+
+    assert not blue_green._port_open("127.0.0.1", port)
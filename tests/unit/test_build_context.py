@@ -0,0 +1,57 @@
+"""Tests for the streamed Docker build context (tasks/build_context.py)."""
+import io
+import os
+import tarfile
+
+import pytest
+
+from tasks import build_context
+from tasks.build_context import BuildContext
+
+
+@pytest.fixture
+def context_dir(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\n")
+    (tmp_path / "app.py").write_text("print('hi')\n")
+    (tmp_path / "big.bin").write_bytes(os.urandom(200 * 1024 + 7))
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "module.py").write_text("x = 1\n")
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "logs" / "debug.log").write_text("noise\n")
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+    (tmp_path / ".dockerignore").write_text("# comment\nlogs\n")
+    return tmp_path
+
+
+def _extract(context):
+    data = b"".join(context)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return data, {member.name: tar.extractfile(member).read() if member.isfile() else None for member in tar}
+
+
+def test_context_excludes_git_and_dockerignore(context_dir):
+    _, members = _extract(BuildContext(str(context_dir)))
+
+    assert set(members) == {"Dockerfile", ".dockerignore", "app.py", "big.bin", "src", "src/module.py"}
+    assert members["big.bin"] == (context_dir / "big.bin").read_bytes()
+    assert members["src/module.py"] == b"x = 1\n"
+
+
+def test_context_is_streamed_in_chunks(context_dir, monkeypatch):
+    monkeypatch.setattr(build_context, "chunk_size", 4096)
+    context = BuildContext(str(context_dir))
+    chunks = list(context)
+
+    # file contents are read in chunks, only the end of archive marker is longer
+    assert max(len(chunk) for chunk in chunks[:-1]) <= 4096
+    assert context.size == sum(len(chunk) for chunk in chunks)
+    assert context.size % tarfile.RECORDSIZE == 0
+
+
+def test_dockerfile_is_kept_even_if_ignored(context_dir):
+    (context_dir / ".dockerignore").write_text("*\n")
+    _, members = _extract(BuildContext(str(context_dir)))
+
+    # like the Docker CLI, the Dockerfile and .dockerignore are always sent
+    assert set(members) == {"Dockerfile", ".dockerignore"}
@@ -0,0 +1,74 @@
+"""Tests for the clone strategies in tasks/clone.py, using a local upstream repository."""
+import os
+
+import pytest
+from git import Repo
+
+from service_config import database
+from tasks.clone import clone_repository, fetch_repository
+
+
+def _commit(repo, name, content):
+    with open(os.path.join(repo.working_tree_dir, name), "w") as f:
+        f.write(content)
+    repo.index.add([name])
+    return repo.index.commit(f"add {name}")
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("services")
+    database.migrate()
+
+    repo = Repo.init(tmp_path / "upstream", initial_branch="main")
+    repo.config_writer().set_value("user", "name", "test").set_value("user", "email", "t@example.org").release()
+    # allow partial clones over file://
+    repo.config_writer().set_value("uploadpack", "allowFilter", "true").release()
+    for i in range(3):
+        _commit(repo, f"file{i}.txt", f"content {i}")
+    repo.create_head("feature")
+    return repo
+
+
+def _url(repo):
+    return f"file://{repo.working_tree_dir}"
+
+
+@pytest.mark.parametrize("strategy", ["full", "shallow", "single-branch", "blobless"])
+def test_clone_strategies(upstream, strategy):
+    repo = clone_repository("svc", _url(upstream), os.path.join("services", "svc"), strategy)
+
+    assert repo.head.commit.hexsha == upstream.head.commit.hexsha
+    history = len(list(repo.iter_commits()))
+    assert history == (1 if strategy == "shallow" else 3)
+    remote_branches = {ref.remote_head for ref in repo.remote("origin").refs} - {"HEAD"}
+    assert remote_branches == ({"main"} if strategy in ("shallow", "single-branch") else {"main", "feature"})
+
+    operation, detail, size = database.query_one("SELECT operation, detail, bytes FROM stats")
+    assert (operation, detail) == ("clone", strategy)
+    assert size > 0
+
+
+def test_clone_branch(upstream):
+    _commit(upstream, "unrelated.txt", "main only")
+    repo = clone_repository("svc", _url(upstream), os.path.join("services", "svc"), "shallow", "feature")
+
+    assert repo.active_branch.name == "feature"
+    assert not os.path.exists(os.path.join("services", "svc", "unrelated.txt"))
+
+
+def test_fetch_resets_to_branch_tip(upstream):
+    path = os.path.join("services", "svc")
+    clone_repository("svc", _url(upstream), path, "shallow")
+    with open(os.path.join(path, "file0.txt"), "w") as f:
+        f.write("local change")
+
+    tip = _commit(upstream, "file3.txt", "new")
+    repo = fetch_repository("svc", path, "shallow")
+
+    assert repo.head.commit.hexsha == tip.hexsha
+    assert len(list(repo.iter_commits())) == 1
+    with open(os.path.join(path, "file0.txt")) as f:
+        assert f.read() == "content 0"
+    assert database.query_one("SELECT COUNT(*) FROM stats WHERE operation = 'fetch'")[0] == 1
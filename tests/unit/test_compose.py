@@ -0,0 +1,102 @@
+"""Tests for the selective docker-compose builds in tasks/compose.py, with a fake docker-compose executable."""
+import os
+import stat
+import subprocess
+
+import pytest
+
+from service_config import database
+from tasks import compose
+from tasks.deploy_log import DeployLog, read_lines
+
+FAKE_COMPOSE = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+[ "$2" = "broken" ] && echo "failed to build" && exit 1
+echo "built $2"
+"""
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("services")
+    database.migrate()
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "docker-compose").write_text(FAKE_COMPOSE)
+    (bin_dir / "docker-compose").chmod(stat.S_IRWXU)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    for name in ["api", "web"]:
+        (tmp_path / "repo" / name).mkdir(parents=True)
+        (tmp_path / "repo" / name / "Dockerfile").write_text("FROM scratch\n")
+        (tmp_path / "repo" / name / "app.txt").write_text(name)
+    (tmp_path / "repo" / "web" / ".dockerignore").write_text("*.log\n")
+
+    config = {"services": {"api": {"build": {"context": "api", "dockerfile": "Dockerfile"}},
+                           "web": {"build": {"context": str(tmp_path / "repo" / "web")}},
+                           "db": {"image": "postgres"}}}
+    return tmp_path, config
+
+
+def _calls(tmp_path):
+    calls = tmp_path / "bin" / "calls"
+    return sorted(calls.read_text().splitlines()) if calls.exists() else []
+
+
+def test_only_changed_contexts_are_rebuilt(project):
+    tmp_path, config = project
+    path = str(tmp_path / "repo")
+
+    hashes = compose.build_hashes(config, path)
+    assert sorted(hashes) == ["api", "web"]
+    assert compose.changed_services("svc", hashes) == ["api", "web"]
+
+    compose.build_services("svc", path, hashes, ["api", "web"])
+    assert _calls(tmp_path) == ["build api", "build web"]
+    assert compose.changed_services("svc", compose.build_hashes(config, path)) == []
+
+    # ignored files don't change the image
+    (tmp_path / "repo" / "web" / "debug.log").write_text("ignored")
+    (tmp_path / "repo" / "api" / "app.txt").write_text("changed")
+    assert compose.changed_services("svc", compose.build_hashes(config, path)) == ["api"]
+
+    config["services"]["web"]["build"]["args"] = {"VERSION": "2"}
+    assert compose.changed_services("svc", compose.build_hashes(config, path)) == ["api", "web"]
+
+
+def test_build_durations_are_recorded_per_service(project):
+    tmp_path, config = project
+    path = str(tmp_path / "repo")
+
+    compose.build_services("svc", path, compose.build_hashes(config, path), ["api", "web"])
+
+    stats = database.query("SELECT detail, bytes FROM stats WHERE service_id = 'svc' AND operation = 'build' "
+                           "ORDER BY detail")
+    assert [tuple(row) for row in stats] == [("compose:api", len("FROM scratch\n") + 3),
+                                             ("compose:web", len("FROM scratch\n") + len("*.log\n") + 3)]
+
+
+def test_failed_builds_are_retried_and_logged(project):
+    tmp_path, config = project
+    path = str(tmp_path / "repo")
+    config["services"]["broken"] = {"build": {"context": "api"}}
+    hashes = compose.build_hashes(config, path)
+
+    with DeployLog("svc", str(tmp_path / "logs")) as log, pytest.raises(subprocess.CalledProcessError) as error:
+        compose.build_services("svc", path, hashes, ["api", "broken"])
+
+    assert b"failed to build" in error.value.stderr
+    assert compose.changed_services("svc", hashes) == ["broken", "web"]
+    lines = list(read_lines("svc", log.deploy_id, root=str(tmp_path / "logs")))
+    assert "api | built api" in lines
+    assert "broken | failed to build" in lines
+
+
+def test_remote_contexts_are_always_rebuilt(project):
+    hashes = compose.build_hashes({"services": {"app": {"build": "https://github.com/org/app.git"}}}, ".")
+
+    assert compose.changed_services("svc", hashes) == ["app"]
+    compose.build_services("svc", ".", hashes, ["app"])
+    assert compose.changed_services("svc", hashes) == ["app"]
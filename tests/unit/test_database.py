@@ -0,0 +1,63 @@
+"""Tests for the shared SQLite access layer (service_config/database.py)."""
+import sqlite3
+import threading
+
+import pytest
+
+from service_config import database
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "services.db")
+    database.migrate(path)
+    return path
+
+
+def test_connections_use_wal_and_are_reused_per_thread(db_path):
+    db = database.connect(db_path)
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert database.connect(db_path) is db
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(database.connect(db_path)))
+    thread.start()
+    thread.join()
+    assert other[0] is not db
+
+
+def test_migrate_upgrades_legacy_database(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    with sqlite3.connect(path) as db:
+        db.execute(
+            "CREATE TABLE repos(id TEXT PRIMARY KEY, url TEXT, mode TEXT, state TEXT,"
+            " port TEXT, docker_root TEXT, image TEXT, tag TEXT)"
+        )
+        db.execute("INSERT INTO repos VALUES ('svc', '', 'dockerfile', 'RUNNING', '8080:80', '.', 'img', 'tag')")
+        db.execute("INSERT INTO repos VALUES ('git', 'git@github.com:o/r.git', 'docker', 'RUNNING', '', '.', '', '')")
+        # accepted by the former format check
+        db.execute("INSERT INTO repos VALUES ('zero', '', 'dockerfile', 'RUNNING', '0:80', '.', 'img', 'tag')")
+        db.execute("INSERT INTO repos VALUES ('high', '', 'dockerfile', 'RUNNING', '70000:80', '.', 'img', 'tag')")
+        db.commit()
+
+    database.migrate(path)
+    # applying the migrations again is a no-op
+    database.migrate(path)
+
+    assert database.query_one("PRAGMA user_version", path=path)[0] == len(database.migrations)
+    assert [tuple(row) for row in database.query("SELECT * FROM port_mappings", path=path)] == [("svc", 8080, 80)]
+    assert database.query_one("SELECT url_key FROM repos WHERE id = 'git'", path=path)[0] == "github.com/o/r"
+
+
+def test_transaction_rolls_back_on_error(db_path):
+    with pytest.raises(RuntimeError), database.transaction(db_path) as db:
+        db.execute("INSERT INTO port_mappings VALUES ('svc', 8080, 80)")
+        raise RuntimeError()
+
+    assert database.query("SELECT * FROM port_mappings", path=db_path) == []
+
+
+def test_set_state(db_path):
+    database.execute("INSERT INTO repos (id, state) VALUES ('svc', 'INITIALIZING')", path=db_path)
+    database.set_state("svc", "RUNNING", db_path)
+    assert database.query_one("SELECT state FROM repos WHERE id = 'svc'", path=db_path)["state"] == "RUNNING"
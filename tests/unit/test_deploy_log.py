@@ -0,0 +1,95 @@
+"""Tests for per-deployment logs (tasks/deploy_log.py)."""
+import os
+import threading
+
+import pytest
+
+from tasks import deploy_log
+from tasks.deploy_log import DeployLog, build_output, is_running, list_deploys, read_lines
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setattr(deploy_log, "follow_interval", 0.01)
+    return str(tmp_path)
+
+
+def test_build_output_is_recorded_and_compressed(root):
+    with DeployLog("svc", root) as log:
+        build_output.info("Step 1/2 : FROM scratch")
+        build_output.info("line one\nline two")
+        assert is_running("svc", log.deploy_id, root)
+
+    assert not is_running("svc", log.deploy_id, root)
+    assert os.listdir(os.path.join(root, "svc")) == [f"{log.deploy_id}.log.gz"]
+    assert list(read_lines("svc", log.deploy_id, root=root)) == ["Step 1/2 : FROM scratch", "line one", "line two"]
+
+
+def test_output_of_other_threads_is_ignored(root):
+    with DeployLog("svc", root) as log:
+        thread = threading.Thread(target=build_output.info, args=("other deployment",))
+        thread.start()
+        thread.join()
+
+    assert list(read_lines("svc", log.deploy_id, root=root)) == []
+
+
+def test_output_of_helper_threads_is_recorded(root):
+    def _helper(thread):
+        with deploy_log.output_of(thread):
+            build_output.info("parallel build")
+        build_output.info("other deployment")
+
+    with DeployLog("svc", root) as log:
+        thread = threading.Thread(target=_helper, args=(threading.get_ident(),))
+        thread.start()
+        thread.join()
+
+    assert list(read_lines("svc", log.deploy_id, root=root)) == ["parallel build"]
+
+
+def test_log_size_is_capped(root, monkeypatch):
+    monkeypatch.setattr(deploy_log, "max_log_size", 20)
+
+    with DeployLog("svc", root) as log:
+        for _ in range(10):
+            build_output.info("0123456789")
+
+    assert list(read_lines("svc", log.deploy_id, root=root)) == ["0123456789", "[log truncated after 11 bytes]"]
+
+
+def test_old_deployments_are_rotated(root, monkeypatch):
+    monkeypatch.setattr(deploy_log, "log_retention", 2)
+    deploy_ids = []
+
+    for number in range(4):
+        log = DeployLog("svc", root)
+        log.deploy_id = str(1000 + number)
+        log.path = os.path.join(log.directory, f"{log.deploy_id}.log")
+        with log:
+            build_output.info(f"deployment {number}")
+        deploy_ids.append(log.deploy_id)
+
+    assert list_deploys("svc", root) == deploy_ids[2:]
+
+
+def test_follow_reads_until_the_deployment_finished(root):
+    started = threading.Event()
+    release = threading.Event()
+
+    def _deploy():
+        with DeployLog("svc", root):
+            build_output.info("building")
+            started.set()
+            release.wait()
+            build_output.info("done")
+
+    thread = threading.Thread(target=_deploy)
+    thread.start()
+    started.wait()
+
+    lines = read_lines("svc", list_deploys("svc", root)[-1], follow=True, root=root)
+    assert next(lines) == "building"
+    release.set()
+    assert list(lines) == ["done"]
+    thread.join()
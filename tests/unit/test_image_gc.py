@@ -0,0 +1,101 @@
+"""Tests for the image and build cache garbage collector in tasks/image_gc.py, with Docker stubbed out."""
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from docker.errors import APIError, ImageNotFound
+
+from service_config import database
+from tasks import image_gc
+from tasks.image_gc import ImageCollector
+
+
+class FakeImages:
+    def __init__(self):
+        self.local = {"svc:latest", "nginx:alpine", "nginx:1.25", "gone:latest", "busy:1"}
+        self.removed = []
+        self.prunes = []
+
+    def remove(self, reference):
+        if reference == "busy:1":
+            raise APIError("conflict: image is being used by stopped container")
+        if reference not in self.local:
+            raise ImageNotFound(reference)
+        self.local.remove(reference)
+        self.removed.append(reference)
+
+    def prune(self, filters=None):
+        self.prunes.append(("images", filters))
+        return {"ImagesDeleted": [{"Deleted": "sha256:dangling"}], "SpaceReclaimed": 100}
+
+    def prune_builds(self, filters=None):
+        self.prunes.append(("builds", filters))
+        return {"SpaceReclaimed": 50}
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join("services", "svc"))
+    os.makedirs(os.path.join("services", "web", "deploy"))
+    with open(os.path.join("services", "svc", "Dockerfile"), "w") as f:
+        f.write("FROM scratch\n")
+    database.migrate()
+
+    database.execute("INSERT INTO repos (id, url, mode, state, docker_root, image, tag) VALUES "
+                     "('svc', '', 'docker', 'RUNNING', '.', '', ''), "
+                     "('web', '', 'docker-compose', 'RUNNING', 'deploy', '', ''), "
+                     "('proxy', '', 'dockerfile', 'RUNNING', '.', 'nginx', 'alpine')")
+
+    old = time.time() - 3600
+    for reference, service_id, used in [("svc:latest", "svc", old), ("nginx:alpine", "proxy", old),
+                                        ("nginx:1.25", "proxy", old), ("gone:latest", "gone", old),
+                                        ("busy:1", "gone", old), ("nginx:next", "proxy", time.time())]:
+        database.execute("INSERT INTO images (reference, service_id, used) VALUES (?, ?, ?)",
+                         (reference, service_id, used))
+
+    fake = SimpleNamespace(images=FakeImages(), df=lambda: {
+        "Images": [{"Id": "sha256:a", "RepoTags": ["svc:latest"], "Size": 1000},
+                   {"Id": "sha256:b", "RepoTags": ["nginx:alpine"], "Size": 2000},
+                   {"Id": "sha256:c", "RepoTags": ["web-api:latest"], "Size": 3000}],
+        "Containers": [{"Names": ["/svc"], "ImageID": "sha256:a", "SizeRw": 10},
+                       {"Names": ["/proxy"], "ImageID": "sha256:b", "SizeRw": 20},
+                       {"Names": ["/web-api-1"], "ImageID": "sha256:c", "SizeRw": 30,
+                        "Labels": {"com.docker.compose.project.working_dir":
+                                   os.path.abspath(os.path.join("services", "web", "deploy"))}}]})
+    monkeypatch.setattr(image_gc.docker, "from_env", lambda: fake)
+    return fake
+
+
+def test_unused_images_are_removed_after_the_retention(daemon):
+    result = ImageCollector(interval=60, retention=600).collect()
+
+    assert sorted(daemon.images.removed) == ["gone:latest", "nginx:1.25"]
+    assert result == {"images": 3, "reclaimed": 150}
+    assert daemon.images.prunes == [("images", {"dangling": True, "until": "600s"}), ("builds", {"until": "600s"})]
+
+    # recently pulled and failed removals are kept, used ones are renewed
+    remaining = dict(database.query("SELECT reference, used FROM images"))
+    assert sorted(remaining) == ["busy:1", "nginx:alpine", "nginx:next", "svc:latest"]
+    assert remaining["svc:latest"] > time.time() - 60
+
+
+def test_disk_use_is_measured_per_service(daemon):
+    ImageCollector(interval=60, retention=600).collect()
+
+    usage = {row["service_id"]: tuple(row)[1:4] for row in database.query("SELECT * FROM disk_usage")}
+    assert usage == {"svc": (len("FROM scratch\n"), 1000, 10), "proxy": (0, 2000, 20), "web": (0, 3000, 30)}
+
+
+def test_collections_are_deferred_while_deploying(daemon):
+    collector = ImageCollector(interval=60, retention=600)
+    now = time.time()
+    assert collector.due(now)
+
+    database.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('1', 'svc', 'update', 'RUNNING')")
+    assert not collector.due(now)
+
+    assert not collector.due(now + 30)
+    # deferred for at most one interval
+    assert collector.due(now + 60)
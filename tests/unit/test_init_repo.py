@@ -1,4 +1,4 @@
-"""Tests for tasks.init_repo.load_repository.
+"""Tests for tasks.init_repo.load_repository and the reservations of batch registrations.
 
 The 'dockerfile' mode needs no git clone (it only creates a directory), so we
 can exercise the directory creation, optional-file writing, duplicate guard and
@@ -8,21 +8,21 @@ import os
 import sqlite3
 
 import pytest
+from git import GitCommandError
 
+from service_config import database
+from service_config.config import PortAlreadyUsedException
+from service_config.database import migrate
 from tasks.exceptions import RepositoryAlreadyExistsException
-from tasks.init_repo import load_repository
+from tasks.init_repo import clone_dir, initialize_repository, load_repository, remove_stale_clones, reserve_repository
+from tasks.spool import store_files
 
 
 @pytest.fixture
 def workspace(tmp_path, monkeypatch):
     monkeypatch.chdir(tmp_path)
     os.mkdir("services")
-    with sqlite3.connect(os.path.join("services", "services.db")) as db:
-        db.execute(
-            "CREATE TABLE repos(id TEXT PRIMARY KEY, url TEXT, mode TEXT, state TEXT,"
-            " port TEXT, docker_root TEXT, image TEXT, tag TEXT)"
-        )
-        db.commit()
+    migrate()
     return tmp_path
 
 
@@ -40,7 +40,25 @@ def test_load_repository_dockerfile_mode_creates_dir_and_row(workspace):
     # row was registered with the INITIALIZING state
     with sqlite3.connect(os.path.join("services", "services.db")) as db:
         row = db.execute("SELECT id, mode, state, port FROM repos WHERE id = ?", (service_id,)).fetchone()
+        ports = db.execute("SELECT * FROM port_mappings").fetchall()
     assert row == (service_id, "dockerfile", "INITIALIZING", "8080:80")
+    assert ports == [(service_id, 8080, 80)]
+
+
+def test_load_repository_rolls_back_on_port_conflict(workspace):
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        db.execute("INSERT INTO port_mappings VALUES ('other', 8080, 80)")
+        db.commit()
+
+    with pytest.raises(PortAlreadyUsedException):
+        load_repository(
+            url="", mode="dockerfile", port="8080:80", docker_root=".",
+            dockerfile="myorg/myimage", tag="1.0",
+        )
+    # neither the workspace nor the registration remain
+    assert not os.path.exists(os.path.join("services", "myorg-myimage"))
+    with sqlite3.connect(os.path.join("services", "services.db")) as db:
+        assert db.execute("SELECT COUNT(*) FROM repos").fetchone() == (0,)
 
 
 def test_load_repository_rejects_existing_repository(workspace):
@@ -50,3 +68,65 @@ def test_load_repository_rejects_existing_repository(workspace):
             url="", mode="dockerfile", port="", docker_root=".",
             dockerfile="myorg/myimage", tag="1.0",
         )
+
+
+def test_reserved_repository_is_initialized_in_background(workspace):
+    with database.transaction() as db:
+        service_id = reserve_repository(db.cursor(), url="", mode="dockerfile", port="8080:80", docker_root=".",
+                                        image="myorg/myimage", tag="1.0")
+        # ports of services reserved in the same transaction are allocated, too
+        with pytest.raises(PortAlreadyUsedException):
+            reserve_repository(db.cursor(), url="", mode="dockerfile", port="8080:81", docker_root=".",
+                               image="myorg/other", tag="1.0")
+        with pytest.raises(RepositoryAlreadyExistsException):
+            reserve_repository(db.cursor(), url="", mode="dockerfile", port="", docker_root=".",
+                               image="myorg/myimage", tag="2.0")
+
+    assert service_id == "myorg-myimage"
+    assert database.query_one("SELECT state FROM repos WHERE id = ?", (service_id,))[0] == "CLONING"
+    assert not os.path.exists(os.path.join("services", service_id))
+
+    initialize_repository(service_id, store_files({"config/extra.txt": "hello"}))
+    with open(os.path.join("services", service_id, "config", "extra.txt")) as f:
+        assert f.read() == "hello"
+    assert database.query_one("SELECT state FROM repos WHERE id = ?", (service_id,))[0] == "INITIALIZING"
+    assert os.listdir(clone_dir) == []
+
+
+def test_failed_clone_removes_reservation(workspace, monkeypatch):
+    def _clone(service_id, url, repo_path, *args):
+        # partial clone
+        open(os.path.join(repo_path, "README.md"), "w").close()
+        raise GitCommandError("clone", 128)
+
+    monkeypatch.setattr("tasks.init_repo.clone_repository", _clone)
+    with database.transaction() as db:
+        service_id = reserve_repository(db.cursor(), url="https://github.com/org/repo.git", mode="docker",
+                                        port="8080:80", docker_root=".")
+
+    with pytest.raises(GitCommandError):
+        initialize_repository(service_id, {})
+
+    # the service can be registered again
+    assert not os.path.exists(os.path.join("services", service_id))
+    assert os.listdir(clone_dir) == []
+    assert database.query("SELECT * FROM repos") == []
+    assert database.query("SELECT * FROM port_mappings") == []
+
+
+def test_interrupted_clones_are_removed(workspace):
+    os.makedirs(os.path.join(clone_dir, f"{os.getpid()}-running-abc"))
+    os.makedirs(os.path.join(clone_dir, "999999999-crashed-abc"))
+    with database.transaction() as db:
+        crashed = reserve_repository(db.cursor(), url="", mode="dockerfile", port="8080:80", docker_root=".",
+                                     image="org/crashed", tag="1.0")
+        queued = reserve_repository(db.cursor(), url="", mode="dockerfile", port="8081:80", docker_root=".",
+                                    image="org/queued", tag="1.0")
+        db.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('1', ?, 'start', 'QUEUED')", (queued,))
+        db.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('2', ?, 'start', 'FAILED')", (crashed,))
+
+    remove_stale_clones()
+
+    assert os.listdir(clone_dir) == [f"{os.getpid()}-running-abc"]
+    assert [row[0] for row in database.query("SELECT id FROM repos")] == [queued]
+    assert database.query_one("SELECT COUNT(*) FROM port_mappings")[0] == 1
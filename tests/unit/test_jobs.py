@@ -0,0 +1,157 @@
+"""Tests for the in-process background job runner (tasks/jobs.py)."""
+import os
+import sqlite3
+import threading
+import time
+from functools import partial
+
+import pytest
+
+from service_config.database import migrate
+from tasks.jobs import JobRunner, get_job, requested_at
+
+
+@pytest.fixture
+def runner(tmp_path):
+    db_path = str(tmp_path / "services.db")
+    migrate(db_path)
+    job_runner = JobRunner(workers=1, db_path=db_path, debounce=0.2)
+    yield job_runner
+    job_runner.executor.shutdown(wait=True)
+
+
+def test_submit_runs_task_and_records_result(runner):
+    calls = []
+
+    def _task(payload):
+        calls.append(payload)
+        return "NO CHANGE"
+
+    job_id = runner.submit("update", "svc", _task, "payload")
+    runner.executor.shutdown(wait=True)
+
+    assert calls == ["payload"]
+    job = get_job(job_id, runner.db_path)
+    assert job["state"] == "DONE"
+    assert job["result"] == "NO CHANGE"
+    assert job["service_id"] == "svc"
+    assert job["kind"] == "update"
+
+
+def test_failing_task_is_marked_failed(runner):
+    def _fail():
+        raise ValueError("broken")
+
+    job_id = runner.submit("start", "svc", _fail)
+    runner.executor.shutdown(wait=True)
+
+    job = get_job(job_id, runner.db_path)
+    assert job["state"] == "FAILED"
+    assert job["error"] == "broken"
+
+
+def test_recover_fails_jobs_of_dead_processes(runner):
+    with sqlite3.connect(runner.db_path) as db:
+        db.execute("INSERT INTO jobs (id, service_id, kind, state, created, pid, payload, not_before)"
+                   " VALUES ('stale', 'svc', 'update', 'QUEUED', 0, 999999999, '[]', 0)")
+        # jobs of a worker before a container restart, whose pid was reused
+        db.execute("INSERT INTO jobs (id, service_id, kind, state, created, pid, pid_start, payload, not_before)"
+                   " VALUES ('restarted', 'svc', 'update', 'RUNNING', 0, ?, 1, '[]', 0)", (os.getpid(),))
+        db.commit()
+
+    assert runner.queue_depth() == {"queued": 1, "running": 1}
+    runner.recover()
+
+    assert get_job("stale", runner.db_path)["state"] == "FAILED"
+    assert get_job("restarted", runner.db_path)["state"] == "FAILED"
+    assert runner.queue_depth() == {"queued": 0, "running": 0}
+
+
+def test_coalesced_jobs_run_once_with_latest_arguments(runner):
+    calls = []
+    first = runner.submit("update", "svc", calls.append, "first", coalesce=True)
+    second = runner.submit("update", "svc", calls.append, "second", coalesce=True)
+    # other services and other job kinds are not merged
+    other = runner.submit("update", "other", calls.append, "other", coalesce=True)
+
+    assert first == second
+    assert other != first
+    assert get_job(first, runner.db_path)["state"] == "QUEUED"
+
+    for _ in range(100):
+        if get_job(first, runner.db_path)["state"] == "DONE" and get_job(other, runner.db_path)["state"] == "DONE":
+            break
+        time.sleep(0.02)
+
+    assert sorted(calls) == ["other", "second"]
+
+
+def test_jobs_of_same_service_run_sequentially(runner, monkeypatch):
+    monkeypatch.setattr("tasks.jobs.poll_interval", 0.01)
+    with sqlite3.connect(runner.db_path) as db:
+        db.execute("INSERT INTO jobs (id, service_id, kind, state, created, started, pid, payload, not_before)"
+                   " VALUES ('busy', 'svc', 'start', 'RUNNING', 0, 0, 1, '[]', 0)")
+        db.commit()
+
+    calls = []
+    job_id = runner.submit("update", "svc", calls.append, "payload")
+    time.sleep(0.1)
+    # the update waits for the running job
+    assert calls == []
+    assert get_job(job_id, runner.db_path)["state"] == "QUEUED"
+
+    with sqlite3.connect(runner.db_path) as db:
+        db.execute("UPDATE jobs SET state = 'DONE' WHERE id = 'busy'")
+        db.commit()
+
+    for _ in range(100):
+        if calls:
+            break
+        time.sleep(0.01)
+    assert calls == ["payload"]
+
+
+def test_tasks_know_the_time_of_their_latest_request(runner):
+    times = []
+    first = time.time()
+
+    runner.submit("update", "svc", lambda: times.append(requested_at()), coalesce=True)
+    time.sleep(0.05)
+    merged = time.time()
+    runner.submit("update", "svc", lambda: times.append(requested_at()), coalesce=True)
+    time.sleep(0.5)
+
+    assert len(times) == 1
+    assert times[0] >= merged > first
+
+
+def test_preparations_run_outside_of_the_worker_pool(runner):
+    blocker = threading.Event()
+    runner.submit("update", "busy", blocker.wait, 5)
+    # the preparations only pass the barrier together, while the only worker is busy
+    barrier = threading.Barrier(3, timeout=5)
+    events = []
+
+    def _clone(service_id):
+        barrier.wait()
+        events.append(f"clone {service_id}")
+
+    job_ids = [runner.submit("start", f"svc{i}", events.append, f"start svc{i}", prepare=partial(_clone, f"svc{i}"))
+               for i in range(3)]
+    failed = runner.submit("start", "broken", events.append, "start broken", prepare=lambda: 1 / 0)
+
+    for _ in range(100):
+        if len(events) == 3 and get_job(failed, runner.db_path)["state"] == "FAILED":
+            break
+        time.sleep(0.01)
+    assert sorted(events) == ["clone svc0", "clone svc1", "clone svc2"]
+    assert get_job(failed, runner.db_path)["error"] == "division by zero"
+
+    blocker.set()
+    # the lock of a failed preparation is released
+    runner.submit("delete", "broken", events.append, "delete broken")
+    runner.preparation.shutdown(wait=True)
+    runner.executor.shutdown(wait=True)
+
+    assert all(get_job(job_id, runner.db_path)["state"] == "DONE" for job_id in job_ids)
+    assert sorted(events[3:]) == ["delete broken", "start svc0", "start svc1", "start svc2"]
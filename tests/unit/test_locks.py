@@ -0,0 +1,111 @@
+"""Tests for the per-service locks shared by all API workers (tasks/locks.py)."""
+import threading
+import time
+
+import pytest
+
+from service_config import database
+from tasks import locks
+from tasks.jobs import JobRunner, get_job
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "services.db")
+    database.migrate(path)
+    monkeypatch.setattr(locks, "lock_poll_interval", 0.01)
+    monkeypatch.setattr("tasks.jobs.poll_interval", 0.01)
+    return path
+
+
+def test_tickets_are_granted_in_order(db_path):
+    with database.transaction(db_path) as db:
+        first = locks.request_lock(db, "svc", "first")
+        second = locks.request_lock(db, "svc", "second")
+        other = locks.request_lock(db, "other", "other")
+
+    with database.transaction(db_path) as db:
+        assert not locks.try_acquire(db, second)
+        assert locks.try_acquire(db, first)
+        assert locks.try_acquire(db, other)
+
+    assert locks.lock_state("svc", db_path) == {"holder": "first", "pid": locks.os.getpid(),
+                                                 "since": pytest.approx(time.time(), abs=5), "waiting": 1}
+
+    locks.release(first, db_path)
+    with database.transaction(db_path) as db:
+        assert locks.try_acquire(db, second)
+
+    locks.release(second, db_path)
+    assert locks.lock_state("svc", db_path) is None
+
+
+def test_tickets_of_terminated_processes_are_released(db_path, monkeypatch):
+    with database.transaction(db_path) as db:
+        crashed = locks.request_lock(db, "svc", "crashed worker")
+        waiting = locks.request_lock(db, "svc", "waiting")
+    database.execute("UPDATE locks SET pid = -1 WHERE ticket = ?", (crashed,), db_path)
+    monkeypatch.setattr(locks, "is_alive", lambda pid, started: pid != -1)
+
+    with database.transaction(db_path) as db:
+        assert locks.try_acquire(db, waiting)
+    assert locks.lock_state("svc", db_path)["holder"] == "waiting"
+
+
+def test_tickets_of_reused_pids_are_released(db_path):
+    # a restarted container starts its API workers with the pids of the terminated ones
+    with database.transaction(db_path) as db:
+        restarted = locks.request_lock(db, "svc", "worker before restart")
+        waiting = locks.request_lock(db, "svc", "waiting")
+    database.execute("UPDATE locks SET pid_start = pid_start - 1 WHERE ticket = ?", (restarted,), db_path)
+
+    with database.transaction(db_path) as db:
+        assert locks.try_acquire(db, waiting)
+
+    assert locks.is_alive(locks.os.getpid(), locks.process_start(locks.os.getpid()))
+    assert locks.tag_alive(locks.process_tag())
+    assert not locks.tag_alive(f"{locks.os.getpid()}.1")
+    assert not locks.tag_alive("unknown")
+
+
+def test_service_lock_serializes_operations(db_path):
+    events = []
+
+    def _operation(name):
+        with locks.service_lock("svc", name, db_path):
+            events.append(f"{name} start")
+            time.sleep(0.05)
+            events.append(f"{name} end")
+
+    threads = [threading.Thread(target=_operation, args=(name,)) for name in ["a", "b"]]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+    assert events == ["a start", "a end", "b start", "b end"]
+
+
+def test_jobs_of_several_workers_run_in_submission_order(db_path):
+    workers = [JobRunner(workers=2, db_path=db_path, debounce=0) for _ in range(2)]
+    events = []
+
+    def _task(name):
+        events.append(f"{name} start")
+        time.sleep(0.03)
+        events.append(f"{name} end")
+
+    job_ids = [workers[number % 2].submit(kind, "svc", _task, kind)
+               for number, kind in enumerate(["patch", "update", "delete"])]
+
+    for _ in range(200):
+        if all(get_job(job_id, db_path)["state"] == "DONE" for job_id in job_ids):
+            break
+        time.sleep(0.01)
+
+    for worker in workers:
+        worker.executor.shutdown(wait=True)
+
+    assert events == ["patch start", "patch end", "update start", "update end", "delete start", "delete end"]
+    assert database.query("SELECT * FROM locks", path=db_path) == []
@@ -0,0 +1,65 @@
+"""Tests for the metrics shared by all API workers (service_config/metrics.py)."""
+import threading
+
+import pytest
+
+from service_config import database, metrics
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "services.db")
+    database.migrate(path)
+    monkeypatch.setattr(metrics, "_pending", {})
+    return path
+
+
+def _samples(text):
+    return dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+
+
+def test_histogram_buckets_are_cumulative_and_ordered(db_path):
+    metrics.observe("deploy_phase_duration_seconds", 0.3, phase="build")
+    metrics.observe("deploy_phase_duration_seconds", 45, phase="build")
+
+    text = metrics.render(path=db_path)
+    samples = _samples(text)
+
+    assert samples['deploy_phase_duration_seconds_bucket{le="0.1",phase="build"}'] == "0"
+    assert samples['deploy_phase_duration_seconds_bucket{le="0.5",phase="build"}'] == "1"
+    assert samples['deploy_phase_duration_seconds_bucket{le="60",phase="build"}'] == "2"
+    assert samples['deploy_phase_duration_seconds_bucket{le="+Inf",phase="build"}'] == "2"
+    assert samples['deploy_phase_duration_seconds_count{phase="build"}'] == "2"
+    assert float(samples['deploy_phase_duration_seconds_sum{phase="build"}']) == pytest.approx(45.3)
+
+    lines = [line for line in text.splitlines() if line.startswith("deploy_phase_duration_seconds_bucket")]
+    assert lines[-1].startswith('deploy_phase_duration_seconds_bucket{le="+Inf"')
+    assert "# TYPE deploy_phase_duration_seconds histogram" in text
+
+
+def test_workers_are_aggregated_in_the_database(db_path):
+    # each API worker flushes its own observations
+    for _ in range(3):
+        metrics.increment("deployments_total", kind="update", state="RUNNING")
+        thread = threading.Thread(target=metrics.flush, args=(db_path,))
+        thread.start()
+        thread.join()
+
+    metrics.increment("deployments_total", kind="update", state="BUILD FAILED")
+
+    samples = _samples(metrics.render(path=db_path))
+    assert samples['deployments_total{kind="update",state="RUNNING"}'] == "3"
+    assert samples['deployments_total{kind="update",state="BUILD FAILED"}'] == "1"
+
+
+def test_timer_observes_failing_blocks(db_path):
+    with pytest.raises(RuntimeError), metrics.timer("deploy_phase_duration_seconds", phase="pull"):
+        raise RuntimeError("pull failed")
+
+    assert _samples(metrics.render(path=db_path))['deploy_phase_duration_seconds_count{phase="pull"}'] == "1"
+
+
+def test_gauges_and_label_escaping(db_path):
+    text = metrics.render({"background_jobs": ("Jobs", {(("state", 'qu"eued'),): 2})}, path=db_path)
+    assert '# TYPE background_jobs gauge' in text
+    assert 'background_jobs{state="qu\\"eued"} 2' in text
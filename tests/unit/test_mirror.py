@@ -0,0 +1,131 @@
+"""Tests for the bare mirrors shared by services cloned from the same remote (tasks/mirror.py)."""
+import os
+import time
+
+import pytest
+from git import Repo
+
+from service_config import database
+from service_config.config import normalize_url
+from tasks import mirror
+from tasks.clone import clone_repository, fetch_repository
+from tasks.delete_repo import delete_repository
+from tasks.init_repo import initialize_repository, reserve_repository
+
+
+def _commit(repo, name, content):
+    with open(os.path.join(repo.working_tree_dir, name), "w") as f:
+        f.write(content)
+    repo.index.add([name])
+    return repo.index.commit(f"add {name}")
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("services")
+    database.migrate()
+    monkeypatch.setattr("tasks.locks.lock_poll_interval", 0.01)
+
+    repo = Repo.init(tmp_path / "upstream", initial_branch="main")
+    repo.config_writer().set_value("user", "name", "test").set_value("user", "email", "t@example.org").release()
+    _commit(repo, "file.txt", "content")
+    return repo
+
+
+def _url(repo):
+    return f"file://{repo.working_tree_dir}"
+
+
+def _fetches():
+    return [row[0] for row in database.query("SELECT detail FROM stats WHERE operation = 'mirror'")]
+
+
+def test_mirror_is_fetched_once_per_request(upstream):
+    url = _url(upstream)
+    requested = time.time()
+
+    path = mirror.update_mirror("svc1", url, normalize_url(url), requested)
+    assert os.path.isfile(os.path.join(path, "HEAD"))
+    assert Repo(path).git.config("gc.auto") == "0"
+
+    # updates requested before the last fetch reuse it
+    assert mirror.update_mirror("svc2", url, normalize_url(url), requested) == path
+    assert _fetches() == ["clone"]
+
+    commit = _commit(upstream, "file.txt", "changed")
+    mirror.update_mirror("svc2", url, normalize_url(url), time.time())
+    assert _fetches() == ["clone", "fetch"]
+    assert Repo(path).commit("main").hexsha == commit.hexsha
+
+
+def test_clones_share_the_objects_of_the_mirror(upstream):
+    url = _url(upstream)
+    path = mirror.update_mirror("svc", url, normalize_url(url))
+
+    repo = clone_repository("svc", url, os.path.join("services", "svc"), "full", mirror=path)
+    assert repo.head.commit.hexsha == upstream.head.commit.hexsha
+    with open(os.path.join("services", "svc", ".git", "objects", "info", "alternates")) as f:
+        assert f.read().strip() == os.path.join(path, "objects")
+
+    # updates fetch from the mirror
+    commit = _commit(upstream, "file.txt", "changed")
+    mirror.update_mirror("svc", url, normalize_url(url), time.time())
+    assert fetch_repository("svc", os.path.join("services", "svc")).head.commit.hexsha == commit.hexsha
+
+
+@pytest.mark.parametrize("strategy", ["shallow", "blobless"])
+def test_partial_clones_are_cloned_from_the_mirror(upstream, strategy):
+    # the blob of the first commit isn't checked out
+    _commit(upstream, "file.txt", "second")
+    url = _url(upstream)
+    path = mirror.update_mirror("svc", url, normalize_url(url))
+
+    repo = clone_repository("svc", url, os.path.join("services", "svc"), strategy, mirror=path)
+    assert repo.remote("origin").url == f"file://{path}"
+    assert not os.path.exists(os.path.join("services", "svc", ".git", "objects", "info", "alternates"))
+    if strategy == "shallow":
+        assert len(list(repo.iter_commits())) == 1
+    else:
+        assert "?" in [line[0] for line in repo.git.rev_list("--objects", "--all", "--missing=print").splitlines()]
+
+    # updates fetch from the mirror
+    commit = _commit(upstream, "file.txt", "changed")
+    mirror.update_mirror("svc", url, normalize_url(url), time.time())
+    assert fetch_repository("svc", os.path.join("services", "svc"), strategy).head.commit.hexsha == commit.hexsha
+
+
+def test_mirror_is_removed_with_its_last_service(upstream, monkeypatch):
+    monkeypatch.setattr("tasks.delete_repo.stop_service", lambda *args: None)
+    url = _url(upstream)
+
+    service_ids = []
+
+    # services deployed from subdirectories of the same repository
+    for docker_root in ["a", "b/c"]:
+        with database.transaction() as db:
+            service_ids.append(reserve_repository(db.cursor(), url=url, mode="docker-compose", port="",
+                                                  docker_root=docker_root))
+        initialize_repository(service_ids[-1], {})
+
+    path = mirror.mirror_path(normalize_url(url))
+    assert service_ids[1].endswith("-b-c")
+    # outside of jobs, every clone fetches the mirror
+    assert _fetches() == ["clone", "fetch"]
+    assert [row[0] for row in database.query("SELECT mirror FROM repos")] == [path, path]
+
+    delete_repository(service_ids[0])
+    assert os.path.isdir(path)
+    delete_repository(service_ids[1])
+    assert not os.path.exists(path)
+    assert database.query("SELECT * FROM mirrors") == []
+
+
+def test_interrupted_mirrors_are_removed(upstream):
+    os.makedirs(os.path.join(mirror.mirror_dir, f"{os.getpid()}-running.tmp"))
+    os.makedirs(os.path.join(mirror.mirror_dir, "999999999-crashed.tmp"))
+    os.makedirs(os.path.join(mirror.mirror_dir, "0123456789abcdef.git"))
+
+    mirror.remove_stale_mirrors()
+
+    assert sorted(os.listdir(mirror.mirror_dir)) == ["0123456789abcdef.git", f"{os.getpid()}-running.tmp"]
@@ -0,0 +1,112 @@
+"""Tests for the remote poller (tasks/poller.py), using a local upstream repository."""
+import os
+import time
+
+import pytest
+from git import Repo
+
+from service_config import database
+from service_config.config import normalize_url
+from tasks import poller
+from tasks.poller import Poller, acquire_lease, ls_remote
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("services")
+    database.migrate()
+
+    repo = Repo.init(tmp_path / "upstream", initial_branch="main")
+    repo.config_writer().set_value("user", "name", "test").set_value("user", "email", "t@example.org").release()
+    with open(os.path.join(repo.working_tree_dir, "file.txt"), "w") as f:
+        f.write("content")
+    repo.index.add(["file.txt"])
+    repo.index.commit("initial commit")
+    return repo
+
+
+def _register(service_id, repo, commit, poll_interval=10, branch="main"):
+    url = f"file://{repo.working_tree_dir}"
+    database.execute(
+        "INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag, branch, url_key, commit_sha,"
+        " poll_interval, payload) VALUES (?, ?, 'docker-compose', 'RUNNING', '', '.', '', '', ?, ?, ?, ?, ?)",
+        (service_id, url, branch, normalize_url(url), commit, poll_interval, '{"files": {}, "volumes": ["v:/v"]}')
+    )
+
+
+@pytest.fixture
+def queued():
+    return []
+
+
+@pytest.fixture
+def service_poller(queued, monkeypatch):
+    calls = []
+
+    def _ls_remote(url):
+        calls.append(url)
+        return ls_remote(url)
+
+    monkeypatch.setattr(poller, "ls_remote", _ls_remote)
+    instance = Poller(lambda *args, **kwargs: queued.append(args), workers=2)
+    instance.ls_remote_calls = calls
+    return instance
+
+
+def test_ls_remote_lists_branch_heads(upstream):
+    heads = ls_remote(f"file://{upstream.working_tree_dir}")
+    assert heads["refs/heads/main"] == heads["HEAD"] == upstream.head.commit.hexsha
+
+
+def test_shared_remote_is_polled_once_and_changes_are_queued(upstream, service_poller, queued):
+    _register("svc1", upstream, "old")
+    _register("svc2", upstream, "old", poll_interval=60)
+    _register("svc3", upstream, upstream.head.commit.hexsha)
+
+    assert sorted(service_poller.poll()) == ["svc1", "svc2"]
+    assert len(service_poller.ls_remote_calls) == 1
+    assert sorted(queued) == [("svc1", {}, ["v:/v"]), ("svc2", {}, ["v:/v"])]
+
+    # not due again before the shortest interval of the remote passed
+    assert service_poller.poll() == []
+    assert len(service_poller.ls_remote_calls) == 1
+
+
+def test_failed_commits_are_not_retried(upstream, service_poller, queued):
+    _register("svc1", upstream, "old")
+    database.execute("UPDATE repos SET failed_sha = ? WHERE id = 'svc1'", (upstream.head.commit.hexsha,))
+
+    assert service_poller.poll() == []
+    assert queued == []
+
+
+def test_services_with_pending_jobs_are_skipped(upstream, service_poller, queued):
+    _register("svc1", upstream, "old")
+    database.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES ('job', 'svc1', 'update', 'QUEUED')")
+
+    assert service_poller.poll() == []
+    assert queued == []
+
+
+def test_failing_remote_backs_off(upstream, service_poller):
+    _register("svc1", upstream, "old")
+    database.execute("UPDATE repos SET url = 'file:///missing/repo', url_key = 'missing' WHERE id = 'svc1'")
+
+    service_poller.poll()
+    service_poller.poll()
+    failures, retry_at = database.query_one("SELECT failures, retry_at FROM remotes WHERE url_key = 'missing'")
+
+    # the second poll waits for the retry time
+    assert failures == 1
+    assert retry_at == pytest.approx(time.time() + 20, abs=5)
+    assert len(service_poller.ls_remote_calls) == 1
+
+
+def test_lease_is_held_by_one_worker(upstream):
+    assert acquire_lease("poller", "worker-1", 10)
+    assert acquire_lease("poller", "worker-1", 10)
+    assert not acquire_lease("poller", "worker-2", 10)
+
+    database.execute("UPDATE leases SET expires = 0")
+    assert acquire_lease("poller", "worker-2", 10)
@@ -0,0 +1,205 @@
+"""Tests for the concurrency limits and admission control shared by all API workers (tasks/scheduler.py)."""
+import threading
+import time
+
+import pytest
+
+from service_config import database
+from tasks import scheduler
+from tasks.exceptions import QueueFullException
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "services.db")
+    database.migrate(path)
+    monkeypatch.setattr(scheduler, "slot_poll_interval", 0.01)
+    return path
+
+
+def _queue(db_path, count, kind="update"):
+    for i in range(count):
+        database.execute("INSERT INTO jobs (id, service_id, kind, state) VALUES (?, ?, ?, 'QUEUED')",
+                         (f"{kind}{i}", f"svc{i}", kind), db_path)
+
+
+def test_limits_changed_at_runtime(db_path):
+    assert scheduler.limits(db_path)["builds"] == scheduler.default_limits["builds"]
+
+    scheduler.set_limits({"builds": 1, "deploys:docker": 3}, db_path)
+    assert scheduler.limits(db_path)["builds"] == 1
+    assert scheduler.limits(db_path)["deploys:docker"] == 3
+
+    for invalid in [{"unknown": 1}, {"builds": -1}, {"builds": "2"}, {"builds": True}]:
+        with pytest.raises(ValueError):
+            scheduler.set_limits(invalid, db_path)
+    assert scheduler.limits(db_path)["builds"] == 1
+
+
+def test_slots_limit_concurrent_operations(db_path):
+    scheduler.set_limits({"builds": 2}, db_path)
+    running, peak = [], []
+    lock = threading.Lock()
+
+    def _build(name):
+        with scheduler.slot("builds", holder=name, path=db_path):
+            with lock:
+                running.append(name)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(name)
+
+    threads = [threading.Thread(target=_build, args=(f"build{i}",)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(peak) == 5
+    assert max(peak) == 2
+    assert scheduler.usage(db_path)["builds"] == {"running": 0, "waiting": 0}
+
+
+def test_waiting_requests_are_ordered_by_priority(db_path):
+    scheduler.set_limits({"deploys": 1}, db_path)
+    order = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def _holder():
+        with scheduler.slot("deploys", holder="holder", path=db_path):
+            entered.set()
+            release.wait(5)
+
+    def _deploy(priority_class):
+        with scheduler.priority(priority_class), scheduler.slot("deploys", holder=priority_class, path=db_path):
+            order.append(priority_class)
+
+    holder = threading.Thread(target=_holder)
+    holder.start()
+    entered.wait(5)
+
+    threads = []
+    for priority_class in ["low", "normal", "high"]:
+        threads.append(thread := threading.Thread(target=_deploy, args=(priority_class,)))
+        thread.start()
+        # every request is queued before the next one
+        while scheduler.usage(db_path)["deploys"]["waiting"] < len(threads):
+            time.sleep(0.01)
+
+    assert scheduler.usage(db_path)["deploys"] == {"running": 1, "waiting": 3}
+    release.set()
+    for thread in [holder, *threads]:
+        thread.join(5)
+
+    assert order == ["high", "normal", "low"]
+
+
+def test_released_slots_wake_up_waiting_requests(db_path, monkeypatch):
+    # only other API workers' releases rely on polling
+    monkeypatch.setattr(scheduler, "slot_poll_interval", 10)
+    scheduler.set_limits({"builds": 1}, db_path)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def _holder():
+        with scheduler.slot("builds", holder="holder", path=db_path):
+            entered.set()
+            release.wait(5)
+
+    def _waiter():
+        with scheduler.slot("builds", holder="waiter", path=db_path):
+            acquired.append(time.monotonic())
+
+    acquired = []
+    holder = threading.Thread(target=_holder)
+    holder.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=_waiter)
+    waiter.start()
+    while scheduler.usage(db_path)["builds"]["waiting"] < 1:
+        time.sleep(0.01)
+
+    released = time.monotonic()
+    release.set()
+    for thread in [holder, waiter]:
+        thread.join(5)
+
+    assert acquired and acquired[0] - released < 1
+
+
+def test_waiting_requests_only_write_when_a_slot_is_free(db_path, monkeypatch):
+    scheduler.set_limits({"builds": 1}, db_path)
+    transactions = []
+    transaction = database.transaction
+
+    def _transaction(path=None):
+        transactions.append(threading.current_thread().name)
+        return transaction(path)
+
+    monkeypatch.setattr(database, "transaction", _transaction)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def _holder():
+        with scheduler.slot("builds", holder="holder", path=db_path):
+            entered.set()
+            release.wait(5)
+
+    def _waiter():
+        with scheduler.slot("builds", holder="waiter", path=db_path):
+            pass
+
+    holder = threading.Thread(target=_holder)
+    holder.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=_waiter, name="waiter")
+    waiter.start()
+    time.sleep(0.5)
+
+    # the ticket and the first attempt, which also releases slots of terminated processes
+    assert transactions.count("waiter") == 2
+    release.set()
+    for thread in [holder, waiter]:
+        thread.join(5)
+    assert transactions.count("waiter") == 3
+
+
+def test_slots_of_terminated_processes_are_released(db_path, monkeypatch):
+    scheduler.set_limits({"pulls": 1}, db_path)
+    database.execute("INSERT INTO slots (resource, priority, holder, pid, requested, acquired) "
+                     "VALUES ('pulls', 1, 'crashed worker', -1, 0, 0)", path=db_path)
+    monkeypatch.setattr(scheduler, "is_alive", lambda pid, started: pid != -1)
+
+    with scheduler.slot("pulls", holder="pull", path=db_path):
+        assert scheduler.usage(db_path)["pulls"] == {"running": 1, "waiting": 0}
+
+
+def test_unlimited_resources_are_granted_immediately(db_path):
+    scheduler.set_limits({"deploys": 0}, db_path)
+
+    with scheduler.slot("deploys", holder="a", path=db_path), scheduler.slot("deploys", holder="b", path=db_path):
+        assert scheduler.usage(db_path)["deploys"]["running"] == 2
+
+
+def test_admission_by_priority_class(db_path):
+    scheduler.set_limits({"queue": 4}, db_path)
+    _queue(db_path, 2)
+
+    # low priority requests are rejected once the queue is half full
+    with pytest.raises(QueueFullException) as e:
+        scheduler.admit("update", "new", "low", db_path)
+    assert e.value.retry_after == scheduler.retry_after
+    scheduler.admit("start", "", "normal", db_path)
+
+    _queue(db_path, 2, "start")
+    with pytest.raises(QueueFullException):
+        scheduler.admit("start", "", "normal", db_path)
+
+    # high priority requests and updates merged into queued ones are always accepted
+    scheduler.admit("start", "", "high", db_path)
+    scheduler.admit("update", "svc0", "normal", db_path)
+
+    scheduler.set_limits({"queue": 0}, db_path)
+    scheduler.admit("update", "new", "low", db_path)
@@ -0,0 +1,89 @@
+"""Tests for the content-addressed spool of custom files in tasks/spool.py."""
+import json
+import os
+
+import pytest
+
+from service_config import database
+from tasks import spool
+from tasks.exceptions import InvalidFilePathException
+
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join("services", "svc"))
+    database.migrate()
+    return tmp_path / "services"
+
+
+def test_identical_contents_are_stored_once(services):
+    refs = spool.store_files({"a.conf": "x", "b/c.conf": "x", "d.conf": "y"})
+
+    assert refs["a.conf"] == refs["b/c.conf"] != refs["d.conf"]
+    assert sorted(os.listdir(services / ".spool")) == sorted({refs["a.conf"], refs["d.conf"]})
+    assert spool.load(refs["d.conf"]) == b"y"
+
+
+def test_unchanged_files_are_skipped(services):
+    refs = spool.store_files({"a.conf": "x", "conf/b.conf": "y"})
+
+    assert spool.write_files("svc", str(services / "svc"), refs) == 2
+    assert (services / "svc" / "conf" / "b.conf").read_text() == "y"
+    assert spool.write_files("svc", str(services / "svc"), refs) == 0
+
+    # changed contents and files modified in the repository are written again
+    (services / "svc" / "a.conf").write_text("checked out")
+    assert spool.write_files("svc", str(services / "svc"), {**refs, **spool.store_files({"conf/b.conf": "z"})}) == 2
+    assert (services / "svc" / "a.conf").read_text() == "x"
+    assert (services / "svc" / "conf" / "b.conf").read_text() == "z"
+
+
+@pytest.mark.parametrize("path", ["/etc/cron.d/x", "link/x"])
+def test_files_outside_of_the_repository_are_rejected(services, path):
+    os.symlink(str(services), str(services / "svc" / "link"))
+    refs = spool.store_files({"a.conf": "x", path: "* * * * * root id"})
+
+    with pytest.raises(InvalidFilePathException):
+        spool.write_files("svc", str(services / "svc"), refs)
+    assert not (services / "svc" / "a.conf").exists()
+    assert not (services / "x").exists()
+
+
+def test_garbage_collection_keeps_referenced_files(services, monkeypatch):
+    deployed = spool.store_files({"a.conf": "deployed"})
+    queued = spool.store_files({"a.conf": "queued"})
+    stale = spool.store_files({"a.conf": "stale"})
+
+    database.execute("INSERT INTO repos (id, url, mode, state, payload) VALUES ('svc', '', 'docker', 'RUNNING', ?)",
+                     (json.dumps({"files": deployed, "volumes": []}),))
+    database.execute("INSERT INTO jobs (id, service_id, kind, state, payload)"
+                     " VALUES ('1', 'svc', 'update', 'QUEUED', ?)", (json.dumps(["svc", queued, []]),))
+
+    # recently stored files may belong to jobs, which aren't queued yet
+    assert spool.collect_garbage() == 0
+
+    monkeypatch.setattr(spool, "gc_grace", -1)
+    assert spool.collect_garbage() == 1
+    assert sorted(os.listdir(services / ".spool")) == sorted([deployed["a.conf"], queued["a.conf"]])
+    assert stale["a.conf"] not in os.listdir(services / ".spool")
+
+
+def test_migration_spools_deployed_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("services")
+    path = os.path.join("services", "legacy.db")
+
+    version = database.migrations.index(database._spool)
+
+    with database.transaction(path) as db:
+        for migration in database.migrations[:version]:
+            migration(db)
+        db.execute(f"PRAGMA user_version = {version}")
+        db.execute("INSERT INTO repos (id, url, mode, state, payload) VALUES ('svc', '', 'docker', 'RUNNING', ?)",
+                   (json.dumps({"files": {"a.conf": "x"}, "volumes": []}),))
+
+    database.migrate(path)
+
+    files = json.loads(database.query_one("SELECT payload FROM repos", path=path)[0])["files"]
+    assert spool.load(files["a.conf"]) == b"x"
@@ -0,0 +1,121 @@
+"""Tests for the Docker-events-driven container status cache (tasks/status_cache.py)."""
+import os
+import queue
+import time
+
+import docker
+import pytest
+from docker.errors import NotFound
+
+from tasks.status_cache import StatusCache
+
+
+class _Container:
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+
+
+class _FakeClient:
+    """Stand-in for docker.from_env() with a controllable event stream."""
+
+    def __init__(self, containers):
+        self.events_queue = queue.Queue()
+        self.lookups = []
+        self._containers = containers
+
+        client = self
+
+        class containers_api:
+            @staticmethod
+            def list(all=False):
+                return [_Container(name, status) for name, status in client._containers.items()]
+
+            @staticmethod
+            def get(name):
+                client.lookups.append(name)
+                if name not in client._containers:
+                    raise NotFound(name)
+                return _Container(name, client._containers[name])
+
+        self.containers = containers_api
+
+    def events(self, decode=False, filters=None):
+        while (event := self.events_queue.get()) is not None:
+            yield event
+
+
+def _event(action, name, **attributes):
+    return {"Action": action, "Actor": {"Attributes": {"name": name, **attributes}}}
+
+
+def _wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = _FakeClient({"svc": "running", "old": "exited"})
+    monkeypatch.setattr(docker, "from_env", lambda: client)
+    yield client
+    client.events_queue.put(None)
+
+
+def test_status_is_answered_from_events(fake_client):
+    cache = StatusCache()
+    cache.start()
+    _wait_for(lambda: cache._synced)
+
+    assert cache.status("svc") == "running"
+
+    fake_client.events_queue.put(_event("die", "svc"))
+    _wait_for(lambda: cache.status("svc") == "exited")
+
+    fake_client.events_queue.put(_event("destroy", "old"))
+    _wait_for(lambda: "old" not in cache._states)
+    with pytest.raises(NotFound):
+        cache.status("old")
+
+    # the daemon was never asked for single containers
+    assert fake_client.lookups == []
+
+
+def test_rename_moves_cached_state():
+    cache = StatusCache()
+    cache.apply(_event("start", "svc-next"))
+    cache.apply(_event("rename", "svc", oldName="/svc-next"))
+
+    assert cache._states == {"svc": "running"}
+
+
+def test_cache_miss_falls_back_to_live_lookup(monkeypatch):
+    client = _FakeClient({"svc": "paused"})
+    monkeypatch.setattr(docker, "from_env", lambda: client)
+
+    cache = StatusCache()
+    assert cache.status("svc") == "paused"
+    assert client.lookups == ["svc"]
+
+
+def test_errors_are_reloaded_after_modification(tmp_path):
+    path = str(tmp_path / "error.txt")
+    with open(path, "w") as f:
+        f.write("first")
+
+    cache = StatusCache()
+    assert cache.errors(path) == "first"
+
+    with open(path, "w") as f:
+        f.write("second")
+    os.utime(path, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+
+    assert cache.errors(path) == "second"
+
+
+def test_missing_error_file_is_empty(tmp_path):
+    # services waiting for their first deployment have no error file yet
+    assert StatusCache().errors(str(tmp_path / "error.txt")) == ""
@@ -0,0 +1,181 @@
+"""Tests for the update flow in tasks/update_service.py with Docker stubbed out."""
+import os
+from types import SimpleNamespace
+
+import pytest
+from docker.errors import APIError, ImageNotFound, NotFound
+
+from service_config import database
+from tasks import start_service, update_service
+from tasks.spool import store_files
+
+
+class FakeDaemon:
+    """Docker client backed by a local registry stand-in: tags resolve to digests, pulls copy them locally."""
+
+    def __init__(self):
+        self.registry = {"nginx:alpine": "sha256:1", "nginx:latest": "sha256:3"}
+        self.reachable = True
+        self.pulls = []
+        # image references and ids of pulled images -> digest
+        self.local = {}
+        self.running = None
+        self.images = SimpleNamespace(get_registry_data=self._registry_data, get=self._image)
+        self.api = SimpleNamespace(pull=self._pull)
+        self.containers = SimpleNamespace(get=self._container)
+
+    def _registry_data(self, name):
+        if not self.reachable:
+            raise APIError("registry unreachable", explanation="registry unreachable")
+        return SimpleNamespace(id=self.registry[name])
+
+    def _image(self, reference):
+        if reference not in self.local:
+            raise ImageNotFound(reference)
+        return SimpleNamespace(attrs={"RepoDigests": [f"nginx@{self.local[reference]}"]})
+
+    def _pull(self, image, tag, stream=False, decode=False):
+        if not self.reachable:
+            yield {"error": "registry unreachable"}
+            return
+        self.pulls.append(f"{image}:{tag}")
+        digest = self.local[f"{image}:{tag}"] = self.registry[f"{image}:{tag}"]
+        self.local[f"id-{digest}"] = digest
+        yield {"status": f"Digest: {digest}"}
+
+    def _container(self, name):
+        if self.running is None:
+            raise NotFound(name)
+        return SimpleNamespace(attrs={"Image": self.running})
+
+
+@pytest.fixture
+def daemon(monkeypatch):
+    fake = FakeDaemon()
+    monkeypatch.setattr(update_service.docker, "from_env", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch, daemon):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join("services", "svc"))
+    database.migrate()
+    database.execute(
+        "INSERT INTO repos (id, url, mode, state, port, docker_root, image, tag)"
+        " VALUES ('svc', '', 'dockerfile', 'INITIALIZING', '8080:80', '.', 'nginx', 'alpine')"
+    )
+
+    calls = []
+
+    def _start(service_id, mode, port, image, tag, *args, pull=True):
+        calls.append(service_id)
+        if pull:
+            list(daemon.api.pull(image, tag))
+        if mode == "dockerfile":
+            daemon.running = f"id-{daemon.local[f'{image}:{tag}']}"
+        database.set_state(service_id, "RUNNING")
+        return True
+
+    monkeypatch.setattr(update_service, "stop_service", lambda *a: None)
+    monkeypatch.setattr(update_service, "start_service", _start)
+    monkeypatch.setattr(update_service, "_container_running", lambda *a: True)
+    return calls
+
+
+def test_unchanged_deployment_is_skipped(service):
+    files = store_files({"a.conf": "x"})
+    assert update_service.update_repository("svc", files, ["data:/data"]) == "RUNNING"
+    assert update_service.update_repository("svc", files, ["data:/data"]) == "NO CHANGE"
+    assert service == ["svc"]
+
+
+@pytest.mark.parametrize("files, volumes", [({"a.conf": "y"}, ["data:/data"]), ({"a.conf": "x"}, [])])
+def test_changed_payload_rebuilds(service, files, volumes):
+    update_service.update_repository("svc", store_files({"a.conf": "x"}), ["data:/data"])
+    assert update_service.update_repository("svc", store_files(files), volumes) == "RUNNING"
+    assert service == ["svc", "svc"]
+
+
+def test_changed_configuration_rebuilds(service):
+    update_service.update_repository("svc", {}, [])
+    database.execute("UPDATE repos SET tag = 'latest' WHERE id = 'svc'")
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+
+
+def test_stopped_container_is_restarted(service, monkeypatch):
+    update_service.update_repository("svc", {}, [])
+    monkeypatch.setattr(update_service, "_container_running", lambda *a: False)
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+
+
+def test_failed_deployment_is_retried(service, monkeypatch):
+    database.execute("UPDATE repos SET commit_sha = 'old' WHERE id = 'svc'")
+    monkeypatch.setattr(update_service, "deploy_fingerprint", lambda *a: ("fingerprint", "new"))
+    start = update_service.start_service
+    monkeypatch.setattr(update_service, "start_service", lambda *a, **kw: False)
+
+    # the failed commit isn't reported as deployed
+    assert update_service.update_repository("svc", {}, []) == "BUILD FAILED"
+    assert tuple(database.query_one("SELECT fingerprint, commit_sha, failed_sha FROM repos WHERE id = 'svc'")) == \
+        ("", "old", "new")
+
+    monkeypatch.setattr(update_service, "start_service", start)
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+    assert tuple(database.query_one("SELECT fingerprint, commit_sha, failed_sha FROM repos WHERE id = 'svc'")) == \
+        ("fingerprint", "new", "")
+
+
+def test_blue_green_services_are_replaced(service, monkeypatch):
+    replaced = []
+    database.execute("UPDATE repos SET update_strategy = 'blue-green' WHERE id = 'svc'")
+    monkeypatch.setattr(update_service, "stop_service", lambda *a: pytest.fail("service stopped"))
+    monkeypatch.setattr(update_service, "replace_service", lambda service_id, *a: replaced.append(service_id) or True)
+
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+    assert replaced == ["svc"]
+    assert service == []
+
+
+def test_compose_services_are_not_stopped(service, monkeypatch):
+    database.execute("UPDATE repos SET mode = 'docker-compose' WHERE id = 'svc'")
+    monkeypatch.setattr(update_service, "stop_service", lambda *a: pytest.fail("service stopped"))
+
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+    assert service == ["svc"]
+
+
+def test_unchanged_registry_digest_skips_the_restart(service, daemon):
+    # the image pulled before stopping the container is started without pulling it again
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+    assert update_service.update_repository("svc", {}, []) == "NO CHANGE"
+    assert daemon.pulls == ["nginx:alpine"]
+
+
+def test_first_update_of_an_unchanged_image_is_skipped(service, daemon, monkeypatch):
+    monkeypatch.setattr(start_service, "start_service", update_service.start_service)
+
+    assert start_service.launch_service("svc", []) == "RUNNING"
+    assert update_service.update_repository("svc", {}, []) == "NO CHANGE"
+    assert daemon.pulls == ["nginx:alpine"]
+
+
+def test_moved_tag_is_pulled_and_restarted(service, daemon):
+    update_service.update_repository("svc", {}, [])
+    daemon.registry["nginx:alpine"] = "sha256:2"
+
+    assert update_service.update_repository("svc", {}, []) == "RUNNING"
+    assert daemon.pulls == ["nginx:alpine", "nginx:alpine"]
+    assert daemon.running == "id-sha256:2"
+    assert update_service.update_repository("svc", {}, []) == "NO CHANGE"
+
+
+def test_failed_pull_keeps_the_running_container(service, daemon, monkeypatch):
+    update_service.update_repository("svc", {}, [])
+    database.execute("UPDATE repos SET tag = 'latest' WHERE id = 'svc'")
+    daemon.reachable = False
+    monkeypatch.setattr(update_service, "stop_service", lambda *a: pytest.fail("service stopped"))
+
+    assert update_service.update_repository("svc", {}, []) == "BUILD FAILED"
+    assert daemon.running == "id-sha256:1"
+    assert service == ["svc"]